@@ -0,0 +1,97 @@
+# /api/messages の行/秒を計測するベンチマーク
+#
+#   python benchmarks/bench_api_messages.py [--rows 10000] [--page 500] [--repeat 20]
+#
+# 同じページ（最新 page 件）を、次の方法でJSONにするまでの速度を比較します。
+# - legacy: 行を辞書にしてPythonのループでキーを付け替え、json.dumps する（以前の実装）
+# - pydantic: ChatMessage の TypeAdapter で行を検証してシリアライズする（SQLite以外のエンジン）
+# - sqlite-json: SQLiteのJSON関数で行から直接生成する（現在のSQLiteの実装）
+# - endpoint: TestClient 経由で /api/messages を呼び出す（本文キャッシュは毎回破棄）
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import llm_agentchat.server.db as db
+from llm_agentchat.schema import encode_messages
+
+def legacy_encode(conn, room, limit):
+    rows = db.get_messages_for_room(conn, room, limit=limit)
+    payload = [
+        {
+            "id": msg.get("id"),
+            "room": room,
+            "sender": msg.get("sender"),
+            "message": msg.get("message_content"),
+            "timestamp": msg.get("timestamp"),
+            "type": msg.get("message_type"),
+        }
+        for msg in rows
+    ]
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def pydantic_encode(conn, room, limit):
+    return encode_messages(db.get_messages_for_room(conn, room, limit=limit), room=room)
+
+def sqlite_json_encode(conn, room, limit):
+    return db.get_messages_json(conn, room, limit=limit)
+
+def measure(name, func, rows_per_call, repeat):
+    func() # ウォームアップ
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - started
+    rate = rows_per_call * repeat / elapsed
+    print(f"{name:<12} {rate:>12,.0f} rows/s  ({elapsed / repeat * 1000:.2f} ms per page)")
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--page", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        conn = db.get_db(path, check_same_thread=False)
+        db.init_db(conn)
+        conn.executemany(
+            "INSERT INTO messages (room_name, sender, message_content, message_type, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [("bench", f"agent{i % 4}", f"メッセージ {i}: " + "lorem ipsum " * 10, "chat",
+              "2025-01-01T00:00:00+00:00") for i in range(args.rows)],
+        )
+        conn.commit()
+
+        assert json.loads(legacy_encode(conn, "bench", args.page)) == json.loads(sqlite_json_encode(conn, "bench", args.page))
+        results = {
+            "legacy": measure("legacy", lambda: legacy_encode(conn, "bench", args.page), args.page, args.repeat),
+            "pydantic": measure("pydantic", lambda: pydantic_encode(conn, "bench", args.page), args.page, args.repeat),
+            "sqlite-json": measure("sqlite-json", lambda: sqlite_json_encode(conn, "bench", args.page),
+                                   args.page, args.repeat),
+        }
+        conn.close()
+
+        from fastapi.testclient import TestClient
+        from llm_agentchat.server.app import app
+        from llm_agentchat.server.http_cache import body_cache
+
+        app.state.storage_engine = "sqlite"
+        app.state.db_path = path
+        with TestClient(app) as client:
+            def fetch():
+                body_cache.clear()
+                response = client.get(f"/api/messages?room=bench&limit={args.page}",
+                                      headers={"Accept-Encoding": "identity"})
+                response.raise_for_status()
+            results["endpoint"] = measure("endpoint", fetch, args.page, args.repeat)
+
+    print(f"sqlite-json vs legacy: x{results['sqlite-json'] / results['legacy']:.2f}")
+
+if __name__ == "__main__":
+    main()
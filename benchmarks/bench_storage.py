@@ -0,0 +1,59 @@
+# ストレージ層のマイクロベンチマーク
+#
+#   python benchmarks/bench_storage.py [--rows 1000000] [--rooms 2000] [--engine sqlite] [--data-dir DIR]
+#                                      [--check benchmarks/storage_thresholds.json] [--json results.json]
+#
+# 合成した履歴（初回のみ生成し、--data-dir に残して再利用する）に対して、書き込みのスループット、
+# 直近のウィンドウ・ページング・ブートストラップの待ち時間、長期記憶の検索、ディスク上のサイズを計測します。
+# --check を指定すると結果をしきい値ファイルと比較し、退行があれば終了コード1で終了します。
+# しきい値は既定の規模（100万行・2000ルーム）で計測した値に余裕を持たせたものです。
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from llm_agentchat.server.storage import ENGINES
+from llm_agentchat.server.storage_bench import check_thresholds, format_results, run_suite
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", action="append", choices=ENGINES, help="計測するエンジン（省略時は全て）")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "agentchat-bench-storage"),
+                        help="合成した履歴の保存先")
+    parser.add_argument("--queries", type=int, default=300, help="読み込みの計測に使うクエリ数")
+    parser.add_argument("--inserts", type=int, default=2000, help="書き込みの計測に使うメッセージ数")
+    parser.add_argument("--memory-messages", type=int, default=20000, help="長期記憶に索引付けするメッセージ数")
+    parser.add_argument("--check", metavar="THRESHOLDS", help="結果を比較するしきい値ファイル")
+    parser.add_argument("--json", metavar="OUTPUT", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    results = run_suite(args.data_dir, engines=args.engine or ENGINES, rows=args.rows, rooms=args.rooms,
+                        seed=args.seed, queries=args.queries, inserts=args.inserts,
+                        memory_messages=args.memory_messages)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            thresholds = json.load(f)
+        if thresholds.get("dataset", {}).get("rows") not in (None, args.rows):
+            print(f"\nWarning: thresholds were calibrated for {thresholds['dataset']['rows']:,} rows", file=sys.stderr)
+        failures = check_thresholds(results, thresholds)
+        print()
+        if failures:
+            print("Performance regressions:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print("All storage metrics are within thresholds.")
+
+if __name__ == "__main__":
+    main()
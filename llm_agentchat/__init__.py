@@ -4,6 +4,64 @@ import uvicorn
 import webbrowser
 import os
 from llm_agentchat.server.app import app # FastAPIアプリケーションをインポート
+from llm_agentchat.client.mock_model import LATENCY_DISTRIBUTIONS, MockModel
+from llm_agentchat.server.storage import DEFAULT_PATHS as STORAGE_DEFAULT_PATHS, ENGINES as STORAGE_ENGINES
+from llm_agentchat.server.blobs import BLOB_THRESHOLD
+from llm_agentchat.server.ingest import DEFAULT_BATCH_WINDOW
+from llm_agentchat.server import admission as admission_defaults
+from llm_agentchat.profiling import configure_profiling, start_loop_monitor
+from llm_agentchat.tracing import (
+    configure_logging, configure_tracing, format_breakdown, group_by_trace, load_trace_records,
+)
+
+def observability_options(func):
+    """サーバーとクライアントで共通のロギング・トレース・プロファイリング関連オプションを付与するデコレータ。"""
+    func = click.option(
+        "--lag-threshold",
+        default=None,
+        type=click.FloatRange(min=0, min_open=True),
+        help="イベントループがこの時間（ミリ秒）以上止まったらスタックをログに出す (デフォルト: 100)",
+    )(func)
+    func = click.option(
+        "--profile-output",
+        default=None,
+        help="サンプリングプロファイルをfolded形式で書き出すファイル（{service} と {pid} を置換。--profile を含む）",
+    )(func)
+    func = click.option(
+        "--profile",
+        is_flag=True,
+        help="イベントループの遅延を監視し、ループを止めている処理をログに出す",
+    )(func)
+    func = click.option(
+        "--log-sample-rate",
+        default=1.0,
+        type=click.FloatRange(0.0, 1.0),
+        help="メッセージ単位の送受信ログを出力する割合 (デフォルト: 1.0)",
+    )(func)
+    func = click.option(
+        "--log-level",
+        default="INFO",
+        type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+        help="ログレベル (デフォルト: INFO。送受信ログはDEBUGで出力されます)",
+    )(func)
+    func = click.option(
+        "--trace-otel",
+        is_flag=True,
+        help="タイミングマークをOpenTelemetryのスパンとして出力する (opentelemetry-api が必要)",
+    )(func)
+    func = click.option(
+        "--trace-file",
+        default=None,
+        help="メッセージのタイミングマークを書き出すJSONLファイルのパス",
+    )(func)
+    return func
+
+@llm.hookimpl
+def register_models(register) -> None:
+    """
+    ベンチマーク用のモックモデル（agentchat-mock）を登録します。
+    """
+    register(MockModel())
 
 @llm.hookimpl
 def register_commands(cli: click.Group) -> None:
@@ -28,22 +86,138 @@ def register_commands(cli: click.Group) -> None:
     @click.option(
         "-s",
         "--storage",
-        default="chat_history.db",
-        help="チャット履歴を保存するSQLiteデータベースファイルのパス (デフォルト: chat_history.db)",
+        default=None,
+        help="チャット履歴の保存先 (デフォルト: sqlite は chat_history.db、log は chat_history_log ディレクトリ)",
+    )
+    @click.option(
+        "--storage-engine",
+        type=click.Choice(list(STORAGE_ENGINES)),
+        default="sqlite",
+        help="チャット履歴のストレージエンジン (sqlite / 追記専用セグメントログ log。デフォルト: sqlite)",
     )
     @click.option(
         "--no-browser",
         is_flag=True,
         help="サーバー起動後にWeb UIを自動的に開かない",
     )
-    def server(room_name: str, port: int, host: str, storage: str, no_browser: bool) -> None:
+    @click.option(
+        "--turn-policy",
+        type=click.Choice(["none", "round_robin", "mention_first", "moderator"]),
+        default="none",
+        help="エージェントの発言権制御ポリシー (デフォルト: none = 全エージェントが自由に応答)",
+    )
+    @click.option(
+        "--reply-budget",
+        default=3,
+        type=click.IntRange(min=1),
+        help="人間のメッセージ1件あたりに許可するエージェントの応答数 (デフォルト: 3)",
+    )
+    @click.option(
+        "--moderator",
+        default=None,
+        help="moderator ポリシーで司会役を務めるエージェント名",
+    )
+    @click.option(
+        "--heartbeat-interval",
+        default=15.0,
+        type=click.FloatRange(min=0),
+        help="接続中のクライアントにハートビートを送る間隔（秒、0で無効。デフォルト: 15）",
+    )
+    @click.option(
+        "--heartbeat-timeout",
+        default=45.0,
+        type=click.FloatRange(min=0, min_open=True),
+        help="ハートビートに応答するクライアントの応答がなくなってから切断するまでの時間（秒、デフォルト: 45）",
+    )
+    @click.option(
+        "--blob-threshold",
+        default=BLOB_THRESHOLD,
+        type=click.IntRange(min=0),
+        help=f"これより大きい本文（バイト）はブロブとして保存し、プレビューと参照だけを配信する（0で無効。デフォルト: {BLOB_THRESHOLD}）",
+    )
+    @click.option(
+        "--batch-window-ms",
+        default=DEFAULT_BATCH_WINDOW * 1000,
+        type=click.FloatRange(min=0),
+        help="活発なルームで1つのバッチにまとめるメッセージを待つ時間（ミリ秒、0で待たない。デフォルト: 5）",
+    )
+    @click.option(
+        "--max-connections",
+        default=admission_defaults.DEFAULT_MAX_CONNECTIONS,
+        type=click.IntRange(min=0),
+        help=f"サーバー全体で受け入れる接続（WebSocket・SSE）数の上限（0で無制限。デフォルト: {admission_defaults.DEFAULT_MAX_CONNECTIONS}）",
+    )
+    @click.option(
+        "--max-room-connections",
+        default=admission_defaults.DEFAULT_MAX_ROOM_CONNECTIONS,
+        type=click.IntRange(min=0),
+        help=f"ルームごとに受け入れる接続数の上限（0で無制限。デフォルト: {admission_defaults.DEFAULT_MAX_ROOM_CONNECTIONS}）",
+    )
+    @click.option(
+        "--max-inflight",
+        default=admission_defaults.DEFAULT_MAX_INFLIGHT,
+        type=click.IntRange(min=0),
+        help=f"同時に処理するHTTPリクエスト数の上限（0で無制限。デフォルト: {admission_defaults.DEFAULT_MAX_INFLIGHT}）",
+    )
+    @click.option(
+        "--overload-lag-ms",
+        default=admission_defaults.DEFAULT_LAG_THRESHOLD * 1000,
+        type=click.FloatRange(min=0),
+        help="イベントループの遅延（指数移動平均）がこれを超えたら過負荷とみなし、観察者から順に断る"
+             f"（ミリ秒、0で無効。デフォルト: {admission_defaults.DEFAULT_LAG_THRESHOLD * 1000:.0f}）",
+    )
+    @click.option(
+        "--overload-backlog",
+        default=admission_defaults.DEFAULT_BACKLOG_THRESHOLD,
+        type=click.IntRange(min=0),
+        help="配信待ちのメッセージ数（受信キューと接続ごとの送信待ちの合計）がこれを超えたら過負荷とみなす"
+             f"（0で無効。デフォルト: {admission_defaults.DEFAULT_BACKLOG_THRESHOLD}）",
+    )
+    @observability_options
+    def server(room_name: str, port: int, host: str, storage: str, storage_engine: str, no_browser: bool,
+               turn_policy: str, reply_budget: int, moderator: str,
+               heartbeat_interval: float, heartbeat_timeout: float, blob_threshold: int, batch_window_ms: float,
+               max_connections: int, max_room_connections: int, max_inflight: int,
+               overload_lag_ms: float, overload_backlog: int,
+               trace_file: str, trace_otel: bool, log_level: str, log_sample_rate: float,
+               profile: bool, profile_output: str, lag_threshold: float) -> None:
         """
         エージェントチャットサーバーを起動します。
         """
+        configure_logging(log_level, log_sample_rate)
+        configure_tracing("server", trace_file=trace_file, otel=trace_otel)
+        configure_profiling(profile, profile_output, lag_threshold)
         click.echo(f"Starting agentchat server for room: {room_name}")
         
-        # データベースパスをアプリケーションの状態に設定
-        app.state.db_path = storage
+        # ストレージの設定をアプリケーションの状態に設定
+        app.state.storage_engine = storage_engine
+        app.state.db_path = storage or STORAGE_DEFAULT_PATHS[storage_engine]
+        click.echo(f"Storage: {storage_engine} ({app.state.db_path})")
+        # 大きな本文はストレージの隣のブロブストアに保存する
+        app.state.blob_threshold = blob_threshold
+        # 活発なルームでは短い間隔に届いたメッセージをまとめて保存・配信する
+        app.state.batch_window = batch_window_ms / 1000
+        # 受け入れ制御（上限と過負荷の検出。過負荷時は観察者、エージェントの順に断る）
+        app.state.admission = {
+            "max_connections": max_connections,
+            "max_room_connections": max_room_connections,
+            "max_inflight": max_inflight,
+            "lag_threshold": overload_lag_ms / 1000,
+            "backlog_threshold": overload_backlog,
+        }
+
+        # 発言権スケジューラの設定
+        if turn_policy == "moderator" and not moderator:
+            raise click.UsageError("--turn-policy moderator requires --moderator")
+        app.state.turn_policy = None if turn_policy == "none" else turn_policy
+        app.state.reply_budget = reply_budget
+        app.state.moderator = moderator
+        if app.state.turn_policy:
+            click.echo(f"Turn policy: {turn_policy} (reply budget: {reply_budget})")
+
+        # ハートビートの設定（応答しない接続を切断してプレゼンスを正確に保つ）
+        app.state.heartbeat_interval = heartbeat_interval
+        app.state.heartbeat_timeout = heartbeat_timeout
 
         # FastAPIアプリケーションをUvicornで起動
         click.echo(f"Server starting on http://{host}:{port}")
@@ -54,12 +228,18 @@ def register_commands(cli: click.Group) -> None:
             except Exception as e:
                 click.echo(f"Warning: Could not open browser automatically: {e}", err=True)
 
-        uvicorn.run(app, host=host, port=port, log_level="info")
+        # プロトコルレベルのping/pongも同じ間隔で行う
+        uvicorn.run(app, host=host, port=port, log_level="info",
+                    ws_ping_interval=heartbeat_interval or None, ws_ping_timeout=heartbeat_timeout)
 
     import asyncio
     import yaml
     from llm_agentchat.client.agent import Agent # Agentクラスをインポート
     from llm_agentchat.client.websocket_client import WebSocketClient # WebSocketClientをインポート
+    from llm_agentchat.client.llm_scheduler import configure_llm_scheduler
+    from llm_agentchat.client.http_client import close_http_client
+    from llm_agentchat.client.tools import configure_tool_sandbox
+    from llm_agentchat.client.hedging import get_hedge_stats
 
     @cli.command(name="agentchat-client")
     @click.argument("room_name")
@@ -77,12 +257,20 @@ def register_commands(cli: click.Group) -> None:
         type=click.Path(exists=True),
         help="エージェント定義ファイルのパス (デフォルト: agents.yml)",
     )
-    def client(room_name: str, agent_name: str, server_url: str, agents_file: str) -> None:
+    @observability_options
+    def client(room_name: str, agent_name: str, server_url: str, agents_file: str,
+               trace_file: str, trace_otel: bool, log_level: str, log_sample_rate: float,
+               profile: bool, profile_output: str, lag_threshold: float) -> None:
         """
         エージェントをチャットルームに参加させます。
+        ROOM_NAME にはカンマ区切りで複数のルームや "project-*" のようなパターンも指定でき、
+        1つのプロセス・1つの接続で全てのルームに参加します（会話履歴はルームごと、モデルとLLMの同時実行数は共有）。
         """
+        configure_logging(log_level, log_sample_rate)
+        configure_tracing("agent", trace_file=trace_file, otel=trace_otel)
+        configure_profiling(profile, profile_output, lag_threshold)
         click.echo(
-            f"Starting agentchat client for agent '{agent_name}' in room: {room_name}"
+            f"Starting agentchat client for agent '{agent_name}' in room(s): {room_name}"
         )
         click.echo(f"Connecting to server: {server_url}")
 
@@ -101,6 +289,19 @@ def register_commands(cli: click.Group) -> None:
 
         common_settings = agents_config.get('common_settings', {})
 
+        # 同じプロセス内のエージェントで共有するLLM呼び出しスケジューラを設定
+        configure_llm_scheduler(
+            common_settings.get('rate_limits'),
+            max_retries=common_settings.get('llm_max_retries', 3),
+        )
+        # ツール呼び出しを実行するサンドボックスを設定
+        configure_tool_sandbox(
+            max_workers=common_settings.get('tool_workers', 4),
+            timeout=common_settings.get('tool_timeout', 30.0),
+            memory_limit_mb=common_settings.get('tool_memory_mb', 512),
+            max_output_chars=common_settings.get('tool_max_output_chars', 16000),
+        )
+
         # エージェントインスタンスの作成
         # on_message_received と on_send_message コールバックを渡すための準備
         # これらは後で WebSocketClient と Agent 間で接続されます
@@ -116,29 +317,139 @@ def register_commands(cli: click.Group) -> None:
             server_url=server_url,
             room_name=room_name,
             agent_name=agent_name,
-            on_message=agent.handle_message_from_server # エージェントのメソッドを受信ハンドラとして渡す
+            on_message=agent.handle_message_from_server, # エージェントのメソッドを受信ハンドラとして渡す
+            subscribe=agent.subscribe,
+            batch=True,
         )
             
         # エージェントがメッセージを送信する際にws_clientを使うように設定
         agent.set_websocket_client(ws_client)
 
         async def main_client_loop():
-            await ws_client.connect()
-            if ws_client.websocket:
-                # エージェントの起動ロジック
-                # 例: 接続成功メッセージを送信、LLMによる初回発言など
-                initial_message = {
-                    "room": room_name,
-                    "sender": agent_name,
-                    "message": f"Hello, I am {agent_name} and I have joined the chat!",
-                    "type": "system"
-                }
-                await ws_client.send_message(initial_message)
-                    
-                # エージェントのメインループを開始（永続的にメッセージを処理）
-                await agent.start_listening() # このメソッドは無限ループを想定
-
-            else:
-                click.echo("Failed to establish WebSocket connection.", err=True)
+            # --profile 指定時はイベントループの遅延を監視する
+            loop_monitor = start_loop_monitor("agent")
+
+            # 自動再接続付きの接続ループを開始し（サーバーの再起動後も自動的に再接続する）、
+            # 接続してから参加前の会話をサーバーから1回のリクエストで取得する
+            if not await agent.join(timeout=10):
+                click.echo("Waiting for the server to become available...", err=True)
+
+            # 参加・退出の通知はサーバーがプレゼンスイベントとして配信する
+
+            # エージェントのメインループを開始（クライアントが停止するまでメッセージを処理）
+            try:
+                await agent.start_listening()
+            finally:
+                await ws_client.disconnect()
+                await close_http_client()
+                get_hedge_stats().log_summary()
+                if loop_monitor is not None:
+                    loop_monitor.stop()
 
         asyncio.run(main_client_loop())
+
+    @cli.command(name="agentchat-trace")
+    @click.argument("trace_files", nargs=-1, required=True, type=click.Path(exists=True))
+    @click.option("-t", "--trace-id", default=None, help="表示するトレースID (省略時は全て)")
+    @click.option("-n", "--last", default=20, type=int, help="表示する最新トレースの件数 (デフォルト: 20)")
+    def trace(trace_files, trace_id: str, last: int) -> None:
+        """
+        サーバーとエージェントのトレースファイルを読み込み、メッセージごとの所要時間の内訳を表示します。
+        """
+        traces = group_by_trace(load_trace_records(trace_files))
+        if trace_id:
+            if trace_id not in traces:
+                click.echo(f"Error: trace '{trace_id}' not found", err=True)
+                return
+            click.echo(format_breakdown(trace_id, traces[trace_id]))
+            return
+        # 最新のトレースを開始時刻順に表示
+        ordered = sorted(traces.items(), key=lambda item: item[1][0]["ts"])[-last:]
+        for tid, marks in ordered:
+            click.echo(format_breakdown(tid, marks))
+            click.echo("")
+
+    @cli.command(name="agentchat-replay")
+    @click.argument("script_file", required=False, type=click.Path(exists=True))
+    @click.option(
+        "-a",
+        "--agents-file",
+        default="agents.yml",
+        type=click.Path(exists=True),
+        help="エージェント定義ファイルのパス (デフォルト: agents.yml)",
+    )
+    @click.option("-n", "--agent", "agent_names", multiple=True, help="リプレイに参加させるエージェント名 (省略時は全て)")
+    @click.option("--synthetic", default=0, type=click.IntRange(min=0),
+                  help="スクリプトの代わりに合成する人間のメッセージ数")
+    @click.option("--interval", default=5.0, type=click.FloatRange(min=0),
+                  help="合成するメッセージの平均間隔（秒、デフォルト: 5）")
+    @click.option("--speed", default=20.0, type=click.FloatRange(min=0, min_open=True),
+                  help="仮想時間の倍速 (デフォルト: 20)")
+    @click.option("--seed", default=0, type=int, help="乱数シード (デフォルト: 0)")
+    @click.option("--latency", default=1.0, type=click.FloatRange(min=0),
+                  help="モックモデルの最初のトークンまでの平均待ち時間（秒、デフォルト: 1.0）")
+    @click.option("--latency-dist", default="lognormal", type=click.Choice(list(LATENCY_DISTRIBUTIONS)),
+                  help="待ち時間の分布 (デフォルト: lognormal)")
+    @click.option("--latency-spread", default=0.5, type=click.FloatRange(min=0),
+                  help="待ち時間のばらつき (デフォルト: 0.5)")
+    @click.option("--tokens-per-second", default=50.0, type=click.FloatRange(min=0),
+                  help="モックモデルのトークン生成速度 (デフォルト: 50)")
+    @click.option("--output-tokens", default=40, type=click.IntRange(min=0),
+                  help="モックモデルの応答のトークン数 (デフォルト: 40)")
+    @click.option("--turn-policy", default="round_robin",
+                  type=click.Choice(["none", "round_robin", "mention_first"]),
+                  help="リプレイ中のサーバーの発言権制御ポリシー (デフォルト: round_robin)")
+    @click.option("--reply-budget", default=3, type=click.IntRange(min=1),
+                  help="人間のメッセージ1件あたりに許可するエージェントの応答数 (デフォルト: 3)")
+    @click.option("--drain", default=5.0, type=click.FloatRange(min=0),
+                  help="最後の投稿後、この時間（秒）応答がなければ終了する (デフォルト: 5)")
+    @click.option("--max-duration", default=None, type=click.FloatRange(min=0, min_open=True),
+                  help="リプレイの最大時間（仮想時間の秒）")
+    @click.option("--json", "as_json", is_flag=True, help="レポートをJSONで出力する")
+    def replay(script_file: str, agents_file: str, agent_names, synthetic: int, interval: float, speed: float,
+               seed: int, latency: float, latency_dist: str, latency_spread: float, tokens_per_second: float,
+               output_tokens: int, turn_policy: str, reply_budget: int, drain: float, max_duration: float,
+               as_json: bool) -> None:
+        """
+        エクスポートしたルーム（または合成したスクリプト）をモックモデルのエージェントでリプレイし、
+        エージェント側のスループット、待ち時間、段階ごとのCPU時間を表示します。
+        """
+        import json
+        from llm_agentchat.replay import format_report, load_script, run_replay, synthetic_script
+
+        with open(agents_file, 'r', encoding='utf-8') as f:
+            agents_config = yaml.safe_load(f)
+        agent_configs = agents_config.get('agents', [])
+        if agent_names:
+            agent_configs = [a for a in agent_configs if a['name'] in agent_names]
+            missing = set(agent_names) - {a['name'] for a in agent_configs}
+            if missing:
+                raise click.UsageError(f"Agent(s) not found in '{agents_file}': {', '.join(sorted(missing))}")
+        names = [a['name'] for a in agent_configs]
+
+        if script_file:
+            script = load_script(script_file, skip_senders=names)
+        elif synthetic:
+            script = synthetic_script(synthetic, interval=interval, agents=names, seed=seed)
+        else:
+            raise click.UsageError("Specify a SCRIPT_FILE or --synthetic N")
+
+        report = run_replay(
+            script,
+            agent_configs,
+            common_settings=agents_config.get('common_settings', {}),
+            mock_options={
+                "latency": latency,
+                "latency_dist": latency_dist,
+                "latency_spread": latency_spread,
+                "tokens_per_second": tokens_per_second,
+                "output_tokens": output_tokens,
+            },
+            speed=speed,
+            seed=seed,
+            turn_policy=None if turn_policy == "none" else turn_policy,
+            reply_budget=reply_budget,
+            drain=drain,
+            max_duration=max_duration,
+        )
+        click.echo(json.dumps(report, indent=2) if as_json else format_report(report))
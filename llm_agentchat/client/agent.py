@@ -1,58 +1,346 @@
 import llm # simonw/llm ライブラリのllmオブジェクトをインポート
 import asyncio
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterable, List, Optional, Union
 import httpx # HTTP通信用
 import yaml # エージェント設定ファイル読み込み用
 import os # ファイルパス操作用
+import logging
+import threading
+from llm_agentchat.tracing import get_tracer, log_sampled
+from llm_agentchat.client.http_client import get_http_client
+from llm_agentchat.schema import AGENT_HEADER, ChatMessage, MessageIn, parse_room_spec, room_matches
+from pydantic import ValidationError
+from llm_agentchat.client.tools import get_tool_sandbox, resolve_tools
+from llm_agentchat.client.memory import AgentMemory, format_memories, is_memorable
+from llm_agentchat.client.hedging import HedgeCancelled, HedgePolicy, run_hedged
+from llm_agentchat.client.llm_scheduler import (
+    PRIORITY_AGENT, PRIORITY_HUMAN, CircuitOpenError, RetriesExhaustedError, estimate_tokens, get_llm_scheduler,
+)
+
+logger = logging.getLogger(__name__)
+
+def _response_token_count(response: Any) -> Optional[int]:
+    """llmのレスポンスから実際のトークン使用量（入力+出力）を取得します。取得できなければNone。"""
+    try:
+        usage = response.usage()
+    except Exception:
+        return None
+    total = 0
+    for value in (getattr(usage, "input", None), getattr(usage, "output", None)):
+        if not isinstance(value, int):
+            return None
+        total += value
+    return total
+
+class RoomContext:
+    """
+    エージェントが参加している1つのルームの状態。会話履歴（直近 history_limit 件）、参加前の会話の要約、
+    長期記憶、発言権制御の状態と、ルーム内の応答を1件ずつ順に生成するためのロックを持ちます。
+    """
+    def __init__(self, room: str, history_limit: int, memory: Optional[AgentMemory] = None):
+        self.room = room
+        self.history_limit = history_limit # 0以下なら履歴を切り詰めない
+        self.chat_history: List[Dict[str, str]] = []
+        self.context_summary: Optional[str] = None
+        self.memory = memory
+        self.floor_controlled = False # サーバーの発言権スケジューラに従うかどうか
+        self.reply_lock = asyncio.Lock()
+        self.last_id: Optional[int] = None # ブートストラップで読み込んだ最新のメッセージID
+        self.ready: Optional[asyncio.Task] = None # ブートストラップ（完了までは受信したメッセージの処理を待たせる）
+
+    def append(self, entry: Dict[str, str]):
+        """会話履歴にメッセージを追加し、直近 history_limit 件より古いものを捨てます（長期記憶には残る）。"""
+        self.chat_history.append(entry)
+        if 0 < self.history_limit < len(self.chat_history):
+            del self.chat_history[:-self.history_limit]
 
 class Agent:
     """
     LLMエージェントのコアロジックを管理するクラス。
+    1つのエージェントが複数のルームに参加でき、会話履歴・長期記憶・応答の順序はルームごとに分け、
+    モデルのインスタンスとLLM呼び出しの同時実行数（共有のLLMスケジューラ）は全てのルームで共有します。
     """
-    def __init__(self, config: Dict[str, Any], room_name: str, server_url: str, common_settings: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], room_name: Union[str, Iterable[str]], server_url: str,
+                 common_settings: Dict[str, Any]):
         """
         エージェントを初期化します。
+        room_name には1つのルーム名のほか、カンマ区切りの複数のルームやパターン（例: "design,project-*"）、
+        またはそのリストを指定できます。パターンに一致するルームには、最初のメッセージを受信した時点で参加します。
         """
         self.name = config["name"]
         self.model = config["model"]
         self.persona = config["persona"]
         self.options = config.get("options", {}) # モデル固有のオプション
-        self.room_name = room_name
+        self.subscribe = config.get("subscribe") # サーバー側の購読フィルタ（例: "mentions" や ["mentions", "humans"]）
+        if isinstance(self.subscribe, list):
+            self.subscribe = ",".join(self.subscribe)
+        self.tool_names: List[str] = config.get("tools") or [] # llmプラグインが登録したツール名（例: "code"）
+        self._tools: Optional[List[Any]] = None # 解決済みのツール定義（初回の応答生成時に解決）
+        # 予備のモデルとヘッジのポリシー（例: {"models": ["gemini-2.5-flash-lite"], "policy": "deadline"}）
+        self.hedge = HedgePolicy.from_config(config.get("hedge"))
+        self.room_names, self.room_patterns = parse_room_spec(room_name)
+        # 1つのルームだけに参加する場合の（chat_history などの属性が指す）ルーム
+        self.room_name = self.room_names[0] if self.room_names else None
         self.server_url = server_url.replace("ws://", "http://").replace("wss://", "https://") # HTTP API用
         self.websocket_client: Optional[Any] = None # WebSocketClientインスタンスを保持
-        self.chat_history: List[Dict[str, str]] = [] # 会話履歴を保持
         self._is_listening = asyncio.Event() # メッセージリスニング状態を制御
+        self._stop_requested = asyncio.Event() # リスニングの終了要求
+        self._models: Dict[str, Any] = {} # 解決済みのモデル（全てのルームで共有する）
         
         # 共通設定を適用
         self.chat_history_limit = common_settings.get('chat_history_limit', 10)
         self.response_delay_ms = common_settings.get('response_delay_ms', 0)
+        # 起動時にサーバーから取得する直近メッセージ数（0で無効）と、要約を取得するかどうか
+        self.bootstrap_messages = common_settings.get('bootstrap_messages', self.chat_history_limit)
+        self.bootstrap_summary = common_settings.get('bootstrap_summary', True)
+        # 1回の応答でツール呼び出しとその結果の受け渡しを繰り返す最大回数
+        self.tool_max_rounds = common_settings.get('tool_max_rounds', 5)
+        # 長期記憶: 直近のウィンドウより古いメッセージから関連するものを memory_top_k 件プロンプトに含める（0で無効）
+        self.memory_top_k = common_settings.get('memory_top_k', 5)
+        self.memory_bootstrap_messages = common_settings.get('memory_bootstrap_messages', 500)
+        # 埋め込みモデルは全てのルームの長期記憶で共有する
+        self.embedding_model = None
+        if self.memory_top_k > 0 and common_settings.get('memory_embedding_model'):
+            try:
+                self.embedding_model = llm.get_embedding_model(common_settings['memory_embedding_model'])
+            except llm.UnknownModelError as e:
+                logger.warning("Agent '%s' memory falls back to keyword search: %s", self.name, e)
+        # 参加しているルームごとの状態 {room_name: RoomContext}
+        self.rooms: Dict[str, RoomContext] = {room: self._new_context(room) for room in self.room_names}
         
-        print(f"Agent '{self.name}' initialized. History limit: {self.chat_history_limit}, Delay: {self.response_delay_ms}ms")
+        logger.info("Agent '%s' initialized. History limit: %s, Delay: %sms", self.name, self.chat_history_limit, self.response_delay_ms)
+
+    def _new_context(self, room: str) -> RoomContext:
+        memory = AgentMemory(embedding_model=self.embedding_model) if self.memory_top_k > 0 else None
+        return RoomContext(room, self.chat_history_limit, memory)
+
+    def _context(self, context: Optional[RoomContext] = None) -> RoomContext:
+        """context が省略された場合は、1つのルームだけに参加する場合のルームの状態を返します。"""
+        return context if context is not None else self.rooms[self.room_name]
+
+    def _join_room(self, room: Optional[str]) -> Optional[RoomContext]:
+        """
+        参加しているルームの状態を返します。パターンに一致する新しいルームであれば状態を作り、
+        ブートストラップを開始します。参加していないルームの場合はNoneを返します。
+        """
+        context = self.rooms.get(room) if room else None
+        if context is None and room and room_matches(room, self.room_patterns):
+            context = self.rooms[room] = self._new_context(room)
+            logger.info("Agent '%s' joined room '%s' (%d rooms).", self.name, room, len(self.rooms))
+            context.ready = asyncio.create_task(self._bootstrap_room(context), name=f"bootstrap {room}")
+        return context
+
+    # 1つのルームだけに参加する場合に、そのルームの状態を直接参照するための属性
+    @property
+    def chat_history(self) -> List[Dict[str, str]]:
+        return self._context().chat_history
+
+    @chat_history.setter
+    def chat_history(self, value: List[Dict[str, str]]):
+        self._context().chat_history = value
+
+    @property
+    def context_summary(self) -> Optional[str]:
+        return self._context().context_summary
+
+    @property
+    def floor_controlled(self) -> bool:
+        return self._context().floor_controlled
+
+    @property
+    def memory(self) -> Optional[AgentMemory]:
+        return self._context().memory
+
+    def _get_model(self, model_id: str) -> Any:
+        """モデルを解決します。解決したモデルは全てのルームの応答で使い回します。"""
+        if model_id not in self._models:
+            self._models[model_id] = llm.get_model(model_id)
+        return self._models[model_id]
 
     def set_websocket_client(self, ws_client: Any):
         """WebSocketClientインスタンスを設定します。"""
         self.websocket_client = ws_client
 
-    async def _send_message(self, message_content: str, message_type: str = "chat"):
-        """メッセージをサーバーに送信します（WebSocket経由）。"""
-        message_data = {
-            "room": self.room_name,
-            "sender": self.name,
-            "message": message_content,
-            "type": message_type
-        }
+    async def join(self, timeout: float = 10) -> bool:
+        """
+        WebSocketクライアントの接続を開始し、接続してから会話履歴を初期化します。
+        先に接続するため、スナップショットの取得と接続の間に投稿されたメッセージも取りこぼしません
+        （スナップショットと重複して受信したメッセージは last_id で除外する）。
+        タイムアウトまでに接続できなかった場合はFalseを返します（接続は再試行を続ける）。
+        """
+        self.websocket_client.start()
+        connected = await self.websocket_client.wait_connected(timeout=timeout)
+        await self.bootstrap()
+        return connected
+
+    async def bootstrap(self) -> bool:
+        """
+        参加する各ルームの会話履歴を並行して初期化します（パターンで参加するルームは最初のメッセージの受信時）。
+        全てのルームで取得できた場合にTrueを返します。初期化中に受信したメッセージは、初期化の完了後に処理します。
+        """
+        if not self.rooms:
+            return False
+        for context in list(self.rooms.values()):
+            context.ready = asyncio.create_task(self._bootstrap_room(context), name=f"bootstrap {context.room}")
+        results = await asyncio.gather(*(context.ready for context in list(self.rooms.values())))
+        return all(results)
+
+    async def _bootstrap_room(self, context: RoomContext) -> bool:
+        """
+        サーバーからルームの直近の会話（システムメッセージを除く）と要約を1回のリクエストで取得し、
+        会話履歴を初期化します。取得に失敗した場合は空の履歴のまま続行し、Falseを返します。
+        """
+        if self.bootstrap_messages <= 0:
+            return False
+        try:
+            response = await self._api_get(
+                "/api/bootstrap",
+                params={
+                    "room": context.room,
+                    "limit": self.bootstrap_messages,
+                    "summary": str(bool(self.bootstrap_summary)).lower(),
+                },
+            )
+            response.raise_for_status()
+            snapshot = response.json()
+            messages = [ChatMessage.model_validate(msg) for msg in snapshot.get("messages", [])]
+        except (httpx.HTTPError, ValidationError, ValueError) as e:
+            logger.warning("Agent '%s' could not load history of room '%s', continuing without it: %s",
+                           self.name, context.room, e)
+            return False
+        await self._resolve_blobs(messages)
+
+        context.chat_history = []
+        for msg in messages:
+            context.append({"sender": msg.sender, "message": msg.message, "type": msg.type})
+        context.context_summary = snapshot.get("summary")
+        if messages:
+            context.last_id = messages[-1].id
+        logger.info("Agent '%s' loaded %d messages of room '%s' history%s.", self.name, len(messages), context.room,
+                    " and a summary" if context.context_summary else "")
+        if context.memory is not None:
+            # 直近の会話が上限に満たなければ、それより古いメッセージはない
+            before_id = messages[0].id if len(messages) >= self.bootstrap_messages else None
+            older = await self._fetch_older_messages(before_id, context.room)
+            await self._remember_many(older + messages, context)
+        return True
+
+    async def _fetch_older_messages(self, before_id: Optional[int], room: Optional[str] = None) -> List[ChatMessage]:
+        """
+        長期記憶の索引用に、before_id より古いメッセージを memory_bootstrap_messages 件まで
+        /api/messages のページをさかのぼって取得します（古い順）。失敗した場合は取得できた分だけ返します。
+        """
+        pages: List[List[ChatMessage]] = []
+        remaining = self.memory_bootstrap_messages
+        while before_id is not None and remaining > 0:
+            try:
+                response = await self._api_get(
+                    "/api/messages",
+                    params={"room": room or self.room_name, "limit": min(remaining, 500), "before_id": before_id},
+                )
+                response.raise_for_status()
+                page = [ChatMessage.model_validate(msg) for msg in response.json()]
+            except (httpx.HTTPError, ValidationError, ValueError) as e:
+                logger.warning("Agent '%s' could not load older history of room '%s' for memory, "
+                               "continuing with %d page(s): %s", self.name, room or self.room_name, len(pages), e)
+                break
+            if not page:
+                break
+            pages.append(page)
+            remaining -= len(page)
+            before_id = page[0].id
+        older = [msg for page in reversed(pages) for msg in page]
+        await self._resolve_blobs(older)
+        return older
+
+    async def _api_get(self, path: str, **kwargs: Any) -> httpx.Response:
+        """
+        サーバーのHTTP APIを呼び出します。エージェント名のヘッダーを付け、
+        サーバーの過負荷時に観察者（Web UI）より優先して受け入れられるようにします。
+        """
+        return await get_http_client().get(f"{self.server_url}{path}", headers={AGENT_HEADER: self.name}, **kwargs)
+
+    async def _fetch_blob(self, key: str) -> Optional[str]:
+        """サーバーのブロブストアから本文の全文を取得します。失敗した場合はNoneを返します。"""
+        try:
+            response = await self._api_get(f"/api/blobs/{key}")
+            response.raise_for_status()
+            return response.text
+        except httpx.HTTPError as e:
+            logger.warning("Agent '%s' could not fetch message body %s: %s", self.name, key, e)
+            return None
+
+    async def _resolve_blobs(self, messages: List[ChatMessage]):
+        """プレビューだけのメッセージ（blob あり）の本文を全文に置き換えます（取得できなければプレビューのまま）。"""
+        pending = [msg for msg in messages if msg.blob]
+        bodies = await asyncio.gather(*(self._fetch_blob(msg.blob) for msg in pending))
+        for msg, body in zip(pending, bodies):
+            if body is not None:
+                msg.message = body
+
+    async def _remember_many(self, messages: List[ChatMessage], context: Optional[RoomContext] = None):
+        """取得したメッセージをまとめてルームの長期記憶に索引付けします。"""
+        memory = self._context(context).memory
+        rows = [(msg.sender, msg.message) for msg in messages if is_memorable(msg.message, msg.type)]
+        if rows:
+            await asyncio.to_thread(memory.add_many, rows)
+
+    async def _add_to_history(self, sender: str, message: str, message_type: str = "chat",
+                              context: Optional[RoomContext] = None):
+        """ルームの会話履歴にメッセージを追加し、長期記憶にも索引付けします。"""
+        context = self._context(context)
+        context.append({"sender": sender, "message": message, "type": message_type})
+        memory = context.memory
+        if memory is None or not is_memorable(message, message_type):
+            return
+        if memory.embedding_model is not None:
+            # 埋め込みの計算はネットワーク越しの場合があるため、ループを止めないようにスレッドで行う
+            await asyncio.to_thread(memory.add, sender, message, message_type)
+        else:
+            memory.add(sender, message, message_type)
+
+    async def _recall(self, history_to_send: List[Dict[str, str]], context: Optional[RoomContext] = None) -> Optional[str]:
+        """
+        直近のウィンドウ（history_to_send）より古いメッセージから、最新のメッセージに関連するものを
+        ルームの長期記憶から検索してシステムプロンプト用の文字列にします。該当がなければNoneを返します。
+        """
+        memory = self._context(context).memory
+        if memory is None or not history_to_send:
+            return None
+        in_window = sum(1 for msg in history_to_send if is_memorable(msg.get("message"), msg.get("type", "chat")))
+        cutoff = memory.count - in_window
+        if cutoff <= 0:
+            return None
+        query = " ".join(msg.get("message") or "" for msg in history_to_send[-2:])
+        if memory.embedding_model is not None:
+            memories = await asyncio.to_thread(memory.search, query, self.memory_top_k, cutoff)
+        else:
+            memories = memory.search(query, self.memory_top_k, cutoff)
+        return format_memories(memories) if memories else None
+
+    async def _send_message(self, message_content: str, message_type: str = "chat", parent_trace_id: Optional[str] = None,
+                            room: Optional[str] = None):
+        """メッセージをサーバーに送信します（WebSocket経由）。room を省略した場合は参加しているルームに送ります。"""
+        # 応答のきっかけとなったメッセージのトレースID（parent_trace_id）を伝え、トレースを関連付ける
+        message_data = MessageIn(
+            room=room or self.room_name, sender=self.name, message=message_content, type=message_type,
+            parent_trace_id=parent_trace_id or None,
+        ).model_dump(exclude_none=True)
         if self.websocket_client:
             await self.websocket_client.send_message(message_data)
         else:
-            print("Error: WebSocket client not set for Agent.")
+            logger.error("WebSocket client not set for Agent.")
 
-    async def _generate_response(self) -> str:
+    async def _generate_response(self, priority: int = PRIORITY_AGENT, context: Optional[RoomContext] = None) -> str:
         """
-        LLMを使用して応答を生成します。レートリミットなどのエラーに対応するためリトライロジックを含みます。
+        ルームの会話履歴からLLMを使用して応答を生成します。
+        レート制限やリトライは共有のLLMスケジューラが処理します。priority には
+        人間への応答（PRIORITY_HUMAN）かエージェント同士の会話（PRIORITY_AGENT）かを指定します。
         """
-        print(f"Agent '{self.name}' generating response...")
+        context = self._context(context)
+        log_sampled(logger, logging.DEBUG, "Agent '%s' generating response in room '%s'...", self.name, context.room)
         # 会話履歴をLLMに渡す前に制限を適用
-        history_to_send = self.chat_history[-self.chat_history_limit:]
+        history_to_send = context.chat_history[-self.chat_history_limit:]
 
         # llmライブラリが期待する辞書のリストを作成
         # personaがYAMLファイルでリスト（ネストされている可能性も含む）として定義されている場合に対処
@@ -61,6 +349,13 @@ class Agent:
             persona_content = "\n".join(map(str, self.persona))
         else:
             persona_content = str(self.persona)
+        if context.context_summary:
+            # 参加前の会話の要約はシステムプロンプトに含める
+            persona_content += "\n\n" + context.context_summary
+        # 直近のウィンドウに含まれない過去の関連メッセージもシステムプロンプトに含める
+        memories = await self._recall(history_to_send, context)
+        if memories:
+            persona_content += "\n\n" + memories
         
         # messagesリストには会話履歴のみを含める
         messages = []
@@ -84,42 +379,99 @@ class Agent:
             conversation_str += f"{role}: {content}\n\n"
 
         # llmライブラリを使用してモデルからの応答を得る
-        model = llm.get_model(self.model)
-        
-        max_retries = 3
-        backoff_factor = 2  # seconds
+        prompt = conversation_str.strip()
+        tools = self._tool_definitions()
+        # 主モデルと、ヘッジが設定されていれば予備のモデル（モデルID, モデル, オプション）
+        candidates = [(self.model, self._get_model(self.model), self.options)]
+        if self.hedge is not None:
+            candidates += [(entry["model"], self._get_model(entry["model"]), entry.get("options", {}))
+                           for entry in self.hedge.models]
+        # ツールを使う場合は、ツールの結果を渡して続きを生成できるように会話オブジェクトを使う
+        conversations = [model.conversation(tools=tools) if tools else None for _, model, _ in candidates]
 
-        for attempt in range(max_retries):
+        def call_model(index, tool_results=None, on_first_token=None, cancelled=None):
+            # model.prompt()とresponse.text()は同期的なブロッキング呼び出しのため、
+            # スケジューラが別スレッドで実行します（text()の時点で実際のAPI呼び出しが行われる）。
+            _, model, options = candidates[index]
+            conversation = conversations[index]
+            if conversation is None:
+                response = model.prompt(prompt, system=persona_content, **options)
+            else:
+                response = conversation.prompt(
+                    None if tool_results else prompt, system=persona_content, tool_results=tool_results, **options
+                )
+            if on_first_token is not None:
+                # ヘッジ中はストリームを読み進めて最初のトークンを通知し、負けたら読むのをやめる
+                for i, _ in enumerate(response):
+                    if cancelled.is_set():
+                        raise HedgeCancelled()
+                    if i == 0:
+                        on_first_token()
+            tool_calls = response.tool_calls() if conversation is not None else []
+            return response.text(), _response_token_count(response), tool_calls
+
+        async def submit(index=0, tool_results=None, on_first_token=None):
+            # レート制限・優先度・Retry-Afterを考慮する共有スケジューラ経由で呼び出す
+            cancelled = threading.Event()
             try:
-                # model.promptは同期的なブロッキング呼び出しのため、asyncio.to_threadを使用して
-                # イベントループをブロックしないように別スレッドで実行します。
-                response = await asyncio.to_thread(
-                    model.prompt, conversation_str.strip(), system=persona_content, **self.options
+                return await get_llm_scheduler().submit(
+                    candidates[index][0],
+                    lambda: call_model(index, tool_results, on_first_token, cancelled),
+                    priority=priority,
+                    estimated_tokens=estimate_tokens(prompt + persona_content),
+                    usage=lambda result: result[1],
+                )
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        try:
+            if self.hedge is None:
+                winner = 0
+                text_response, _, tool_calls = await submit()
+            else:
+                # 先に完了したモデルの応答を採用し、ツールの結果もそのモデルとの会話で続ける
+                attempts = [(model_id, lambda notify, index=index: submit(index, on_first_token=notify))
+                            for index, (model_id, _, _) in enumerate(candidates)]
+                winner, (text_response, _, tool_calls) = await run_hedged(attempts, self.hedge)
+            rounds = 0
+            while tool_calls and rounds < self.tool_max_rounds:
+                # 独立したツール呼び出しはサンドボックスで並列に実行し、完了した順にルームへ送る
+                results = await get_tool_sandbox().run_all(
+                    {tool.name: tool for tool in tools}, tool_calls,
+                    on_result=lambda call, result: self._post_tool_result(call, result, context),
                 )
-                
-                text_response = response.text()
-                
-                # 応答がリストであるかチェック
-                if isinstance(text_response, list):
-                    if not text_response:
-                        return ""
-                    final_text = text_response[0]
-                    while isinstance(final_text, list) and final_text:
-                        final_text = final_text[0]
-                    return str(final_text)
-                
-                return str(text_response)
-
-            except Exception as e:
-                print(f"Error generating LLM response (attempt {attempt + 1}/{max_retries}): {e}")
-                if attempt + 1 == max_retries:
-                    return f"Error: LLM failed to generate a response after {max_retries} attempts."
-                
-                sleep_time = backoff_factor * (2 ** attempt)
-                print(f"Retrying in {sleep_time} seconds...")
-                await asyncio.sleep(sleep_time)
-
-        return "Error: LLM failed to generate a response." # Fallback
+                text_response, _, tool_calls = await submit(winner, results)
+                rounds += 1
+        except RetriesExhaustedError as e:
+            return f"Error: LLM failed to generate a response after {e.attempts} attempts."
+        except CircuitOpenError as e:
+            logger.warning("Skipping LLM call: %s", e)
+            return "Error: LLM is temporarily unavailable."
+
+        # 応答がリストであるかチェック
+        if isinstance(text_response, list):
+            if not text_response:
+                return ""
+            final_text = text_response[0]
+            while isinstance(final_text, list) and final_text:
+                final_text = final_text[0]
+            return str(final_text)
+
+        return str(text_response)
+
+    def _tool_definitions(self) -> List[Any]:
+        """設定されたツールの定義を返します（初回のみプラグインから解決する）。"""
+        if self._tools is None:
+            self._tools = resolve_tools(self.tool_names) if self.tool_names else []
+        return self._tools
+
+    async def _post_tool_result(self, call: Any, result: Any, context: Optional[RoomContext] = None):
+        """ツールの実行結果を `tool` メッセージとしてルームに送信し、会話履歴にも追加します。"""
+        context = self._context(context)
+        content = f"[{call.name}] {result.output}"
+        await self._send_message(content, message_type="tool", room=context.room)
+        await self._add_to_history(self.name, content, "tool", context)
 
     async def handle_message_from_server(self, message: Dict[str, Any]):
         """
@@ -134,34 +486,106 @@ class Agent:
         # 自身のメッセージは処理しない、または特定のタイプのみ処理
         if sender == self.name:
             return
+        # 在室状況の通知（"presence" を購読した場合に届く）は会話ではないため、履歴にも応答にも使わない
+        if message_type == "presence":
+            return
 
-        if room != self.room_name:
-            return # 自身のルーム宛てではないメッセージは無視
+        context = self._join_room(room)
+        if context is None:
+            return # 参加しているルーム宛てではないメッセージは無視
+        if context.ready is not None:
+            # ブートストラップ中のルームのメッセージは、ブートストラップが終わってから処理する
+            await context.ready
 
-        print(f"Agent '{self.name}' received: <{sender}> {message_content}")
+        # サーバーからの制御フレーム（発言権の通知など）は会話履歴に含めない
+        if message_type == "control":
+            await self._handle_control(message, context)
+            return
+
+        # 大きな本文はプレビューと参照だけが配信されるため、LLMに渡す全文を取得する
+        if message.get("blob"):
+            message_content = await self._fetch_blob(message["blob"]) or message_content
+
+        log_sampled(logger, logging.DEBUG, "Agent '%s' received: <%s> %s", self.name, sender, message_content)
         
-        # 会話履歴に追加
-        self.chat_history.append({"sender": sender, "message": message_content, "type": message_type})
+        # 会話履歴に追加（ブートストラップで読み込み済みのメッセージは除く）
+        message_id = message.get("id")
+        if message_id is None or context.last_id is None or message_id > context.last_id:
+            await self._add_to_history(sender, message_content, message_type, context)
+
+        # 発言権制御が有効な場合は、サーバーから発言権を与えられるまで応答しない
+        if context.floor_controlled:
+            return
 
         # LLMに問い合わせて応答を生成
         # プログラマーAgentにメンションされたら応答、または他のエージェントが話したら応答
-        if "@" + self.name in message_content or message_type == "chat": # 仮の応答トリガー
+        # サーバーが解析済みのメンション（mentions）があればそれを優先して使う
+        mentioned = self.name in message.get("mentions", []) or "@" + self.name in (message_content or "")
+        if mentioned or message_type == "chat": # 仮の応答トリガー
+            await self._respond(message, context)
+
+    async def _handle_control(self, message: Dict[str, Any], context: Optional[RoomContext] = None):
+        """
+        サーバーからの制御フレームを処理します。
+        - floor: 発言権スケジューラが有効かどうかの通知
+        - speak: 発言権の付与（agents に自分が含まれていれば応答する）
+        """
+        context = self._context(context)
+        action = message.get("action")
+        if action == "floor":
+            context.floor_controlled = bool(message.get("policy"))
+            logger.info("Agent '%s' follows server turn policy in room '%s': %s",
+                        self.name, context.room, message.get("policy"))
+        elif action == "speak" and self.name in message.get("agents", []):
+            await self._respond(message.get("in_reply_to"), context)
+
+    async def _respond(self, trigger: Optional[Dict[str, Any]] = None, context: Optional[RoomContext] = None):
+        """
+        応答を生成してサーバーに送信し、自身の応答も会話履歴に追加します。
+        trigger には応答のきっかけとなったメッセージを渡し、各段階のタイミングをそのトレースに記録します。
+        同じルームの応答は1件ずつ順に生成し（前の応答を履歴に含めるため）、別のルームの応答は並行して生成します。
+        """
+        context = self._context(context)
+        room = context.room
+        tracer = get_tracer()
+        trace_id = (trigger or {}).get("trace_id")
+        async with context.reply_lock:
             # 応答遅延を適用
             if self.response_delay_ms > 0:
                 await asyncio.sleep(self.response_delay_ms / 1000)
+            tracer.record(trace_id, "delay_end", agent=self.name, room=room)
 
-            response_text = await self._generate_response()
-            await self._send_message(response_text)
+            # 人間のメッセージへの応答はエージェント同士の会話より優先する
+            priority = PRIORITY_AGENT if (trigger or {}).get("from_agent") else PRIORITY_HUMAN
+            tracer.record(trace_id, "llm_start", agent=self.name, room=room, model=self.model)
+            response_text = await self._generate_response(priority, context)
+            tracer.record(trace_id, "llm_end", agent=self.name, room=room, model=self.model)
+            await self._send_message(response_text, parent_trace_id=trace_id, room=room)
+            tracer.record(trace_id, "reply_sent", agent=self.name, room=room)
             # 自身の応答も履歴に追加
-            self.chat_history.append({"sender": self.name, "message": response_text, "type": "chat"})
+            await self._add_to_history(self.name, response_text, context=context)
 
     async def start_listening(self):
         """
         エージェントがメッセージの受信と処理を開始するメインループ。
-        基本的にWebSocketクライアントのリスナーが動いている間は待機する。
+        stop_listening() が呼ばれるか、WebSocketクライアントが完全に停止するまで待機する。
+        （一時的な切断はWebSocketクライアントが自動的に再接続するため、ここでは待ち続ける）
         """
-        print(f"Agent '{self.name}' is now listening for messages in room '{self.room_name}'.")
+        logger.info("Agent '%s' is now listening for messages in room(s) '%s'.", self.name,
+                    ",".join(self.room_names + self.room_patterns))
         self._is_listening.set() # リスニング状態をTrueに設定
-        while self._is_listening.is_set():
-            await asyncio.sleep(1) # 無限ループでブロックしないように短時間スリープ
-        print(f"Agent '{self.name}' stopped listening.")
+        self._stop_requested.clear()
+        waiters = [asyncio.create_task(self._stop_requested.wait())]
+        if self.websocket_client is not None and hasattr(self.websocket_client, "closed"):
+            waiters.append(asyncio.create_task(self.websocket_client.closed.wait()))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+            self._is_listening.clear()
+        logger.info("Agent '%s' stopped listening.", self.name)
+
+    def stop_listening(self):
+        """start_listening() の待機を終了させます。"""
+        self._stop_requested.set()
@@ -0,0 +1,217 @@
+# LLM呼び出しのヘッジ（複数モデルへの投機的なリクエスト）
+#
+# 1つのプロバイダの遅い応答がエージェントの発言全体を止めないように、エージェントの設定（hedge）で
+# 予備のモデルを指定できます。主モデルに問い合わせ、最初のトークンが過去の実績のp95（quantile）までに
+# 届かなければ次のモデルにも問い合わせ、先に完了した応答を採用して残りを中断します。
+# モデルごとの最初のトークンまでの時間と完了までの時間はプロセス全体で共有して集計し、
+# ヘッジの期限の計算と、勝率・短縮できた時間の記録に使います。
+import asyncio
+import collections
+import logging
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# deadline: 最初のトークンが期限までに届かなければ次のモデルを起動する
+# parallel: 全てのモデルを同時に起動する
+# fallback: 失敗した場合にのみ次のモデルを起動する
+HEDGE_POLICIES = ("deadline", "parallel", "fallback")
+
+class HedgeCancelled(Exception):
+    """ヘッジで負けた呼び出しを中断したことを示す例外（呼び出し側のスレッドで送出されます）。"""
+
+class ModelLatency:
+    """1つのモデルの直近の応答時間（秒）。"""
+
+    def __init__(self, max_samples: int = 200):
+        self.first_token: Deque[float] = collections.deque(maxlen=max_samples)
+        self.total: Deque[float] = collections.deque(maxlen=max_samples)
+
+    def quantile(self, q: float, min_samples: int = 10) -> Optional[float]:
+        """最初のトークンまでの時間の分位点を返します。サンプルが min_samples 未満ならNoneを返します。"""
+        if len(self.first_token) < min_samples:
+            return None
+        samples = sorted(self.first_token)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def expected_remaining(self, elapsed: float) -> float:
+        """
+        すでに elapsed 秒かかっている呼び出しが完了するまでの残り時間の期待値を返します
+        （elapsed より長くかかった過去の呼び出しの平均から計算し、該当がなければ0）。
+        """
+        slower = [total for total in self.total if total > elapsed]
+        if not slower:
+            return 0.0
+        return sum(slower) / len(slower) - elapsed
+
+class HedgeStats:
+    """モデルごとのヘッジの結果（呼び出し数・勝利数・短縮できた時間）と応答時間の集計。"""
+
+    def __init__(self):
+        self.latency: Dict[str, ModelLatency] = collections.defaultdict(ModelLatency)
+        self.launches: Dict[str, int] = collections.Counter() # 起動した回数
+        self.hedges: Dict[str, int] = collections.Counter() # そのうち期限切れで追加起動した回数
+        self.wins: Dict[str, int] = collections.Counter() # 採用された回数
+        self.failures: Dict[str, int] = collections.Counter()
+        self.saved: Dict[str, float] = collections.defaultdict(float) # 勝利によって短縮できた時間の推定（秒）
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """モデルごとの集計を返します。"""
+        result = {}
+        for model_id in sorted(self.launches):
+            launches = self.launches[model_id]
+            p95 = self.latency[model_id].quantile(0.95, min_samples=1)
+            result[model_id] = {
+                "launches": launches,
+                "hedges": self.hedges[model_id],
+                "wins": self.wins[model_id],
+                "failures": self.failures[model_id],
+                "win_rate": round(self.wins[model_id] / launches, 3) if launches else 0.0,
+                "saved_ms": round(self.saved[model_id] * 1000),
+                "first_token_p95_ms": round(p95 * 1000) if p95 is not None else None,
+            }
+        return result
+
+    def log_summary(self):
+        for model_id, entry in self.summary().items():
+            logger.info("Hedging '%s': %d wins / %d launches (%d hedged, %d failed), saved ~%d ms, first token p95 %s ms",
+                        model_id, entry["wins"], entry["launches"], entry["hedges"], entry["failures"],
+                        entry["saved_ms"], entry["first_token_p95_ms"])
+
+_stats: Optional[HedgeStats] = None
+
+def get_hedge_stats() -> HedgeStats:
+    """プロセス全体で共有するヘッジの集計を返します。"""
+    global _stats
+    if _stats is None:
+        _stats = HedgeStats()
+    return _stats
+
+class HedgePolicy:
+    """
+    エージェントの hedge 設定。
+
+    models は予備のモデルIDのリスト（または {"model": ..., "options": {...}} の辞書）で、主モデルの後に順に使います。
+    deadline の場合、直前に起動したモデルの最初のトークンまでの時間の quantile 分位点
+    （min_delay〜max_delay 秒に制限。サンプルが min_samples 未満なら default_delay）を期限とします。
+    """
+
+    def __init__(self, models: List[Any], policy: str = "deadline", quantile: float = 0.95,
+                 min_delay: float = 0.5, max_delay: float = 10.0, default_delay: float = 2.0, min_samples: int = 10):
+        if policy not in HEDGE_POLICIES:
+            raise ValueError(f"Unknown hedge policy '{policy}' (expected one of {', '.join(HEDGE_POLICIES)})")
+        self.models = [m if isinstance(m, dict) else {"model": m} for m in models]
+        self.policy = policy
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> Optional["HedgePolicy"]:
+        """エージェント設定の hedge から作成します。予備のモデルがなければNoneを返します。"""
+        if not config or not config.get("models"):
+            return None
+        return cls(
+            config["models"],
+            policy=config.get("policy", "deadline"),
+            quantile=config.get("quantile", 0.95),
+            min_delay=config.get("min_delay_ms", 500) / 1000,
+            max_delay=config.get("max_delay_ms", 10000) / 1000,
+            default_delay=config.get("default_delay_ms", 2000) / 1000,
+            min_samples=config.get("min_samples", 10),
+        )
+
+    def delay_for(self, model_id: str, stats: HedgeStats) -> float:
+        """model_id を起動してから次のモデルを起動するまでの期限（秒）を返します。"""
+        observed = stats.latency[model_id].quantile(self.quantile, self.min_samples)
+        if observed is None:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, observed))
+
+# 1つの試行: モデルIDと、最初のトークンの通知（スレッドから呼び出せる）を受け取って呼び出しを行うコルーチン関数
+Attempt = Tuple[str, Callable[[Callable[[], None]], Awaitable[T]]]
+
+async def run_hedged(attempts: List[Attempt], policy: HedgePolicy,
+                     stats: Optional[HedgeStats] = None) -> Tuple[int, T]:
+    """
+    attempts（先頭が主モデル）をポリシーに従って起動し、最初に成功した試行の (番号, 結果) を返します。
+    残りの試行はキャンセルします。全て失敗した場合は最後の例外を送出します。
+    """
+    loop = asyncio.get_running_loop()
+    stats = stats or get_hedge_stats()
+    tasks: Dict[asyncio.Task, int] = {}
+    started: Dict[int, float] = {}
+    first_token_at: Dict[int, float] = {}
+    first_token = asyncio.Event()
+
+    def mark_first_token(index: int):
+        if index not in first_token_at:
+            first_token_at[index] = loop.time() - started[index]
+            first_token.set()
+
+    def launch(index: int, hedged: bool):
+        model_id, start = attempts[index]
+        started[index] = loop.time()
+        stats.launches[model_id] += 1
+        if hedged:
+            stats.hedges[model_id] += 1
+            logger.info("No first token from '%s' in time, hedging with '%s'", attempts[index - 1][0], model_id)
+        notify = lambda: loop.call_soon_threadsafe(mark_first_token, index)
+        tasks[asyncio.ensure_future(start(notify))] = index
+
+    launch(0, False)
+    next_index = 1
+    if policy.policy == "parallel":
+        while next_index < len(attempts):
+            launch(next_index, False)
+            next_index += 1
+
+    token_waiter = asyncio.ensure_future(first_token.wait())
+    last_error: Optional[BaseException] = None
+    try:
+        while tasks:
+            timeout = None
+            if policy.policy == "deadline" and next_index < len(attempts) and not first_token.is_set():
+                latest = next_index - 1
+                deadline = started[latest] + policy.delay_for(attempts[latest][0], stats)
+                timeout = max(0.0, deadline - loop.time())
+            waiters = set(tasks) | ({token_waiter} if timeout is not None else set())
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch(next_index, True)
+                next_index += 1
+                continue
+            # 同時に完了した場合は成功した試行を優先する
+            for task in sorted((t for t in done if t in tasks), key=lambda t: t.exception() is not None):
+                index = tasks.pop(task)
+                model_id = attempts[index][0]
+                error = task.exception()
+                if error is not None:
+                    last_error = error
+                    stats.failures[model_id] += 1
+                    if next_index < len(attempts):
+                        launch(next_index, False)
+                        next_index += 1
+                    continue
+                elapsed = loop.time() - started[index]
+                first_token_at.setdefault(index, elapsed)
+                # 完了までの時間は完了した試行だけ記録する
+                stats.latency[model_id].total.append(elapsed)
+                stats.wins[model_id] += 1
+                if index != 0 and 0 in tasks.values():
+                    # 主モデルがまだ応答していなければ、その残り時間の期待値だけ短縮できたとみなす
+                    primary = attempts[0][0]
+                    stats.saved[model_id] += stats.latency[primary].expected_remaining(loop.time() - started[0])
+                return index, task.result()
+        raise last_error
+    finally:
+        token_waiter.cancel()
+        for task in tasks:
+            task.cancel()
+        # 最初のトークンまでの時間は負けた試行も含めて記録する（勝った試行だけでは遅いモデルのp95が下がり続ける）
+        for index, seconds in first_token_at.items():
+            stats.latency[attempts[index][0]].first_token.append(seconds)
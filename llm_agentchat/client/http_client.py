@@ -0,0 +1,32 @@
+# サーバーのHTTP APIを呼び出すための共有クライアント
+#
+# 同じプロセス内のエージェントでコネクションプールを共有し、
+# リクエストごとに接続を張り直さないようにします。
+from typing import Optional
+
+import httpx
+
+# プール全体の接続数の上限と、アイドル接続を保持する数
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+# 1リクエストあたりのタイムアウト（秒）
+REQUEST_TIMEOUT = 10.0
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """共有のHTTPクライアントを返します。未作成または閉じられている場合は作成します。"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+        )
+    return _client
+
+async def close_http_client():
+    """共有のHTTPクライアントを閉じます。"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,294 @@
+# LLM呼び出しのスケジューラ
+#
+# 同じプロセス内の全エージェントが共有し、モデル（プロバイダ）ごとに
+# リクエスト数・トークン数のレート制限（トークンバケット）、優先度付きの待ち行列、
+# Retry-After を尊重するリトライ、サーキットブレーカーを提供します。
+import asyncio
+import email.utils
+import heapq
+import itertools
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 優先度（値が小さいほど先に実行される）
+PRIORITY_HUMAN = 0 # 人間のメッセージへの応答
+PRIORITY_AGENT = 1 # エージェント同士の会話
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため、LLM呼び出しを行わなかったことを示す例外。"""
+
+class RetriesExhaustedError(Exception):
+    """リトライ回数の上限に達したことを示す例外。最後に発生した例外を `last_error` に保持します。"""
+    def __init__(self, attempts: int, last_error: Exception):
+        super().__init__(f"LLM call failed after {attempts} attempts: {last_error}")
+        self.attempts = attempts
+        self.last_error = last_error
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    例外からRetry-Afterのヒント（秒）を取り出します。
+    `retry_after` 属性、または `response.headers` / `headers` の Retry-After ヘッダー
+    （秒数またはHTTP日付）に対応します。見つからない場合はNoneを返します。
+    """
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        headers = getattr(error, "headers", None)
+        response = getattr(error, "response", None)
+        if headers is None and response is not None:
+            headers = getattr(response, "headers", None)
+        if headers is not None:
+            try:
+                value = headers.get("retry-after") or headers.get("Retry-After")
+            except AttributeError:
+                value = None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(str(value))
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(text: str) -> int:
+    """プロンプトのトークン数を大まかに見積もります（約4文字で1トークン）。"""
+    return max(1, len(text) // 4)
+
+class TokenBucket:
+    """1分あたりの量で補充されるトークンバケット。rate_per_minuteがNoneなら無制限。"""
+    def __init__(self, rate_per_minute: Optional[float], capacity: Optional[float] = None):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity or 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate_per_minute:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_minute / 60.0)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        """amount分のトークンが使えるようになるまでの秒数を返します。"""
+        if not self.rate_per_minute:
+            return 0.0
+        self._refill()
+        # バケットの容量を超える要求は、満杯になった時点で許可する
+        amount = min(amount, self.capacity)
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) * 60.0 / self.rate_per_minute
+
+    def consume(self, amount: float):
+        """トークンを消費します（実際の使用量による補正で負になることもあります）。"""
+        if self.rate_per_minute:
+            self._refill()
+            self._tokens -= amount
+
+class CircuitBreaker:
+    """
+    連続した失敗がしきい値に達すると一定時間呼び出しを遮断し、
+    その後1件だけ試行（half-open）して成功すれば元に戻すサーキットブレーカー。
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """呼び出しを許可するかどうかを返します。"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        """試行を成功・失敗のどちらとも数えずに終えます（呼び出しがキャンセルされた場合）。"""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.state == "half_open":
+                logger.warning("Circuit breaker opened after %d consecutive failures", self.failures)
+            self.opened_at = time.monotonic()
+
+class _ModelLane:
+    """1つのモデル（またはプロバイダ）に対するレート制限と待ち行列。"""
+    def __init__(self, key: str, rpm: Optional[float], tpm: Optional[float],
+                 failure_threshold: int, reset_timeout: float):
+        self.key = key
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.paused_until = 0.0 # Retry-After により全呼び出しを止める時刻（monotonic）
+        self._waiters: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def pause(self, seconds: float):
+        """プロバイダから待機を指示された場合、このレーンの全ての呼び出しを一時停止します。"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority: int, tokens: float):
+        """優先度順にレート制限の枠が空くまで待ちます。"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """待ち行列の先頭（最も優先度の高い呼び出し）から順に実行を許可します。"""
+        while self._waiters:
+            priority, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = max(
+                self.paused_until - time.monotonic(),
+                self.requests.time_until(1),
+                self.tokens.time_until(tokens),
+            )
+            if wait > 0:
+                # より優先度の高い呼び出しが来たら待機を中断して再評価する
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._waiters)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            future.set_result(None)
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, _, future in self._waiters if not future.done())
+
+class LLMScheduler:
+    """
+    プロセス内で共有されるLLM呼び出しのスケジューラ。
+
+    rate_limits はモデルIDをキーにした `{"rpm": ..., "tpm": ...}` の辞書です。
+    キー "default" はその他のモデルに適用されます。同じレート制限を共有するモデルは
+    `{"key": "provider-name"}` で同じレーンにまとめられます。
+    """
+    def __init__(self, rate_limits: Optional[Dict[str, Dict[str, Any]]] = None,
+                 max_retries: int = 3, base_backoff: float = 2.0, max_backoff: float = 60.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.rate_limits = rate_limits or {}
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lanes: Dict[str, _ModelLane] = {}
+
+    def lane_for(self, model_id: str) -> _ModelLane:
+        """モデルIDに対応するレーンを返します（必要なら作成します）。"""
+        limits = self.rate_limits.get(model_id) or self.rate_limits.get("default") or {}
+        key = limits.get("key", model_id)
+        if key not in self._lanes:
+            self._lanes[key] = _ModelLane(
+                key, limits.get("rpm"), limits.get("tpm"), self.failure_threshold, self.reset_timeout
+            )
+        return self._lanes[key]
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """ジッター付きの指数バックオフ。複数のエージェントが同時にリトライしないようにする。"""
+        cap = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return random.uniform(cap / 2, cap)
+
+    async def submit(self, model_id: str, call: Callable[[], T], priority: int = PRIORITY_AGENT,
+                     estimated_tokens: int = 0, usage: Optional[Callable[[T], Optional[int]]] = None) -> T:
+        """
+        同期的なLLM呼び出し `call` をレート制限に従って別スレッドで実行し、結果を返します。
+        usage を渡すと、結果から実際のトークン使用量を取得してバケットを補正します。
+        失敗した場合は Retry-After またはバックオフに従ってリトライし、
+        上限に達したら RetriesExhaustedError を送出します。
+        """
+        lane = self.lane_for(model_id)
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_retries):
+            if not lane.breaker.allow():
+                raise CircuitOpenError(f"Circuit breaker for '{lane.key}' is open")
+            try:
+                await lane.acquire(priority, estimated_tokens)
+                result = await asyncio.to_thread(call)
+            except asyncio.CancelledError:
+                # ヘッジで不要になった呼び出しなどのキャンセルは失敗として数えない
+                # （レート制限の待ち中のキャンセルでも、half-open の試行を終えて次の呼び出しを許可する）
+                lane.breaker.release()
+                raise
+            except Exception as e:
+                last_error = e
+                lane.breaker.record_failure()
+                retry_after = retry_after_seconds(e)
+                if retry_after is not None:
+                    # プロバイダの指示に従い、同じレーンの全呼び出しを待たせる
+                    lane.pause(retry_after)
+                    delay = retry_after
+                else:
+                    delay = self._backoff_delay(attempt)
+                logger.warning("LLM call to '%s' failed (attempt %d/%d): %s", model_id, attempt + 1, self.max_retries, e)
+                if attempt + 1 < self.max_retries:
+                    logger.info("Retrying in %.1f seconds...", delay)
+                    await asyncio.sleep(delay)
+                continue
+            lane.breaker.record_success()
+            if usage is not None:
+                try:
+                    actual = usage(result)
+                except Exception:
+                    actual = None
+                if actual is not None:
+                    lane.tokens.consume(actual - estimated_tokens)
+            return result
+        raise RetriesExhaustedError(self.max_retries, last_error)
+
+_scheduler: Optional[LLMScheduler] = None
+
+def configure_llm_scheduler(rate_limits: Optional[Dict[str, Dict[str, Any]]] = None, **kwargs: Any) -> LLMScheduler:
+    """プロセス全体で共有するスケジューラを設定します。"""
+    global _scheduler
+    _scheduler = LLMScheduler(rate_limits, **kwargs)
+    return _scheduler
+
+def get_llm_scheduler() -> LLMScheduler:
+    """共有スケジューラを返します。未設定ならレート制限なしのスケジューラを作成します。"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler()
+    return _scheduler
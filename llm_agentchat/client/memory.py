@@ -0,0 +1,189 @@
+# エージェントの長期記憶（関連度順の過去メッセージの検索）
+#
+# LLMに渡すのは直近の chat_history_limit 件だけなので、それより前の決定事項は忘れられてしまいます。
+# このモジュールはルームの全履歴をローカルのSQLite FTS5に索引付けし、応答の生成ごとに
+# 直近のウィンドウより古いメッセージから関連度（BM25）の高いものを top-k 件だけ取り出します。
+# llmの埋め込みモデル（memory_embedding_model）を設定した場合は、ベクトルの類似度の順位と
+# BM25の順位を Reciprocal Rank Fusion で統合します。
+import logging
+import math
+import re
+import sqlite3
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 記憶しないメッセージの種類
+SKIPPED_TYPES = ("system", "control", "presence")
+MAX_QUERY_TERMS = 64 # FTSクエリに含める語の上限
+MAX_SNIPPET_CHARS = 300 # プロンプトに含める1件あたりの最大文字数
+RRF_K = 60 # Reciprocal Rank Fusion の定数
+
+_WORD = re.compile(r"\w+")
+
+def _fts5_tokenizer(conn: sqlite3.Connection) -> str:
+    """日本語も部分一致で検索できる trigram トークナイザが使えればそれを、なければ unicode61 を返します。"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.tokenizer_probe USING fts5(x, tokenize='trigram')")
+        conn.execute("DROP TABLE temp.tokenizer_probe")
+        return "trigram"
+    except sqlite3.OperationalError:
+        return "unicode61"
+
+def build_fts_query(text: str, tokenizer: str = "trigram", max_terms: int = MAX_QUERY_TERMS) -> Optional[str]:
+    """
+    テキストからFTS5のORクエリを作ります。
+    trigram の場合、空白で区切られない語（日本語など）は3文字ずつの断片に分けて部分一致させます。
+    """
+    terms: List[str] = []
+    for word in _WORD.findall(text.lower()):
+        if tokenizer != "trigram":
+            candidates = [word] if len(word) > 1 else []
+        elif len(word) < 3:
+            continue
+        elif word.isascii():
+            candidates = [word]
+        else:
+            candidates = [word[i:i + 3] for i in range(len(word) - 2)]
+        for term in candidates:
+            if term not in terms:
+                terms.append(term)
+    if not terms:
+        return None
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms[:max_terms])
+
+def is_memorable(message: Optional[str], message_type: str = "chat") -> bool:
+    """記憶（索引付け）の対象となるメッセージかどうかを返します。"""
+    return bool(message) and message_type not in SKIPPED_TYPES
+
+def _pack(vector: Sequence[float]) -> bytes:
+    return struct.pack(f"<{len(vector)}f", *vector)
+
+def _unpack(blob: bytes) -> Tuple[float, ...]:
+    return struct.unpack(f"<{len(blob) // 4}f", blob)
+
+def _cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+class AgentMemory:
+    """
+    1つのエージェントが見たルームのメッセージを索引付けする記憶。
+    メッセージには追加順の通し番号（seq）を割り当て、検索は指定した seq 以前のメッセージに限定できます。
+    """
+
+    def __init__(self, path: str = ":memory:", embedding_model: Optional[Any] = None):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.tokenizer = _fts5_tokenizer(self._conn)
+        self.embedding_model = embedding_model
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "seq INTEGER PRIMARY KEY, sender TEXT NOT NULL, message TEXT NOT NULL, embedding BLOB)"
+        )
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5("
+            f"sender, message, content='memory', content_rowid='seq', tokenize='{self.tokenizer}')"
+        )
+        self.count = self._conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+
+    def add(self, sender: str, message: str, message_type: str = "chat") -> Optional[int]:
+        """メッセージを索引に追加し、割り当てた seq を返します。記憶しない種類のメッセージはNoneを返します。"""
+        if not is_memorable(message, message_type):
+            return None
+        return self.add_many([(sender, message)])
+
+    def add_many(self, messages: Sequence[Tuple[str, str]]) -> int:
+        """
+        (sender, message) のリストを古い順にまとめて索引に追加し、最後の seq を返します。
+        埋め込みモデルがあれば1回のバッチで埋め込みます（ネットワーク越しの場合があるため、
+        非同期コードからはスレッドで呼び出してください）。
+        """
+        embeddings: List[Optional[bytes]] = [None] * len(messages)
+        if self.embedding_model is not None and messages:
+            try:
+                vectors = self.embedding_model.embed_batch([message for _, message in messages])
+                embeddings = [_pack(vector) for vector in vectors]
+            except Exception as e:
+                logger.warning("Could not embed messages for memory: %s", e)
+        with self._lock:
+            rows = []
+            for (sender, message), embedding in zip(messages, embeddings):
+                self.count += 1
+                rows.append((self.count, sender or "", message, embedding))
+            self._conn.executemany("INSERT INTO memory (seq, sender, message, embedding) VALUES (?, ?, ?, ?)", rows)
+            self._conn.executemany("INSERT INTO memory_fts (rowid, sender, message) VALUES (?, ?, ?)",
+                                   [row[:3] for row in rows])
+            self._conn.commit()
+            return self.count
+
+    def search(self, query: str, k: int = 5, before_seq: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        query に関連するメッセージを関連度の高い順に最大 k 件返します。
+        before_seq を指定すると、その seq 以下（直近のウィンドウより古いもの）に限定します。
+        """
+        limit_seq = self.count if before_seq is None else before_seq
+        if k <= 0 or limit_seq <= 0:
+            return []
+        rankings = [self._search_fts(query, k * 4, limit_seq)]
+        if self.embedding_model is not None:
+            rankings.append(self._search_embeddings(query, k * 4, limit_seq))
+        scores: Dict[int, float] = {}
+        for ranking in rankings:
+            for rank, seq in enumerate(ranking):
+                scores[seq] = scores.get(seq, 0.0) + 1.0 / (RRF_K + rank + 1)
+        best = sorted(scores, key=lambda seq: (-scores[seq], -seq))[:k]
+        if not best:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT seq, sender, message FROM memory WHERE seq IN ({', '.join('?' for _ in best)})", best
+            ).fetchall()
+        by_seq = {seq: {"seq": seq, "sender": sender, "message": message} for seq, sender, message in rows}
+        return [by_seq[seq] for seq in best if seq in by_seq]
+
+    def _search_fts(self, query: str, limit: int, limit_seq: int) -> List[int]:
+        match = build_fts_query(query, self.tokenizer)
+        if match is None:
+            return []
+        with self._lock:
+            try:
+                rows = self._conn.execute(
+                    "SELECT rowid FROM memory_fts WHERE memory_fts MATCH ? AND rowid <= ? "
+                    "ORDER BY bm25(memory_fts) LIMIT ?",
+                    (match, limit_seq, limit),
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                logger.debug("Memory search failed for %r: %s", match, e)
+                return []
+        return [row[0] for row in rows]
+
+    def _search_embeddings(self, query: str, limit: int, limit_seq: int) -> List[int]:
+        try:
+            query_vector = self.embedding_model.embed(query)
+        except Exception as e:
+            logger.warning("Could not embed the memory query: %s", e)
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, embedding FROM memory WHERE seq <= ? AND embedding IS NOT NULL", (limit_seq,)
+            ).fetchall()
+        scored = sorted(((_cosine(query_vector, _unpack(blob)), seq) for seq, blob in rows), reverse=True)
+        return [seq for _, seq in scored[:limit]]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def format_memories(memories: List[Dict[str, Any]]) -> str:
+    """検索したメッセージをシステムプロンプトに含める文字列にします（古い順）。"""
+    lines = ["Relevant earlier messages in this room:"]
+    for memory in sorted(memories, key=lambda m: m["seq"]):
+        text = " ".join(memory["message"].split())
+        if len(text) > MAX_SNIPPET_CHARS:
+            text = text[:MAX_SNIPPET_CHARS] + "..."
+        lines.append(f"- {memory['sender']}: {text}")
+    return "\n".join(lines)
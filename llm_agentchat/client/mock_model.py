@@ -0,0 +1,128 @@
+# ベンチマーク用のモックLLMモデル
+#
+# 実際のAPIを呼び出さずにエージェントの処理を計測するためのllmモデル（モデルID: agentchat-mock）です。
+# 応答までの待ち時間を分布（constant / uniform / exponential / lognormal）から、
+# 生成時間を出力トークン数とトークンレートから決めて待機し、ダミーのテキストを返します。
+# 乱数はシード、システムプロンプト（エージェント）、そのエージェントの呼び出し回数から決まるため、
+# 実行のたびに各エージェントは同じ系列の待ち時間・応答を返します。
+#
+#   agents.yml:
+#     model: "agentchat-mock"
+#     options: {latency: 1.5, latency_dist: lognormal, tokens_per_second: 40, output_tokens: 80}
+import math
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import llm
+from pydantic import Field
+
+MOCK_MODEL_ID = "agentchat-mock"
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+# ダミーの応答に使う単語
+_WORDS = (
+    "agent", "room", "message", "reply", "review", "code", "test", "plan", "idea", "result",
+    "token", "model", "latency", "queue", "server", "client", "batch", "cache", "index", "log",
+)
+
+class RealClock:
+    """実時間の時計。"""
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+_seed = 0
+_clock: Any = RealClock()
+_observer: Optional[Callable[[float, float, int, float], None]] = None
+_call_counts: Dict[str, int] = {} # システムプロンプトごとの呼び出し回数
+_lock = threading.Lock()
+
+def configure_mock_model(seed: int = 0, clock: Any = None,
+                         observer: Optional[Callable[[float, float, int, float], None]] = None):
+    """
+    モックモデルの乱数シード、待機に使う時計（`now()` と `sleep()` を持つオブジェクト）、
+    呼び出しごとに (開始時刻, 終了時刻, 出力トークン数, CPU時間) で呼び出すオブザーバーを設定します。
+    """
+    global _seed, _clock, _observer
+    with _lock:
+        _seed = seed
+        _clock = clock or RealClock()
+        _observer = observer
+        _call_counts.clear()
+
+def sample_latency(rng: random.Random, mean: float, distribution: str = "constant", spread: float = 0.5) -> float:
+    """
+    平均 mean 秒の待ち時間を分布からサンプリングします。
+    spread は uniform では平均に対する幅の割合、lognormal では対数の標準偏差です。
+    """
+    if mean <= 0:
+        return 0.0
+    if distribution == "constant":
+        return mean
+    if distribution == "uniform":
+        return rng.uniform(mean * max(0.0, 1 - spread), mean * (1 + spread))
+    if distribution == "exponential":
+        return rng.expovariate(1 / mean)
+    if distribution == "lognormal":
+        # 平均が mean になるように対数の平均を補正する
+        return rng.lognormvariate(math.log(mean) - spread ** 2 / 2, spread)
+    raise ValueError(f"Unknown latency distribution '{distribution}'. Choose from: {', '.join(LATENCY_DISTRIBUTIONS)}")
+
+class MockModel(llm.Model):
+    """待ち時間とトークンレートを設定できるモックモデル。"""
+    model_id = MOCK_MODEL_ID
+    can_stream = True
+
+    class Options(llm.Options):
+        latency: Optional[float] = Field(default=0.5, description="最初のトークンまでの平均待ち時間（秒）")
+        latency_dist: Optional[str] = Field(default="constant", description="待ち時間の分布")
+        latency_spread: Optional[float] = Field(default=0.5, description="待ち時間のばらつき")
+        tokens_per_second: Optional[float] = Field(default=50.0, description="出力トークンの生成速度")
+        output_tokens: Optional[int] = Field(default=40, description="応答のトークン数")
+
+    def execute(self, prompt, stream, response, conversation):
+        system = prompt.system or ""
+        with _lock:
+            seed, clock, observer = _seed, _clock, _observer
+            call_index = _call_counts.get(system, 0)
+            _call_counts[system] = call_index + 1
+        options = prompt.options
+        started = clock.now()
+        cpu_start = time.thread_time()
+        rng = random.Random(f"{seed}:{system}:{call_index}")
+        output_tokens = max(0, options.output_tokens or 0)
+        delay = sample_latency(rng, options.latency or 0.0, options.latency_dist or "constant",
+                               options.latency_spread or 0.0)
+        if options.tokens_per_second:
+            delay += output_tokens / options.tokens_per_second
+        words = [rng.choice(_WORDS) for _ in range(output_tokens)]
+        cpu = time.thread_time() - cpu_start
+        clock.sleep(delay)
+        response.set_usage(input=len(system + (prompt.prompt or "")) // 4, output=output_tokens)
+        if observer is not None:
+            observer(started, clock.now(), output_tokens, cpu)
+        yield " ".join(words) or "ok"
+
+def ensure_mock_model_registered():
+    """
+    llmのプラグインとしてインストールされていない場合（開発環境など）でも
+    llm.get_model(MOCK_MODEL_ID) で取得できるように、モックモデルを登録します。
+    """
+    try:
+        llm.get_model(MOCK_MODEL_ID)
+        return
+    except llm.UnknownModelError:
+        pass
+    from llm.plugins import pm
+
+    class _MockModelPlugin:
+        @llm.hookimpl
+        def register_models(self, register):
+            register(MockModel())
+
+    pm.register(_MockModelPlugin(), name="llm_agentchat_mock_model")
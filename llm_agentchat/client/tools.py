@@ -0,0 +1,172 @@
+# エージェントのツール実行サンドボックス
+#
+# agents.yml の `tools` に指定したllmのツールをモデルに渡し、モデルからのツール呼び出しを
+# 呼び出しごとに別プロセスで実行します。同時実行数に上限を設け、各呼び出しにタイムアウト・メモリ上限・
+# 出力サイズの上限を適用するため、遅い（または暴走した）ツールがエージェントのイベントループを止めません。
+import asyncio
+import json
+import logging
+import multiprocessing
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+import llm
+
+try:
+    import resource # 任意（POSIXのみ）。メモリ上限の適用に使用
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4 # 同時に実行するツールプロセス数の上限
+DEFAULT_TIMEOUT = 30.0 # 1回の呼び出しのタイムアウト（秒）
+DEFAULT_MEMORY_LIMIT_MB = 512 # ツールプロセスのアドレス空間の上限（MB）
+DEFAULT_MAX_OUTPUT_CHARS = 16000 # ツールの出力の最大文字数
+
+def resolve_tools(names: Iterable[str]) -> List[llm.Tool]:
+    """
+    プラグインが登録したツールから、名前で指定されたものを返します。
+    Toolbox の名前を指定した場合は、そのToolboxの全てのツールを返します。
+    """
+    wanted = list(names)
+    registered = llm.get_tools()
+    tools: List[llm.Tool] = []
+    for name in wanted:
+        tool = registered.get(name)
+        if tool is None:
+            logger.warning("Tool '%s' is not registered by any llm plugin. Ignoring it.", name)
+            continue
+        if isinstance(tool, llm.Tool):
+            tools.append(tool)
+            continue
+        try:
+            tools.extend(tool().tools())
+        except Exception as e:
+            logger.warning("Could not initialize toolbox '%s': %s", name, e)
+    return tools
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit] + f"\n... [truncated {len(text) - limit} characters]"
+
+def _execute_tool(conn, implementation: Callable[..., Any], arguments: Dict[str, Any],
+                  memory_limit_bytes: Optional[int], max_output_chars: int):
+    """ツールプロセスのエントリポイント。結果を ("ok" | "error", 出力) としてパイプに送ります。"""
+    try:
+        if memory_limit_bytes and resource is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+        result = implementation(**arguments)
+        if not isinstance(result, str):
+            try:
+                result = json.dumps(result, ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                result = str(result)
+        conn.send(("ok", _truncate(result, max_output_chars)))
+    except MemoryError:
+        conn.send(("error", "Error: tool exceeded its memory limit"))
+    except BaseException as e:
+        conn.send(("error", _truncate(f"Error: {type(e).__name__}: {e}", max_output_chars)))
+    finally:
+        conn.close()
+
+def _process_context():
+    """ツールプロセスの起動方式。forkserverが使えればそれを（イベントループのスレッドを複製しない）。"""
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # 重いモジュールはforkserverで一度だけ読み込み、呼び出しごとのプロセス起動を速くする
+    context.set_forkserver_preload(["llm", __name__])
+    return context
+
+class ToolSandbox:
+    """
+    ツール呼び出しを別プロセスで実行します。同時に実行するプロセス数はセマフォで max_workers までに制限します。
+
+    ワーカープロセスを使い回すプールではなく、呼び出しごとにプロセスを起動します
+    （起動コストは forkserver のプリロードで抑える）。そのため、タイムアウトしたツールは確実に終了させられ、
+    クラッシュやメモリ上限の超過が後続の呼び出しやエージェント本体に影響しません。
+    """
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, timeout: float = DEFAULT_TIMEOUT,
+                 memory_limit_mb: Optional[int] = DEFAULT_MEMORY_LIMIT_MB,
+                 max_output_chars: int = DEFAULT_MAX_OUTPUT_CHARS):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.max_output_chars = max_output_chars
+        self._slots = asyncio.Semaphore(max_workers)
+        self._context = _process_context()
+
+    async def run(self, tool: Optional[llm.Tool], call: llm.ToolCall) -> llm.ToolResult:
+        """ツール呼び出しを1件実行し、結果を返します（失敗やタイムアウトも結果として返す）。"""
+        if tool is None or tool.implementation is None:
+            return llm.ToolResult(name=call.name, output=f"Error: tool '{call.name}' does not exist",
+                                  tool_call_id=call.tool_call_id)
+        async with self._slots:
+            output = await asyncio.to_thread(self._run_in_process, tool.implementation, call.arguments or {})
+        return llm.ToolResult(name=call.name, output=output, tool_call_id=call.tool_call_id)
+
+    def _run_in_process(self, implementation: Callable[..., Any], arguments: Dict[str, Any]) -> str:
+        """ツールプロセスを起動して結果を待ちます（スレッドで実行される）。"""
+        parent_conn, child_conn = self._context.Pipe(duplex=False)
+        memory_limit = self.memory_limit_mb * 1024 * 1024 if self.memory_limit_mb else None
+        process = self._context.Process(
+            target=_execute_tool,
+            args=(child_conn, implementation, arguments, memory_limit, self.max_output_chars),
+            daemon=True,
+        )
+        try:
+            process.start()
+        except Exception as e: # 実装をプロセスに渡せない（pickleできない）場合など
+            return f"Error: could not start tool process: {e}"
+        finally:
+            child_conn.close()
+        try:
+            if not parent_conn.poll(self.timeout):
+                logger.warning("Tool call timed out after %.1f seconds. Killing the tool process.", self.timeout)
+                return f"Error: tool timed out after {self.timeout:g} seconds"
+            # 出力はツールプロセスで切り詰め済み（ここで再び切り詰めると省略した文字数が変わる）
+            _, output = parent_conn.recv()
+            return str(output)
+        except EOFError:
+            # 結果を返さずにプロセスが終了した（強制終了やメモリ不足など）
+            process.join(1)
+            return f"Error: tool process exited unexpectedly (exit code {process.exitcode})"
+        finally:
+            if process.is_alive():
+                process.kill()
+            process.join(1)
+            parent_conn.close()
+
+    async def run_all(self, tools: Dict[str, llm.Tool], calls: List[llm.ToolCall],
+                      on_result: Optional[Callable[[llm.ToolCall, llm.ToolResult], Awaitable[None]]] = None,
+                      ) -> List[llm.ToolResult]:
+        """
+        1ターン内の独立したツール呼び出しを並列に実行し、呼び出し順の結果を返します。
+        on_result を渡すと、各呼び出しが完了した順にその結果で呼び出します。
+        """
+        async def run_one(call: llm.ToolCall) -> llm.ToolResult:
+            result = await self.run(tools.get(call.name), call)
+            if on_result is not None:
+                try:
+                    await on_result(call, result)
+                except Exception as e:
+                    logger.warning("Tool result callback failed: %s", e)
+            return result
+
+        return list(await asyncio.gather(*(run_one(call) for call in calls)))
+
+_sandbox: Optional[ToolSandbox] = None
+
+def configure_tool_sandbox(**kwargs: Any) -> ToolSandbox:
+    """プロセス全体で共有するツールサンドボックスを設定します。"""
+    global _sandbox
+    _sandbox = ToolSandbox(**kwargs)
+    return _sandbox
+
+def get_tool_sandbox() -> ToolSandbox:
+    """共有のツールサンドボックスを返します。未設定ならデフォルト設定で作成します。"""
+    global _sandbox
+    if _sandbox is None:
+        _sandbox = ToolSandbox()
+    return _sandbox
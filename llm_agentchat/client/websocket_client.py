@@ -2,37 +2,154 @@
 import websockets
 import json
 import asyncio
-from typing import Callable, Any, Dict # Dict をインポートに追加
+import logging
+import random
+from collections import deque
+from typing import Callable, Any, Deque, Dict, Iterable, Optional, Union # Dict をインポートに追加
+from urllib.parse import urlencode
+from llm_agentchat.schema import parse_room_spec
+from llm_agentchat.tracing import get_tracer, log_sampled
+
+logger = logging.getLogger(__name__)
 
 class WebSocketClient:
     """
     WebSocketサーバーに接続し、メッセージを送受信するためのクライアント。
+
+    接続が切れた場合はジッター付き指数バックオフで自動的に再接続し、
+    切断中に送信されたメッセージは上限付きのキューに保持して再接続時に送信します。
+    room_name に複数のルームやパターン（例: "design,project-*" またはリスト）を指定すると、
+    1つの接続で全てのルームに参加します（受信したメッセージの room で区別する）。
     """
-    def __init__(self, server_url: str, room_name: str, agent_name: str, on_message: Callable[[Dict[str, Any]], None]):
+    def __init__(self, server_url: str, room_name: Union[str, Iterable[str]], agent_name: str, on_message: Callable[[Dict[str, Any]], None],
+                 subscribe: Optional[str] = None,
+                 batch: bool = False,
+                 max_queue_size: int = 1000,
+                 initial_backoff: float = 0.5,
+                 max_backoff: float = 30.0,
+                 ping_interval: Optional[float] = 20.0,
+                 ping_timeout: Optional[float] = 20.0):
         self.server_url = server_url
-        self.room_name = room_name
+        self.room_name = room_name if isinstance(room_name, str) else ",".join(room_name)
         self.agent_name = agent_name
         self.on_message = on_message # 受信メッセージを処理するコールバック
+        self.subscribe = subscribe # 購読フィルタ（例: "mentions,humans"）。Noneなら全て受信
+        self.batch = batch # Trueならサーバーがまとめたバッチのフレームを受け取る（1件ずつに分けてコールバックに渡す）
         self.websocket = None
         self._listener_task = None
-        print(f"WebSocketClient initialized for agent '{agent_name}' in room '{room_name}' at {server_url}")
+        self._run_task: Optional[asyncio.Task] = None
+
+        # 再接続とキープアライブの設定
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.ping_interval = ping_interval # websocketsライブラリのping/pongによる死活監視の間隔（秒）
+        self.ping_timeout = ping_timeout # pongが返ってこない場合に切断とみなすまでの時間（秒）
+
+        # 切断中に送信されたメッセージを保持するキュー（上限を超えたら古いものから破棄）
+        self._outbox: Deque[Dict[str, Any]] = deque(maxlen=max_queue_size)
+        self.dropped_messages = 0 # キューあふれで破棄したメッセージ数
+        self._send_lock = asyncio.Lock() # キューの再送と新しいメッセージの送信の順序を保つ
+
+        # ライフサイクルシグナル
+        self.connected = asyncio.Event() # 接続中はセットされる
+        self.closed = asyncio.Event() # disconnect()で完全に停止したときにセットされる
+        self._should_run = False
+        logger.info("WebSocketClient initialized for agent '%s' in room '%s' at %s", agent_name, room_name, server_url)
+
+    @property
+    def url(self) -> str:
+        """接続先のWebSocket URLを返します。"""
+        names, patterns = parse_room_spec(self.room_name)
+        if len(names) == 1 and not patterns:
+            params = {"room": names[0], "agent": self.agent_name}
+        else:
+            params = {"rooms": ",".join(names + patterns), "agent": self.agent_name}
+        if self.subscribe:
+            params["subscribe"] = self.subscribe
+        if self.batch:
+            params["batch"] = "1"
+        return f"{self.server_url}/ws?{urlencode(params)}"
+
+    @property
+    def pending_messages(self) -> int:
+        """送信待ちキューに溜まっているメッセージ数を返します。"""
+        return len(self._outbox)
 
-    async def connect(self):
-        """WebSocketサーバーに接続します。"""
+    async def connect(self) -> bool:
+        """
+        WebSocketサーバーに1回だけ接続を試みます。
+        成功した場合はリスナーを起動し、キューに溜まったメッセージを送信してTrueを返します。
+        """
         try:
-            full_url = f"{self.server_url}/ws?room={self.room_name}&agent={self.agent_name}"
-            self.websocket = await websockets.connect(full_url)
-            print(f"Connected to WebSocket: {full_url}")
-            self._listener_task = asyncio.create_task(self._listen_for_messages())
+            full_url = self.url
+            self.websocket = await websockets.connect(
+                full_url, ping_interval=self.ping_interval, ping_timeout=self.ping_timeout
+            )
+            logger.info("Connected to WebSocket: %s", full_url)
         except Exception as e:
-            print(f"WebSocket connection failed: {e}")
+            logger.warning("WebSocket connection failed: %s", e)
             self.websocket = None
+            return False
+
+        self.connected.set()
+        self.closed.clear()
+        self._listener_task = asyncio.create_task(self._listen_for_messages(), name="websocket listener")
+        async with self._send_lock:
+            await self._flush_outbox()
+        return True
+
+    def start(self) -> asyncio.Task:
+        """
+        自動再接続付きの接続ループをバックグラウンドタスクとして開始します。
+        接続の確立は `connected` イベントで待つことができます。
+        """
+        if self._run_task is None or self._run_task.done():
+            self._should_run = True
+            self.closed.clear()
+            self._run_task = asyncio.create_task(self.run())
+        return self._run_task
+
+    async def run(self):
+        """接続が切れるたびにバックオフしながら再接続を繰り返します。disconnect()で停止します。"""
+        self._should_run = True
+        attempt = 0
+        while self._should_run:
+            if await self.connect():
+                attempt = 0
+                listener = self._listener_task
+                if listener is not None:
+                    try:
+                        await listener
+                    except asyncio.CancelledError:
+                        if not self._should_run:
+                            break
+                        raise
+            if not self._should_run:
+                break
+            delay = self._backoff_delay(attempt)
+            attempt += 1
+            logger.info("Reconnecting to WebSocket in %.1f seconds (attempt %d)...", delay, attempt)
+            await asyncio.sleep(delay)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """フルジッター付きの指数バックオフで次の再接続までの待ち時間を計算します。"""
+        cap = min(self.max_backoff, self.initial_backoff * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    async def wait_connected(self, timeout: Optional[float] = None) -> bool:
+        """接続が確立されるまで待ちます。タイムアウトした場合はFalseを返します。"""
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
     async def disconnect(self):
-        """WebSocketサーバーから切断します。"""
+        """WebSocketサーバーから切断し、再接続ループも停止します。"""
+        self._should_run = False
         if self.websocket:
             await self.websocket.close()
-            print("Disconnected from WebSocket.")
+            logger.info("Disconnected from WebSocket.")
         if self._listener_task:
             self._listener_task.cancel()
             try:
@@ -40,20 +157,73 @@ class WebSocketClient:
             except asyncio.CancelledError:
                 pass
             self._listener_task = None
+        if self._run_task and self._run_task is not asyncio.current_task():
+            self._run_task.cancel()
+            try:
+                await self._run_task
+            except asyncio.CancelledError:
+                pass
+            self._run_task = None
         self.websocket = None
+        self.connected.clear()
+        self.closed.set()
 
     async def send_message(self, message: Dict[str, Any]):
-        """WebSocket経由でメッセージを送信します。"""
+        """
+        WebSocket経由でメッセージを送信します。
+        未接続または送信に失敗した場合は、キューに保持して再接続時（または次の送信時）に送信します。
+        接続中にキューに残っているメッセージがあれば、送信順を保つために先にそれらを送信します。
+        """
+        try:
+            payload = json.dumps(message)
+        except TypeError as e: # シリアライズできないオブジェクトが渡された場合
+            logger.error("Failed to serialize message for WebSocket: %s - Message: %r", e, message)
+            return
+
+        async with self._send_lock:
+            if self.websocket:
+                # 以前の送信に失敗して接続が生きたまま残ったメッセージを先に送る
+                await self._flush_outbox()
+            if self.websocket and not self._outbox:
+                try:
+                    await self.websocket.send(payload)
+                    log_sampled(logger, logging.DEBUG, "Sent message via WebSocket: %r", message)
+                    return
+                except Exception as e:
+                    logger.warning("Failed to send message via WebSocket: %s", e)
+            self._enqueue(message)
+
+    def _enqueue(self, message: Dict[str, Any]):
+        """メッセージを送信待ちキューに追加します。キューが満杯なら最も古いメッセージを破棄します。"""
+        if len(self._outbox) == self._outbox.maxlen:
+            self.dropped_messages += 1
+            logger.warning("Outbound queue is full. Dropping the oldest message.")
+        self._outbox.append(message)
         if self.websocket:
+            log_sampled(logger, logging.INFO, "Could not send the message. Message queued (%d pending).", len(self._outbox))
+        else:
+            log_sampled(logger, logging.INFO, "WebSocket is not connected. Message queued (%d pending).", len(self._outbox))
+
+    async def _flush_outbox(self):
+        """キューに溜まったメッセージを送信順に送信します。送信に失敗したら残りはキューに残します。"""
+        while self._outbox and self.websocket:
+            message = self._outbox[0]
             try:
                 await self.websocket.send(json.dumps(message))
-                print(f"Sent message via WebSocket: {message}")
             except Exception as e:
-                print(f"Failed to send message via WebSocket: {e}")
-            except TypeError as e: # シリアライズできないオブジェクトが渡された場合
-                print(f"Failed to serialize message for WebSocket: {e} - Message: {message}")
-        else:
-            print("WebSocket is not connected. Message not sent.")
+                logger.warning("Failed to flush queued message: %s", e)
+                return
+            self._outbox.popleft()
+            log_sampled(logger, logging.DEBUG, "Sent queued message via WebSocket: %r", message)
+
+    def _dispatch(self, message_data: Dict[str, Any]):
+        """受信したメッセージをコールバックに渡します。"""
+        get_tracer().record(message_data.get("trace_id"), "agent_received",
+                            agent=self.agent_name, room=message_data.get("room"))
+        log_sampled(logger, logging.DEBUG, "Received message via WebSocket: %r", message_data)
+        # コールバックを待たずに実行することで、リスナーがブロックされるのを防ぐ
+        asyncio.create_task(self.on_message(message_data),
+                            name=f"handle {message_data.get('type', 'chat')} message")
 
     async def _listen_for_messages(self):
         """WebSocketからのメッセージをリッスンし、コールバックを非同期タスクとして実行します。"""
@@ -61,14 +231,22 @@ class WebSocketClient:
             while True:
                 message_str = await self.websocket.recv()
                 message_data = json.loads(message_str)
-                print(f"Received message via WebSocket: {message_data}")
-                # コールバックを待たずに実行することで、リスナーがブロックされるのを防ぐ
-                asyncio.create_task(self.on_message(message_data))
+                if message_data.get("type") == "control" and message_data.get("action") == "ping":
+                    # サーバーのハートビートに応答する（応答しない接続はサーバーに切断される）
+                    await self.websocket.send(json.dumps({"type": "control", "action": "pong"}))
+                    continue
+                if message_data.get("type") == "batch":
+                    # バッチのフレームは受信順のメッセージに分けて処理する
+                    for message in message_data.get("messages", []):
+                        self._dispatch(message)
+                    continue
+                self._dispatch(message_data)
         except websockets.exceptions.ConnectionClosedOK:
-            print("WebSocket connection closed normally.")
+            logger.info("WebSocket connection closed normally.")
         except Exception as e:
-            print(f"WebSocket listener error: {e}")
+            logger.warning("WebSocket listener error: %s", e)
         finally:
-            print("WebSocket listener stopped.")
+            logger.debug("WebSocket listener stopped.")
             self.websocket = None # 接続が切れたらwebsocketをNoneにする
             self._listener_task = None
+            self.connected.clear()
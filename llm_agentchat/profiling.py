@@ -0,0 +1,244 @@
+# イベントループの遅延モニターとサンプリングプロファイラ
+#
+# 非同期コードに紛れ込んだ同期処理（SQLiteの呼び出しや大きなJSONの変換など）は、
+# 原因のわからないレイテンシとしてしか現れません。このモジュールは --profile
+# （または環境変数 AGENTCHAT_PROFILE）で有効になり、次のことを行います。
+# - イベントループの遅延（予定した時刻からのずれ）を継続的に計測し、定期的に集計をログに出す
+#   （サーバーはプロファイリングが無効でも遅延の計測だけは行い、受け入れ制御の過負荷の判定に使う）
+# - しきい値より長くループを止めている処理を別スレッドから検出し、そのスタックをログに出す
+# - --profile-output を指定した場合、ループのスレッドをサンプリングし、実行中のタスク名
+#   （サーバーはエンドポイント、エージェントはハンドラ）を先頭に付けたスタックを
+#   folded形式（flamegraph.pl や speedscope で読み込める）でファイルに書き出す
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LAG_THRESHOLD = 0.1 # この時間（秒）以上ループが止まったらスタックを記録する
+DEFAULT_CHECK_INTERVAL = 0.05 # 遅延を計測する間隔（秒）
+DEFAULT_SAMPLE_INTERVAL = 0.005 # サンプリングの間隔（秒）
+DEFAULT_REPORT_INTERVAL = 60.0 # 遅延の集計をログに出し、プロファイルを書き出す間隔（秒）
+LAG_SMOOTHING = 0.2 # 遅延の指数移動平均の係数（一瞬の停止では過負荷とみなさない）
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _is_idle(frame) -> bool:
+    """ループのスレッドがI/O待ち（selectorでの待機）かどうかを判定します。"""
+    return frame.f_code.co_name in ("select", "poll", "control") and "selectors" in frame.f_code.co_filename
+
+def _running_task_name(loop: asyncio.AbstractEventLoop) -> str:
+    """ループで実行中のタスクの名前を返します（別スレッドから参照するため、取得できなければ "loop"）。"""
+    try:
+        task = asyncio.tasks._current_tasks.get(loop)
+    except AttributeError:
+        task = None
+    return task.get_name() if task is not None else "loop"
+
+class LoopMonitor:
+    """
+    イベントループの遅延の計測、ループを止めている処理の検出、サンプリングプロファイラをまとめて行います。
+    start() はループのスレッドから呼び出してください。
+    """
+
+    def __init__(self, service: str, threshold: float = DEFAULT_LAG_THRESHOLD,
+                 check_interval: float = DEFAULT_CHECK_INTERVAL, output: Optional[str] = None,
+                 sample_interval: float = DEFAULT_SAMPLE_INTERVAL, report_interval: float = DEFAULT_REPORT_INTERVAL):
+        self.service = service
+        self.threshold = threshold
+        self.check_interval = check_interval
+        self.output = output
+        self.sample_interval = sample_interval
+        self.report_interval = report_interval
+        self.lags: Deque[float] = collections.deque(maxlen=10000) # 直近の遅延（秒）
+        self.lag = 0.0 # 遅延の指数移動平均（秒）
+        self.max_lag = 0.0
+        self.stalls = 0 # しきい値を超えてループが止まった回数
+        self.samples: Dict[str, int] = collections.Counter() # folded形式のスタック -> サンプル数
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._beat = time.monotonic()
+        self._lag_task: Optional[asyncio.Task] = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.watching = False
+
+    def start(self, watch: bool = True):
+        """
+        実行中のループの監視を開始します。watch=False の場合は遅延の計測だけを行い、
+        ウォッチドッグ・プロファイラと集計のログ出力は行いません。
+        """
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self.lag = 0.0
+        self.watching = watch
+        self._lag_task = self._loop.create_task(self._measure_lag(), name="loop-monitor")
+        if not watch:
+            return
+        self._threads = [threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)]
+        if self.output:
+            self._threads.append(threading.Thread(target=self._sample, name="loop-sampler", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info("Event loop monitor started for %s (threshold %.0f ms%s)", self.service, self.threshold * 1000,
+                    f", profile: {self.output}" if self.output else "")
+
+    def stop(self):
+        """監視を終了し、集計をログに出してプロファイルを書き出します。"""
+        self._stop.set()
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        for thread in self._threads:
+            thread.join(1)
+        self._threads = []
+        if self.watching:
+            self.report()
+            self.write_profile()
+
+    async def _measure_lag(self):
+        """check_interval ごとに起床し、予定時刻からのずれを遅延として記録します。"""
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        while True:
+            expected = loop.time() + self.check_interval
+            await asyncio.sleep(self.check_interval)
+            lag = max(0.0, loop.time() - expected)
+            self._beat = time.monotonic()
+            self.lags.append(lag)
+            self.lag += LAG_SMOOTHING * (lag - self.lag)
+            self.max_lag = max(self.max_lag, lag)
+            if self.watching and loop.time() - last_report >= self.report_interval:
+                last_report = loop.time()
+                self.report()
+                await asyncio.to_thread(self.write_profile)
+
+    def _watch(self):
+        """ウォッチドッグ: ループが止まっていれば、止めている処理のスタックをログに出します（1回の停止につき1回）。"""
+        reported_beat = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.check_interval
+            if blocked < self.threshold or beat == reported_beat:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None or _is_idle(frame):
+                continue
+            reported_beat = beat
+            self.stalls += 1
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning("Event loop of %s blocked for over %.0f ms in task '%s':\n%s",
+                           self.service, blocked * 1000, _running_task_name(self._loop), stack)
+
+    def _sample(self):
+        """サンプリングプロファイラ: ループのスレッドのスタックを実行中のタスク名ごとに集計します。"""
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None or _is_idle(frame):
+                continue
+            labels = []
+            while frame is not None:
+                # ループ本体（run_forever から Handle._run まで）のフレームは省く
+                if frame.f_code.co_name == "_run" and frame.f_code.co_filename.endswith(os.path.join("asyncio", "events.py")):
+                    break
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(_running_task_name(self._loop))
+            key = ";".join(reversed(labels))
+            with self._lock:
+                self.samples[key] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        """直近の遅延の集計（ミリ秒）を返します。"""
+        lags = sorted(self.lags)
+        if not lags:
+            return {"samples": 0, "p50_ms": None, "p99_ms": None, "max_ms": round(self.max_lag * 1000, 1),
+                    "stalls": self.stalls}
+        return {
+            "samples": len(lags),
+            "p50_ms": round(lags[len(lags) // 2] * 1000, 1),
+            "p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 1),
+            "max_ms": round(self.max_lag * 1000, 1),
+            "stalls": self.stalls,
+        }
+
+    def report(self):
+        summary = self.summary()
+        if summary["samples"]:
+            logger.info("Event loop lag (%s): p50 %.1f ms, p99 %.1f ms, max %.1f ms, %d stalls over %d samples",
+                        self.service, summary["p50_ms"], summary["p99_ms"], summary["max_ms"],
+                        summary["stalls"], summary["samples"])
+
+    def write_profile(self):
+        """サンプルをfolded形式（`タスク名;フレーム;... 回数`）でファイルに書き出します。"""
+        if not self.output:
+            return
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in sorted(self.samples.items())]
+        tmp = self.output + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp, self.output)
+
+class TaskLabelMiddleware:
+    """
+    HTTPリクエスト・WebSocket接続を処理するタスクに「メソッド パス」の名前を付けるASGIミドルウェア。
+    サンプリングプロファイラやウォッチドッグはこの名前でエンドポイントを識別します。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            task = asyncio.current_task()
+            if task is not None:
+                method = scope.get("method", "WS")
+                task.set_name(f"{method} {scope.get('path', '')}")
+        await self.app(scope, receive, send)
+
+_settings: Dict[str, Any] = {}
+
+def configure_profiling(enabled: bool = False, output: Optional[str] = None, threshold_ms: Optional[float] = None):
+    """
+    プロセス全体のプロファイリングの設定を行います。
+    引数が省略された場合は環境変数 AGENTCHAT_PROFILE / AGENTCHAT_PROFILE_OUTPUT /
+    AGENTCHAT_LAG_THRESHOLD_MS の値を使います。出力先を指定するとプロファイリングも有効になります。
+    出力先には {service}（server / agent）と {pid} を含めることができます。
+    """
+    output = output or os.environ.get("AGENTCHAT_PROFILE_OUTPUT") or None
+    enabled = enabled or bool(output) or os.environ.get("AGENTCHAT_PROFILE", "") not in ("", "0", "false")
+    if threshold_ms is None:
+        threshold_ms = float(os.environ.get("AGENTCHAT_LAG_THRESHOLD_MS", DEFAULT_LAG_THRESHOLD * 1000))
+    _settings.update(enabled=enabled, output=output, threshold=threshold_ms / 1000)
+
+def start_loop_monitor(service: str, measure_lag: bool = False) -> Optional[LoopMonitor]:
+    """
+    プロファイリングが有効なら、実行中のループの監視を開始して返します。無効ならNoneを返します。
+    measure_lag=True の場合は、プロファイリングが無効でも遅延の計測だけを行うモニターを返します。
+    """
+    if not _settings:
+        configure_profiling()
+    if not _settings["enabled"]:
+        if not measure_lag:
+            return None
+        monitor = LoopMonitor(service, threshold=_settings["threshold"])
+        monitor.start(watch=False)
+        return monitor
+    output = _settings["output"]
+    if output:
+        output = output.replace("{service}", service).replace("{pid}", str(os.getpid()))
+    monitor = LoopMonitor(service, threshold=_settings["threshold"], output=output)
+    monitor.start()
+    return monitor
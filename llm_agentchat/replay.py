@@ -0,0 +1,468 @@
+# ルームのリプレイによるエージェント側のベンチマーク
+#
+# エクスポートしたルームの履歴（/api/messages のJSONなど）または合成したスクリプトを、
+# 同じプロセス内で起動したサーバーに投稿し、モックモデル（agentchat-mock）を使う
+# エージェントに応答させて、エージェント側の処理（WebSocketClient → handle_message_from_server →
+# _generate_response → _send_message）のスループット、待ち時間、段階ごとのCPU時間を計測します。
+#
+# イベントループの時計を speed 倍速で進めるため、モデルの待ち時間や応答遅延、スクリプトの
+# 投稿間隔は実時間の 1/speed で経過します。報告する時間は全て仮想時間（秒）です。
+# ネットワークやCPUの処理は実時間で進むため、仮想時間では speed 倍に見える点に注意してください。
+import asyncio
+import contextvars
+import datetime
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+import httpx
+
+from llm_agentchat.client.agent import Agent
+from llm_agentchat.client.http_client import close_http_client
+from llm_agentchat.client.llm_scheduler import configure_llm_scheduler
+from llm_agentchat.client.mock_model import MOCK_MODEL_ID, configure_mock_model, ensure_mock_model_registered
+from llm_agentchat.client.websocket_client import WebSocketClient
+
+# リプレイしないメッセージの種類
+SKIPPED_TYPES = ("system", "control", "presence", "tool")
+
+# 計測する段階（model はモデル呼び出しのスレッド、それ以外はイベントループ上の処理）
+STAGES = ("receive", "respond", "generate", "send", "model")
+
+# ---------------------------------------------------------------------------
+# 仮想時間
+# ---------------------------------------------------------------------------
+
+class AcceleratedClock:
+    """実時間の speed 倍で進む時計。イベントループとモックモデルで共有します。"""
+
+    def __init__(self, speed: float = 1.0):
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        self.speed = speed
+        self._origin = time.monotonic()
+
+    def now(self) -> float:
+        return self._origin + (time.monotonic() - self._origin) * self.speed
+
+    def sleep(self, seconds: float):
+        """仮想時間で seconds 秒待ちます（別スレッドから呼び出す）。"""
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+class _ScaledSelector:
+    """selectのタイムアウト（仮想時間）を実時間に換算するセレクタのラッパー。"""
+
+    def __init__(self, selector, speed: float):
+        self._selector = selector
+        self._speed = speed
+
+    def select(self, timeout=None):
+        return self._selector.select(None if timeout is None else timeout / self._speed)
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+class AcceleratedEventLoop(asyncio.SelectorEventLoop):
+    """時計を AcceleratedClock に置き換えたイベントループ。asyncio.sleep やタイムアウトが speed 倍速になります。"""
+
+    def __init__(self, clock: AcceleratedClock):
+        super().__init__()
+        self.clock = clock
+        self._selector = _ScaledSelector(self._selector, clock.speed)
+
+    def time(self) -> float:
+        return self.clock.now()
+
+# ---------------------------------------------------------------------------
+# 段階ごとの計測
+# ---------------------------------------------------------------------------
+
+# 処理中のメッセージの計測レコード（モデル呼び出しのスレッドにも引き継がれる）
+_current_record: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar(
+    "replay_record", default=None
+)
+
+class StageMeter:
+    """
+    コルーチンの各ステップ（次のawaitまで）のCPU時間を段階ごとに集計します。
+    段階が入れ子になっている場合、内側の段階の時間は外側から差し引きます（排他的なCPU時間）。
+    """
+
+    def __init__(self, clock: AcceleratedClock):
+        self.clock = clock
+        self.cpu: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        self.calls: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.records: List[Dict[str, Any]] = []
+        self.in_flight = 0
+        self.last_activity = clock.now()
+        self._stack: List[List[float]] = []
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, cpu: float, calls: int = 0):
+        with self._lock:
+            self.cpu[stage] = self.cpu.get(stage, 0.0) + cpu
+            self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def _enter(self):
+        self._stack.append([time.thread_time(), 0.0])
+
+    def _exit(self, stage: str):
+        started, nested = self._stack.pop()
+        elapsed = time.thread_time() - started
+        self.add(stage, elapsed - nested)
+        if self._stack:
+            self._stack[-1][1] += elapsed
+
+    def wrap(self, stage: str, func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """非同期関数をラップし、呼び出しごとにCPU時間を計測します。"""
+        async def metered(*args: Any, **kwargs: Any) -> Any:
+            self.add(stage, 0.0, calls=1)
+            return await _MeteredCoroutine(self, stage, func(*args, **kwargs))
+        return metered
+
+    def wrap_receive(self, func: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Callable[[Dict[str, Any]], Awaitable[Any]]:
+        """受信ハンドラをラップし、処理中の件数と受信時刻を記録します。"""
+        metered = self.wrap("receive", func)
+
+        async def receive(message: Dict[str, Any]) -> Any:
+            _current_record.set({"received": self.clock.now()})
+            self.in_flight += 1
+            try:
+                return await metered(message)
+            finally:
+                self.in_flight -= 1
+                self.last_activity = self.clock.now()
+        return receive
+
+    def wrap_respond(self, func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """応答の生成をラップし、応答ごとの時刻を記録します。"""
+        metered = self.wrap("respond", func)
+
+        async def respond(*args: Any, **kwargs: Any) -> Any:
+            record = _current_record.get()
+            record = dict(record) if record is not None else {"received": self.clock.now()}
+            _current_record.set(record)
+            record["respond_start"] = self.clock.now()
+            result = await metered(*args, **kwargs)
+            record["reply_sent"] = self.clock.now()
+            self.records.append(record)
+            return result
+        return respond
+
+    def observe_model(self, started: float, finished: float, output_tokens: int, cpu: float):
+        """モックモデルのオブザーバー（モデル呼び出しのスレッドで呼ばれる）。"""
+        self.add("model", cpu, calls=1)
+        record = _current_record.get()
+        if record is not None:
+            record.setdefault("model_start", started)
+            record["model_end"] = finished
+            record["output_tokens"] = record.get("output_tokens", 0) + output_tokens
+
+class _MeteredCoroutine:
+    """コルーチンを1ステップずつ進め、各ステップのCPU時間を StageMeter に記録するawaitable。"""
+
+    def __init__(self, meter: StageMeter, stage: str, coro):
+        self._meter = meter
+        self._stage = stage
+        self._coro = coro
+
+    def __await__(self):
+        coro = self._coro
+        value, error = None, None
+        while True:
+            self._meter._enter()
+            try:
+                yielded = coro.throw(error) if error is not None else coro.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self._meter._exit(self._stage)
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e: # キャンセルなどはラップしたコルーチンに伝える
+                value, error = None, e
+
+# ---------------------------------------------------------------------------
+# スクリプト
+# ---------------------------------------------------------------------------
+
+def _parse_timestamp(value: Any) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+def load_script(path: str, skip_senders: Sequence[str] = ()) -> List[Dict[str, Any]]:
+    """
+    リプレイするメッセージを読み込みます。
+    /api/messages のJSON（リストまたは {"messages": [...]}）やJSONLに対応します。
+    各メッセージは `at`（先頭からの秒数）または `timestamp` で投稿時刻を、`sender` と `message` で内容を指定します。
+    リプレイするエージェント自身の発言（skip_senders）やシステムメッセージは除外します。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+        entries = data.get("messages", []) if isinstance(data, dict) else data
+    except ValueError:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    script = []
+    origin = None
+    for entry in entries:
+        if entry.get("type", "chat") in SKIPPED_TYPES or entry.get("sender") in skip_senders:
+            continue
+        if not entry.get("message"):
+            continue
+        at = entry.get("at")
+        if at is None:
+            ts = _parse_timestamp(entry.get("timestamp"))
+            if ts is not None:
+                origin = ts if origin is None else origin
+                at = ts - origin
+        script.append({
+            "at": float(at or 0.0),
+            "sender": entry.get("sender") or "human",
+            "message": entry["message"],
+            "type": entry.get("type", "chat"),
+        })
+    script.sort(key=lambda m: m["at"])
+    return script
+
+def synthetic_script(count: int, interval: float = 5.0, agents: Sequence[str] = (), mention_rate: float = 0.3,
+                     seed: int = 0, sender: str = "human") -> List[Dict[str, Any]]:
+    """
+    人間の発言をポアソン到着（平均間隔 interval 秒）で count 件生成します。
+    mention_rate の割合でランダムなエージェントにメンションします。
+    """
+    rng = random.Random(seed)
+    script = []
+    at = 0.0
+    for i in range(count):
+        text = f"Message {i + 1}: please take a look at item {rng.randint(1, 1000)}."
+        if agents and rng.random() < mention_rate:
+            text = f"@{rng.choice(list(agents))} {text}"
+        script.append({"at": round(at, 3), "sender": sender, "message": text, "type": "chat"})
+        at += rng.expovariate(1 / interval) if interval > 0 else 0.0
+    return script
+
+# ---------------------------------------------------------------------------
+# レポート
+# ---------------------------------------------------------------------------
+
+def _distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    """平均とパーセンタイル（秒）を返します。"""
+    if not values:
+        return {"mean": None, "p50": None, "p95": None, "max": None}
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+    return {
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": round(percentile(0.5), 4),
+        "p95": round(percentile(0.95), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+def build_report(meter: StageMeter, injected: int, started: float, finished: float, wall: float,
+                 speed: float, seed: int) -> Dict[str, Any]:
+    """計測結果からレポートの辞書を作成します。"""
+    records = meter.records
+    elapsed = max(finished - started, 1e-9)
+    queue_delays = [r["model_start"] - r["received"] for r in records if "model_start" in r]
+    model_times = [r["model_end"] - r["model_start"] for r in records if "model_start" in r]
+    response_times = [r["reply_sent"] - r["received"] for r in records]
+    return {
+        "seed": seed,
+        "speed": speed,
+        "injected": injected,
+        "received": meter.calls["receive"],
+        "replies": len(records),
+        "virtual_seconds": round(elapsed, 3),
+        "wall_seconds": round(wall, 3),
+        "throughput": {
+            "replies_per_second": round(len(records) / elapsed, 4),
+            "received_per_second": round(meter.calls["receive"] / elapsed, 4),
+            "output_tokens_per_second": round(sum(r.get("output_tokens", 0) for r in records) / elapsed, 4),
+        },
+        "queue_delay": _distribution(queue_delays),
+        "model_time": _distribution(model_times),
+        "response_time": _distribution(response_times),
+        "cpu": {
+            stage: {
+                "calls": meter.calls.get(stage, 0),
+                "total_ms": round(meter.cpu.get(stage, 0.0) * 1000, 3),
+                "per_call_us": round(meter.cpu.get(stage, 0.0) * 1e6 / meter.calls[stage], 1)
+                if meter.calls.get(stage) else None,
+            }
+            for stage in STAGES
+        },
+    }
+
+def format_report(report: Dict[str, Any]) -> str:
+    """レポートを表形式の文字列にします。"""
+    def seconds(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value * 1000:.1f}ms"
+
+    throughput = report["throughput"]
+    lines = [
+        f"replayed {report['injected']} messages in {report['virtual_seconds']:.1f}s virtual "
+        f"({report['wall_seconds']:.1f}s wall, speed x{report['speed']:g}, seed {report['seed']})",
+        f"  received {report['received']}, replies {report['replies']} "
+        f"({throughput['replies_per_second']:.3f}/s, {throughput['output_tokens_per_second']:.1f} tokens/s)",
+        "",
+        f"  {'':<14} {'mean':>10} {'p50':>10} {'p95':>10} {'max':>10}",
+    ]
+    for key in ("queue_delay", "model_time", "response_time"):
+        d = report[key]
+        lines.append(f"  {key:<14} {seconds(d['mean']):>10} {seconds(d['p50']):>10} "
+                     f"{seconds(d['p95']):>10} {seconds(d['max']):>10}")
+    lines += ["", f"  {'cpu stage':<14} {'calls':>8} {'total':>12} {'per call':>12}"]
+    for stage, cpu in report["cpu"].items():
+        per_call = "-" if cpu["per_call_us"] is None else f"{cpu['per_call_us']:.1f}us"
+        lines.append(f"  {stage:<14} {cpu['calls']:>8} {cpu['total_ms']:>10.2f}ms {per_call:>12}")
+    return "\n".join(lines)
+
+# ---------------------------------------------------------------------------
+# リプレイの実行
+# ---------------------------------------------------------------------------
+
+def mock_agent_config(config: Dict[str, Any], mock_options: Dict[str, Any]) -> Dict[str, Any]:
+    """エージェント設定のモデルをモックモデルに置き換えます（ツールは使わない）。"""
+    replayed = dict(config)
+    replayed["model"] = MOCK_MODEL_ID
+    replayed["options"] = {k: v for k, v in mock_options.items() if v is not None}
+    replayed["tools"] = []
+    return replayed
+
+async def _replay(script: List[Dict[str, Any]], agent_configs: List[Dict[str, Any]], common_settings: Dict[str, Any],
+                  clock: AcceleratedClock, meter: StageMeter, room: str, drain: float,
+                  max_duration: Optional[float]) -> Dict[str, Any]:
+    import uvicorn
+    from llm_agentchat.server.app import app, floor_schedulers
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", ws_ping_interval=None, lifespan="on"))
+    server_task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+            raise RuntimeError("Replay server failed to start")
+        await asyncio.sleep(0.01)
+    floor_schedulers.pop(room, None)
+
+    server_url = f"ws://127.0.0.1:{port}"
+    clients = []
+    poster = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}")
+    injected = 0
+    try:
+        for config in agent_configs:
+            agent = Agent(config=config, room_name=room, server_url=server_url, common_settings=common_settings)
+            agent._respond = meter.wrap_respond(agent._respond)
+            agent._generate_response = meter.wrap("generate", agent._generate_response)
+            agent._send_message = meter.wrap("send", agent._send_message)
+            ws_client = WebSocketClient(
+                server_url=server_url, room_name=room, agent_name=agent.name,
+                on_message=meter.wrap_receive(agent.handle_message_from_server),
+                subscribe=agent.subscribe, ping_interval=None,
+            )
+            agent.set_websocket_client(ws_client)
+            # 接続してから会話履歴を取得する（その間に投稿されたメッセージも取りこぼさない）
+            if not await agent.join(timeout=10):
+                raise RuntimeError(f"Agent '{agent.name}' could not connect to the replay server")
+            clients.append(ws_client)
+
+        started = clock.now()
+        meter.last_activity = started
+        for entry in script:
+            delay = started + entry["at"] - clock.now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            response = await poster.post("/api/message", json={
+                "room": room, "sender": entry["sender"], "message": entry["message"], "type": entry["type"],
+            })
+            response.raise_for_status()
+            injected += 1
+
+        # 全ての応答が終わり、drain 秒間何も受信しなくなるまで待つ
+        deadline = None if max_duration is None else started + max_duration
+        while True:
+            now = clock.now()
+            if deadline is not None and now >= deadline:
+                break
+            if meter.in_flight == 0 and now - meter.last_activity >= drain:
+                break
+            await asyncio.sleep(min(0.1, drain) or 0.01)
+        finished = max([started] + [r["reply_sent"] for r in meter.records])
+    finally:
+        await poster.aclose()
+        for ws_client in clients:
+            await ws_client.disconnect()
+        await close_http_client()
+        server.should_exit = True
+        await server_task
+        floor_schedulers.pop(room, None)
+    return {"injected": injected, "started": started, "finished": finished}
+
+def run_replay(script: List[Dict[str, Any]], agent_configs: List[Dict[str, Any]],
+               common_settings: Optional[Dict[str, Any]] = None, mock_options: Optional[Dict[str, Any]] = None,
+               speed: float = 20.0, seed: int = 0, turn_policy: Optional[str] = "round_robin",
+               reply_budget: int = 3, drain: float = 5.0, max_duration: Optional[float] = None,
+               room: str = "replay") -> Dict[str, Any]:
+    """
+    スクリプトを投稿し、モックモデルを使うエージェントに応答させてレポートを返します。
+    サーバーは一時ディレクトリのSQLiteデータベースを使い、ハートビートは無効にして起動します。
+    """
+    from llm_agentchat.server.app import app
+
+    ensure_mock_model_registered()
+    clock = AcceleratedClock(speed)
+    meter = StageMeter(clock)
+    configure_mock_model(seed=seed, clock=clock, observer=meter.observe_model)
+    configure_llm_scheduler(None)
+    configs = [mock_agent_config(config, mock_options or {}) for config in agent_configs]
+
+    settings = ("storage_engine", "db_path", "storage_options", "turn_policy", "reply_budget", "moderator",
+                "heartbeat_interval")
+    saved = {name: getattr(app.state, name) for name in settings if hasattr(app.state, name)}
+    loop = AcceleratedEventLoop(clock)
+    wall_start = time.perf_counter()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            app.state.storage_engine = "sqlite"
+            app.state.db_path = os.path.join(tmp, "replay.db")
+            app.state.storage_options = {}
+            app.state.turn_policy = turn_policy
+            app.state.reply_budget = reply_budget
+            app.state.moderator = None
+            app.state.heartbeat_interval = 0
+            result = loop.run_until_complete(
+                _replay(script, configs, common_settings or {}, clock, meter, room, drain, max_duration)
+            )
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        loop.close()
+        configure_mock_model()
+        for name in settings:
+            if name in saved:
+                setattr(app.state, name, saved[name])
+            elif hasattr(app.state, name):
+                delattr(app.state, name)
+    return build_report(meter, result["injected"], result["started"], result["finished"],
+                        time.perf_counter() - wall_start, speed, seed)
@@ -0,0 +1,84 @@
+# サーバー・クライアント・ストレージで共有するメッセージのスキーマ
+#
+# チャットメッセージは ChatMessage（保存済みのメッセージ。APIの応答やブートストラップの形式）、
+# クライアントからの投稿は MessageIn で表します。ストレージの行（message_content / message_type）も
+# 別名としてそのまま ChatMessage に読み込めます。大きな本文はプレビューとブロブのハッシュ（blob）で表します。
+# 履歴のJSONは、SQLiteでは行から直接（辞書を作らずに）生成し、それ以外のエンジンでは
+# MESSAGE_LIST の TypeAdapter で一括してシリアライズします。
+# 1つの接続で参加するルームの指定（parse_room_spec）もサーバーとクライアントで共有します。
+import fnmatch
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field, TypeAdapter, model_serializer
+
+class ChatMessage(BaseModel):
+    """保存済みのチャットメッセージ。"""
+    model_config = ConfigDict(populate_by_name=True, extra="ignore")
+
+    id: Optional[int] = None
+    room: Optional[str] = None
+    sender: str
+    message: str = Field(validation_alias=AliasChoices("message", "message_content"))
+    timestamp: Optional[str] = None
+    type: str = Field(default="chat", validation_alias=AliasChoices("type", "message_type"))
+    # 本文をブロブストアに保存した場合のハッシュ（message はプレビュー。全文は /api/blobs/{blob}）
+    blob: Optional[str] = None
+
+    @model_serializer(mode="wrap")
+    def _omit_empty_blob(self, handler):
+        # ブロブのないメッセージには blob キーを出力しない（SQLiteの行から直接生成するJSONと同じ形式）
+        data = handler(self)
+        if data.get("blob") is None:
+            data.pop("blob", None)
+        return data
+
+class MessageIn(BaseModel):
+    """クライアント（Web UI・エージェント）から投稿されるメッセージ。"""
+    model_config = ConfigDict(extra="ignore")
+
+    room: Optional[str] = None
+    sender: Optional[str] = None
+    message: Optional[str] = None
+    type: str = "chat"
+    action: Optional[str] = None # 制御フレーム（type が "control"）の種類（例: ハートビートへの応答の "pong"）
+    to: Optional[Union[str, List[str]]] = None # 宛先のエージェント（メンションとは別に明示する場合）
+    trace_id: Optional[str] = None
+    parent_trace_id: Optional[str] = None # 応答のきっかけとなったメッセージのトレースID
+
+MESSAGE_LIST = TypeAdapter(List[ChatMessage])
+
+def encode_messages(rows: Iterable[Dict[str, Any]], room: Optional[str] = None) -> bytes:
+    """ストレージの行（またはメッセージの辞書）のリストをAPIの形式のJSONバイト列にします。"""
+    messages = MESSAGE_LIST.validate_python(list(rows))
+    if room is not None:
+        for message in messages:
+            message.room = room
+    return MESSAGE_LIST.dump_json(messages)
+
+# エージェントがサーバーのHTTP APIを呼び出すときに付けるヘッダー（値はエージェント名）。
+# サーバーは過負荷時の受け入れ制御で、このヘッダーのあるリクエストを観察者より優先する
+AGENT_HEADER = "X-Agent-Name"
+
+# この文字を含むルームの指定は fnmatch 形式のパターンとして扱う
+ROOM_PATTERN_CHARS = "*?["
+
+def parse_room_spec(spec: Union[str, Iterable[str]]) -> Tuple[List[str], List[str]]:
+    """
+    ルームの指定（カンマ区切りの文字列またはリスト）を (ルーム名のリスト, パターンのリスト) に分けます。
+    例: "design,project-*" -> (["design"], ["project-*"])
+    """
+    items = spec.split(",") if isinstance(spec, str) else list(spec)
+    names: List[str] = []
+    patterns: List[str] = []
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
+        target = patterns if any(char in item for char in ROOM_PATTERN_CHARS) else names
+        if item not in target:
+            target.append(item)
+    return names, patterns
+
+def room_matches(room: str, patterns: Iterable[str]) -> bool:
+    """ルーム名がいずれかのパターンに一致するかどうかを返します（大文字と小文字を区別する）。"""
+    return any(fnmatch.fnmatchcase(room, pattern) for pattern in patterns)
@@ -0,0 +1,185 @@
+# 受け入れ制御と負荷制限（ロードシェディング）
+#
+# サーバーが受け入れる接続（WebSocket・SSE）と処理中のHTTPリクエストの数に上限を設け、
+# 過負荷（イベントループの遅延、または配信待ちのメッセージの滞留）を検出したら新しい接続・リクエストを断ります。
+# 遅延はプロファイリングと共通のループモニター（profiling.LoopMonitor）の計測値（指数移動平均）を、
+# 滞留は受信キューに溜まったメッセージと接続ごとの送信待ちのフレームの合計を使います。
+# 優先度は人間の投稿（human）が最も高く、次にエージェント（agent）、最後に受動的な観察者（observer: Web UIの閲覧、SSE）です。
+# エージェントのHTTPリクエスト（ブートストラップなど）は AGENT_HEADER ヘッダーでエージェントとして扱います。
+# - 上限: 観察者は上限の observer_share の割合までしか使えず、残りを人間とエージェントのために空けておく
+# - 過負荷（レベル1）: 観察者の新しい接続・リクエストを断る
+# - 深刻な過負荷（レベル2、しきい値の CRITICAL_FACTOR 倍）: エージェントも断り、人間の投稿だけを受け入れる
+# 断ったHTTPリクエストには503とRetry-After、WebSocketには接続を受け入れた直後にクローズコード1013を返します。
+import json
+import logging
+import math
+from collections import Counter
+from typing import Callable, Optional, Tuple
+
+from llm_agentchat.profiling import DEFAULT_LAG_THRESHOLD
+from llm_agentchat.schema import AGENT_HEADER
+from llm_agentchat.tracing import log_sampled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 10000 # サーバー全体の接続数の上限（0で無制限）
+DEFAULT_MAX_ROOM_CONNECTIONS = 1000 # ルームごとの接続数の上限（0で無制限）
+DEFAULT_MAX_INFLIGHT = 256 # 処理中のHTTPリクエスト数の上限（0で無制限）
+# 過負荷とみなすイベントループの遅延（秒、0で無効）は、ループモニターがスタックを記録するしきい値と同じ DEFAULT_LAG_THRESHOLD
+DEFAULT_BACKLOG_THRESHOLD = 1000 # 過負荷とみなす配信待ちのメッセージ数（0で無効）
+DEFAULT_RETRY_AFTER = 2 # 断ったクライアントに再試行までの待ち時間として返す秒数
+OBSERVER_SHARE = 0.8 # 観察者が使える上限の割合
+CRITICAL_FACTOR = 4 # しきい値のこの倍を超えたら深刻な過負荷とみなす
+
+class AdmissionController:
+    """接続数・処理中のリクエスト数と過負荷の状態を管理し、新しい接続・リクエストを受け入れるかを判断します。"""
+
+    def __init__(self, backlog: Optional[Callable[[], int]] = None, lag: Optional[Callable[[], float]] = None):
+        self.backlog = backlog or (lambda: 0) # 配信待ちのメッセージ数を返す関数
+        self.lag = lag or (lambda: 0.0) # イベントループの遅延（秒、ループモニターの指数移動平均）を返す関数
+        self.configure()
+        self.connections: Counter = Counter() # ルーム -> 接続数
+        self.total_connections = 0
+        self.inflight = 0
+        self.shed: Counter = Counter() # (優先度, 理由) -> 断った数
+
+    def configure(self, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                  max_room_connections: int = DEFAULT_MAX_ROOM_CONNECTIONS,
+                  max_inflight: int = DEFAULT_MAX_INFLIGHT, lag_threshold: float = DEFAULT_LAG_THRESHOLD,
+                  backlog_threshold: int = DEFAULT_BACKLOG_THRESHOLD, retry_after: int = DEFAULT_RETRY_AFTER,
+                  observer_share: float = OBSERVER_SHARE):
+        """上限としきい値を設定します（0は無制限・無効）。"""
+        self.max_connections = max_connections
+        self.max_room_connections = max_room_connections
+        self.max_inflight = max_inflight
+        self.lag_threshold = lag_threshold
+        self.backlog_threshold = backlog_threshold
+        self.retry_after = retry_after
+        self.observer_share = observer_share
+
+    def stop(self):
+        """断った数の集計をログに出します（シャットダウン時）。"""
+        if self.shed:
+            logger.info("Load shedding summary: %s",
+                        ", ".join(f"{kind}/{reason}={count}" for (kind, reason), count in sorted(self.shed.items())))
+
+    def overload_level(self) -> int:
+        """0: 通常、1: 過負荷（観察者を断る）、2: 深刻な過負荷（人間の投稿だけを受け入れる）。"""
+        ratios = []
+        if self.lag_threshold > 0:
+            ratios.append(self.lag() / self.lag_threshold)
+        if self.backlog_threshold > 0:
+            ratios.append(self.backlog() / self.backlog_threshold)
+        pressure = max(ratios, default=0.0)
+        if pressure >= CRITICAL_FACTOR:
+            return 2
+        return 1 if pressure >= 1 else 0
+
+    def _limit_for(self, kind: str, limit: int) -> int:
+        """優先度に応じた上限（観察者は一部を空けておく）。0は無制限。"""
+        if limit <= 0 or kind != "observer":
+            return limit
+        return max(1, math.floor(limit * self.observer_share))
+
+    def _shed_by_overload(self, kind: str) -> Optional[str]:
+        level = self.overload_level()
+        if level >= 2 and kind != "human":
+            return "critical"
+        if level >= 1 and kind == "observer":
+            return "overloaded"
+        return None
+
+    def _reject(self, kind: str, reason: str) -> Tuple[str, int]:
+        self.shed[(kind, reason)] += 1
+        log_sampled(logger, logging.WARNING, "Shedding %s (%s): %d connections, %d in flight, lag %.0f ms, backlog %d",
+                    kind, reason, self.total_connections, self.inflight, self.lag() * 1000, self.backlog())
+        return reason, self.retry_after
+
+    def check_connection(self, room: str, kind: str) -> Optional[Tuple[str, int]]:
+        """
+        新しい接続を受け入れられるかを判断します。受け入れる場合はNone、
+        断る場合は (理由, Retry-Afterの秒数) を返します。受け入れたら open_connection() を呼んでください。
+        """
+        reason = self._shed_by_overload(kind)
+        if reason is None:
+            limit = self._limit_for(kind, self.max_connections)
+            room_limit = self._limit_for(kind, self.max_room_connections)
+            if limit and self.total_connections >= limit:
+                reason = "connections"
+            elif room_limit and self.connections[room] >= room_limit:
+                reason = "room connections"
+        return self._reject(kind, reason) if reason else None
+
+    def open_connection(self, room: str):
+        self.connections[room] += 1
+        self.total_connections += 1
+
+    def close_connection(self, room: str):
+        self.connections[room] -= 1
+        if self.connections[room] <= 0:
+            del self.connections[room]
+        self.total_connections -= 1
+
+    def check_request(self, kind: str) -> Optional[Tuple[str, int]]:
+        """新しいHTTPリクエストを受け入れられるかを判断します（戻り値は check_connection と同じ）。"""
+        reason = self._shed_by_overload(kind)
+        if reason is None:
+            limit = self._limit_for(kind, self.max_inflight)
+            if limit and self.inflight >= limit:
+                reason = "requests"
+        return self._reject(kind, reason) if reason else None
+
+    def check_overload(self, kind: str) -> Optional[Tuple[str, int]]:
+        """上限は見ずに、過負荷の状態だけで受け入れるかを判断します（受け入れ済みのリクエストの送信者の判定に使う）。"""
+        reason = self._shed_by_overload(kind)
+        return self._reject(kind, reason) if reason else None
+
+def request_priority(method: str, path: str, from_agent: bool = False) -> Optional[str]:
+    """
+    HTTPリクエストの優先度を返します。メッセージの投稿は人間として扱い（エージェントの投稿はエンドポイントで判定する）、
+    エージェントからの閲覧（ブートストラップ・履歴・ブロブの取得）はエージェント、それ以外は観察者として扱います。
+    SSEのストリームは接続として数えるためNoneを返します。
+    """
+    if path.startswith("/api/rooms/") and path.endswith("/stream"):
+        return None
+    if method == "POST" and path == "/api/message":
+        return "human"
+    return "agent" if from_agent else "observer"
+
+_AGENT_HEADER_KEY = AGENT_HEADER.lower().encode("latin-1")
+
+def overloaded_body(reason: str) -> bytes:
+    return json.dumps({"detail": f"Server is overloaded ({reason}), please retry later"}).encode("utf-8")
+
+class AdmissionMiddleware:
+    """処理中のHTTPリクエストを数え、上限や過負荷の場合は503とRetry-Afterで断るASGIミドルウェア。"""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        kind = None
+        if scope["type"] == "http":
+            from_agent = any(name == _AGENT_HEADER_KEY for name, _ in scope.get("headers", ()))
+            kind = request_priority(scope.get("method", ""), scope.get("path", ""), from_agent)
+        if kind is None:
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller
+        rejected = controller.check_request(kind)
+        if rejected is not None:
+            reason, retry_after = rejected
+            body = overloaded_body(reason)
+            await send({"type": "http.response.start", "status": 503, "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(retry_after).encode("ascii")),
+            ]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        controller.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.inflight -= 1
@@ -1,10 +1,33 @@
-from fastapi import FastAPI, WebSocket, HTTPException, status
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, WebSocket, HTTPException, status
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from typing import Dict, List, Any
-import llm_agentchat.server.db as db
+from typing import Dict, List, Any, Optional, Set, Tuple, Union
+from llm_agentchat.server.storage import DEFAULT_PATHS, MessageStore, open_storage
+from llm_agentchat.server.blobs import BLOB_THRESHOLD, BlobStore, blob_root_for, make_preview
+from llm_agentchat.server.scheduler import FloorScheduler
+from llm_agentchat.server.presence import PresenceTracker
+from llm_agentchat.server.ingest import DEFAULT_BATCH_WINDOW, RoomIngestor
+from llm_agentchat.server.sse import RoomFeed, encode_event, stream_events
+from llm_agentchat.server.admission import AdmissionController, AdmissionMiddleware
+from llm_agentchat.server.bootstrap import EXCLUDED_TYPES, SUMMARY_SOURCE_LIMIT, SummaryCache, build_summary
+from llm_agentchat.server.http_cache import (
+    CACHE_IMMUTABLE, CACHE_REVALIDATE, accepted_encodings, body_cache, cached_json_response, make_etag, match_etag,
+)
+from llm_agentchat.server.routing import (
+    OBSERVER_NAME, addressees, index_mentions, parse_subscription, select_recipients,
+)
+import asyncio
 import datetime
+from collections import Counter
+import gzip
+import json
+import logging
 import os
+import uuid
+from llm_agentchat.tracing import get_tracer, log_sampled
+from llm_agentchat.schema import ChatMessage, MessageIn, encode_messages, parse_room_spec, room_matches
+from pydantic import ValidationError
+from llm_agentchat.profiling import LoopMonitor, TaskLabelMiddleware, start_loop_monitor
 
 from contextlib import asynccontextmanager
 
@@ -12,16 +35,41 @@ from contextlib import asynccontextmanager
 async def lifespan(app: FastAPI):
     """アプリケーションの起動時とシャットダウン時に実行されるイベントハンドラ。"""
     # 起動イベント
-    # データベースパスはapp.stateから取得
-    conn = db.get_db(app.state.db_path)
-    db.init_db(conn)
-    conn.close()
+    # ストレージはapp.stateの設定（storage_engine, db_path）から開く
+    get_storage()
+    # イベントループの遅延は常に計測し（受け入れ制御が使う）、--profile 指定時はウォッチドッグとプロファイラも動かす
+    global loop_monitor
+    loop_monitor = start_loop_monitor("server", measure_lag=True)
+    latest_message_ids.clear()
+    room_summaries.clear()
+    room_ingestors.clear()
+    room_feeds.clear()
+    # 接続数・リクエスト数の上限と過負荷のしきい値は app.state.admission（辞書）で設定する
+    admission.configure(**getattr(app.state, "admission", {}))
+    sync_task = asyncio.create_task(sync_storage_periodically())
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
     yield
-    # シャットダウンイベント（ここでは特になし）
-    # print("Application is shutting down.")
+    # シャットダウンイベント：まとめて行っているfsyncを済ませてからストレージを閉じる
+    # 定期タスクは終了を待ってから（ストレージを閉じるのと並行して動かないように）後始末する
+    for task in (heartbeat_task, sync_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    admission.stop()
+    await stop_ingestors()
+    close_storage()
+    if loop_monitor is not None:
+        loop_monitor.stop()
+        loop_monitor = None
+
+logger = logging.getLogger(__name__)
 
 # FastAPIアプリケーションのインスタンスを作成し、lifespanイベントハンドラを適用
 app = FastAPI(lifespan=lifespan)
+# リクエストを処理するタスクにエンドポイント名を付け、プロファイルで区別できるようにする
+app.add_middleware(TaskLabelMiddleware)
 
 # プロジェクトのルートディレクトリからの相対パスでstaticディレクトリをマウント
 # NOTE: 実際のアプリケーションでは、より堅牢なパス解決が必要になる場合があります
@@ -32,145 +80,849 @@ static_dir = os.path.join(current_dir, "static")
 # {room_name: {agent_name: websocket}}
 active_connections: Dict[str, Dict[str, WebSocket]] = {}
 
-# データベースのパスはapp.stateから取得するように変更
-# DATABASE_PATH = "chat_history.db" # この行は削除またはコメントアウト
+# 接続ごとの購読フィルタ（all / mentions / humans）
+# {room_name: {agent_name: {filter, ...}}}
+connection_subscriptions: Dict[str, Dict[str, Set[str]]] = {}
+
+# 複数のメッセージをまとめたバッチのフレームを受け取る接続（接続時に batch=1 を指定したもの）
+# {room_name: {agent_name, ...}}
+batched_connections: Dict[str, Set[str]] = {}
+
+# 1つの接続で複数のルームに参加している接続（接続時に rooms= を指定したもの）と、参加中のルーム
+# {websocket: {room_name, ...}}
+connection_rooms: Dict[WebSocket, Set[str]] = {}
+
+# ルーム名のパターンで参加する接続。パターンに一致するルームにメッセージが届いたときに参加させる
+# {websocket: (agent_name, (pattern, ...), {filter, ...}, batch)}
+room_patterns: Dict[WebSocket, Tuple[str, Tuple[str, ...], Set[str], bool]] = {}
+
+# ルームごとの受信処理のアクター（ルーム内の順序の決定・保存・配信を1つのタスクで行う）
+# {room_name: RoomIngestor}
+room_ingestors: Dict[str, RoomIngestor] = {}
+
+# 観戦者（SSE）向けのルームごとの共有イベントバッファ。エージェントの接続とは別に管理する
+# {room_name: RoomFeed}
+room_feeds: Dict[str, RoomFeed] = {}
+
+# 接続ごとの送信待ち（送信中を含む）のフレーム数。遅い接続への送信で配信が滞ると増える
+# {websocket: 件数}
+pending_sends: Counter = Counter()
+
+# イベントループの遅延を計測するモニター（起動中のみ）
+loop_monitor: Optional[LoopMonitor] = None
+
+def ingest_backlog() -> int:
+    """全てのルームで保存・配信を待っているメッセージ数を返します。"""
+    return sum(ingestor.queue.qsize() for ingestor in room_ingestors.values())
+
+def outbound_backlog() -> int:
+    """全ての接続への送信待ちのフレーム数を返します。"""
+    return sum(pending_sends.values())
+
+def delivery_backlog() -> int:
+    """過負荷の検出に使う配信待ちの量（受信キューのメッセージ数と、接続ごとの送信待ちのフレーム数の合計）。"""
+    return ingest_backlog() + outbound_backlog()
+
+def loop_lag() -> float:
+    """ループモニターが計測したイベントループの遅延（指数移動平均、秒）を返します。"""
+    return loop_monitor.lag if loop_monitor is not None else 0.0
+
+# 接続数・処理中のリクエスト数の上限と過負荷の検出（人間とエージェントを観察者より優先して受け入れる）
+admission = AdmissionController(backlog=delivery_backlog, lag=loop_lag)
+app.add_middleware(AdmissionMiddleware, controller=admission)
+
+def overloaded_error(rejected: Tuple[str, int]) -> HTTPException:
+    """受け入れ制御で断ったリクエストに返す503（Retry-After付き）を作ります。"""
+    reason, retry_after = rejected
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail=f"Server is overloaded ({reason}), please retry later",
+                         headers={"Retry-After": str(retry_after)})
+
+# ルームごとの発言権スケジューラ（--turn-policy 指定時のみ使用）
+# {room_name: FloorScheduler}
+floor_schedulers: Dict[str, FloorScheduler] = {}
+
+# ルームごとの最新メッセージID（/api/messages のETag計算用。未登録のルームはDBから取得する）
+# {room_name: message_id}
+latest_message_ids: Dict[str, int] = {}
+
+# ルームごとの参加者のスナップショットと各接続の最終受信時刻
+presence = PresenceTracker()
+# ハートビートにpongを返したことのある接続。応答しなくなった場合に切断するのはこれらの接続だけで、
+# pongを返さない（アプリのハートビートに対応していない）クライアントの死活はプロトコルのping/pongで検出する
+heartbeat_clients: Set[WebSocket] = set()
+
+# ハートビートのデフォルト設定（秒）。app.state.heartbeat_interval / heartbeat_timeout で変更できる
+HEARTBEAT_INTERVAL = 15.0
+HEARTBEAT_TIMEOUT = 45.0
+# 1つの接続への送信を待つ上限（秒）。応答しない接続がブロードキャスト全体を止めないようにする
+SEND_TIMEOUT = 5.0
 
-# lifespan関数は既に定義されているため、ここでは変更なし
+# ルームごとの要約のキャッシュ（/api/bootstrap 用）
+room_summaries = SummaryCache()
+
+# サーバーの起動ごとに異なる値。再起動でバージョンが巻き戻っても古いETagと一致しないようにする
+_instance_id = uuid.uuid4().hex
+
+# 現在開いているストレージと、それを開いたときの設定
+_storage: Optional[MessageStore] = None
+_storage_key: Optional[tuple] = None
+# ストレージの隣に置く大きな本文のブロブストア
+_blob_store: Optional[BlobStore] = None
+
+def get_storage() -> MessageStore:
+    """
+    app.stateの設定（storage_engine, db_path, storage_options）に対応するストレージを返します。
+    設定が変わった場合は開き直し、古いストレージに基づくキャッシュを破棄します。
+    """
+    global _storage, _storage_key
+    engine = getattr(app.state, "storage_engine", "sqlite")
+    path = getattr(app.state, "db_path", None)
+    options = getattr(app.state, "storage_options", {})
+    key = (engine, path, tuple(sorted(options.items())))
+    if _storage is None or _storage_key != key:
+        close_storage()
+        _storage = open_storage(engine, path, **options)
+        _storage_key = key
+        latest_message_ids.clear()
+        room_summaries.clear()
+        body_cache.clear()
+    return _storage
+
+def get_blob_store() -> BlobStore:
+    """
+    大きな本文を保存するブロブストアを返します。保存先は app.state.blob_dir、
+    省略時はストレージの保存先の隣（<保存先>.blobs）です。
+    """
+    global _blob_store
+    engine = getattr(app.state, "storage_engine", "sqlite")
+    root = getattr(app.state, "blob_dir", None) or blob_root_for(
+        getattr(app.state, "db_path", None) or DEFAULT_PATHS[engine]
+    )
+    if _blob_store is None or _blob_store.root != root:
+        _blob_store = BlobStore(root)
+    return _blob_store
+
+async def store_large_body(full_message: Dict[str, Any]) -> Optional[str]:
+    """
+    本文が app.state.blob_threshold（バイト）を超える場合はブロブストアに保存し、
+    メッセージの本文をプレビューに置き換えてハッシュを返します。しきい値以下ならNoneを返します。
+    圧縮とファイルの書き込みはスレッドで行い、他のルームの受信処理を止めません。
+    """
+    threshold = getattr(app.state, "blob_threshold", BLOB_THRESHOLD)
+    body = full_message["message"].encode("utf-8")
+    if threshold <= 0 or len(body) <= threshold:
+        return None
+    key = await asyncio.to_thread(get_blob_store().put, body)
+    full_message["message"] = make_preview(full_message["message"])
+    full_message["blob"] = key
+    return key
+
+def close_storage():
+    """開いているストレージを閉じます。"""
+    global _storage, _storage_key
+    if _storage is not None:
+        _storage.sync()
+        _storage.close()
+        _storage = None
+        _storage_key = None
+
+async def sync_storage_periodically():
+    """fsyncをまとめて行うエンジンのために、書き込みを定期的に永続化します。"""
+    interval = getattr(app.state, "storage_options", {}).get("fsync_interval", 1.0)
+    while True:
+        await asyncio.sleep(interval)
+        if _storage is not None:
+            _storage.sync()
 
 async def broadcast_message(room: str, message: Dict[str, Any]):
     """
-    指定されたルームの全てのWebSocketクライアントにメッセージをブロードキャストします。
+    指定されたルームのWebSocketクライアントにメッセージを配信します。
+    宛先指定（`to` やメンション）のあるメッセージは宛先と観察者にのみ、
+    それ以外は各接続の購読フィルタに従って配信します。
     """
     if room in active_connections:
+        recipients = message_recipients(room, message)
+        # 全ての宛先に同じフレームを送るため、シリアライズは1回だけ行う
+        payload = json.dumps(message, ensure_ascii=False, separators=(",", ":"))
         # 接続リストをコピーして、非同期イテレーション中にリストが変更されるのを防ぐ
         connections_to_remove = []
         # エージェント名と接続のペアをイテレート
-        for agent_name, connection in list(active_connections[room].items()):
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                # 送信失敗した接続はクローズされたとみなし、リストから削除
-                print(f"Error broadcasting message to {agent_name}: {e}")
-                connections_to_remove.append(agent_name)
-        for agent_name in connections_to_remove:
-            if agent_name in active_connections[room]:
-                del active_connections[room][agent_name]
-
-@app.get("/api/messages", response_model=List[Dict[str, Any]])
-async def get_messages(room: str):
+        targets = [(agent_name, connection) for agent_name, connection in list(active_connections[room].items())
+                   if agent_name in recipients]
+        held = hold_sends({connection: 1 for _, connection in targets})
+        try:
+            for agent_name, connection in targets:
+                ok = await send_with_timeout(connection, payload, agent_name)
+                release_sends(held, connection)
+                if not ok:
+                    # 送信失敗した接続はクローズされたとみなし、リストから削除
+                    connections_to_remove.append((agent_name, connection))
+        finally:
+            release_sends(held)
+        for agent_name, connection in connections_to_remove:
+            await drop_connection(room, agent_name, connection)
+
+def message_recipients(room: str, message: Dict[str, Any]) -> List[str]:
+    """メッセージを配信すべき、ルームに接続中の接続名のリストを返します。"""
+    return select_recipients(
+        list(active_connections.get(room, {}).keys()),
+        connection_subscriptions.get(room, {}),
+        message,
+        sender_is_human=not message.get("from_agent", is_agent_sender(room, message.get("sender", ""))),
+    )
+
+async def broadcast_messages(room: str, messages: List[Dict[str, Any]]):
     """
-    特定のチャットルームの過去のメッセージを取得します。
+    受信順に並んだ複数のメッセージをルームに配信します。
+    バッチのフレームを受け取る接続には、その接続宛てのメッセージが複数あれば1つのフレーム
+    （{"type": "batch", "room": ..., "messages": [...]}）にまとめて送り、それ以外の接続には1件ずつ送ります。
     """
-    # app.state.db_pathからデータベースパスを取得
-    conn = db.get_db(app.state.db_path)
-    messages_from_db = db.get_messages_for_room(conn, room)
-    conn.close()
-    # フロントエンドが期待する 'message' キーに 'message_content' をマッピング
-    messages = [
-        {
-            "room": msg.get("room_name"),
-            "sender": msg.get("sender"),
-            "message": msg.get("message_content"),
-            "timestamp": msg.get("timestamp"),
-            "type": msg.get("message_type"),
-        }
-        for msg in messages_from_db
+    if len(messages) == 1 or not batched_connections.get(room):
+        for message in messages:
+            await broadcast_message(room, message)
+        return
+    if room not in active_connections:
+        return
+    batched = batched_connections[room]
+    # 各メッセージのシリアライズは1回だけ行い、同じ組み合わせのバッチのフレームは使い回す
+    payloads = [json.dumps(message, ensure_ascii=False, separators=(",", ":")) for message in messages]
+    selected: Dict[str, List[int]] = {}
+    for index, message in enumerate(messages):
+        for agent_name in message_recipients(room, message):
+            selected.setdefault(agent_name, []).append(index)
+    room_json = json.dumps(room, ensure_ascii=False)
+    frames: Dict[Tuple[int, ...], str] = {}
+    connections_to_remove = []
+    targets = [(agent_name, connection) for agent_name, connection in list(active_connections[room].items())
+               if selected.get(agent_name)]
+    # バッチのフレームを受け取らない接続は、宛てのメッセージ数だけフレームを送る
+    held = hold_sends({connection: 1 if agent_name in batched else len(selected[agent_name])
+                       for agent_name, connection in targets})
+    try:
+        for agent_name, connection in targets:
+            indexes = selected[agent_name]
+            if agent_name in batched and len(indexes) > 1:
+                key = tuple(indexes)
+                if key not in frames:
+                    frames[key] = f'{{"type":"batch","room":{room_json},"messages":[{",".join(payloads[i] for i in indexes)}]}}'
+                sends = [frames[key]]
+            else:
+                sends = [payloads[i] for i in indexes]
+            for payload in sends:
+                if not await send_with_timeout(connection, payload, agent_name):
+                    connections_to_remove.append((agent_name, connection))
+                    break
+            release_sends(held, connection)
+    finally:
+        release_sends(held)
+    for agent_name, connection in connections_to_remove:
+        await drop_connection(room, agent_name, connection)
+
+def hold_sends(counts: Dict[WebSocket, int]) -> Dict[WebSocket, int]:
+    """配信を始める前に、各接続への送信待ちのフレーム数を数えます。release_sends() に渡す counts を返します。"""
+    for connection, count in counts.items():
+        pending_sends[connection] += count
+    return counts
+
+def release_sends(held: Dict[WebSocket, int], connection: Optional[WebSocket] = None):
+    """
+    接続への送信が終わった（または打ち切った）フレームを送信待ちから外します。
+    connection を省略した場合は、まだ外していない全ての接続の分を外します（配信が中断された場合）。
+    """
+    for connection in ([connection] if connection is not None else list(held)):
+        count = held.pop(connection, 0)
+        pending_sends[connection] -= count
+        if pending_sends[connection] <= 0:
+            del pending_sends[connection]
+
+async def send_with_timeout(connection: WebSocket, payload: Union[str, Dict[str, Any]], name: str) -> bool:
+    """
+    接続にJSON（シリアライズ済みの文字列または辞書）を送信します。
+    失敗または SEND_TIMEOUT 秒以内に完了しなかった場合はFalseを返します。
+    """
+    send = connection.send_text(payload) if isinstance(payload, str) else connection.send_json(payload)
+    try:
+        await asyncio.wait_for(send, SEND_TIMEOUT)
+        return True
+    except Exception as e:
+        logger.warning("Error sending to %s: %r", name, e)
+        return False
+
+def register_connection(room: str, agent: str, websocket: WebSocket, filters: Set[str], batch: bool = False):
+    """接続をルームに登録します。batch=True の接続にはバッチのフレームを送ります。"""
+    active_connections.setdefault(room, {})[agent] = websocket
+    connection_subscriptions.setdefault(room, {})[agent] = filters
+    if batch:
+        batched_connections.setdefault(room, set()).add(agent)
+    else:
+        batched_connections.get(room, set()).discard(agent)
+    presence.join(room, agent)
+
+async def drop_connection(room: str, agent: str, websocket: Optional[WebSocket] = None, close: bool = False) -> bool:
+    """
+    接続をルームから取り除き、退出のプレゼンスイベントを配信します。
+    websocket を指定した場合は、その接続が登録されているときだけ取り除きます
+    （同名で再接続した新しい接続を誤って取り除かないため）。何度呼ばれても安全です。
+    close=True の場合は接続も閉じます（応答しない接続の切断に使用）。
+    """
+    current = active_connections.get(room, {}).get(agent)
+    if current is None or (websocket is not None and current is not websocket):
+        return False
+    del active_connections[room][agent]
+    if not active_connections[room]:
+        del active_connections[room]
+    if room in connection_subscriptions:
+        connection_subscriptions[room].pop(agent, None)
+        if not connection_subscriptions[room]:
+            del connection_subscriptions[room]
+    if room in batched_connections:
+        batched_connections[room].discard(agent)
+        if not batched_connections[room]:
+            del batched_connections[room]
+    if current in connection_rooms:
+        connection_rooms[current].discard(room)
+    presence.leave(room, agent)
+    if close:
+        try:
+            await asyncio.wait_for(current.close(code=status.WS_1001_GOING_AWAY), SEND_TIMEOUT)
+        except Exception as e:
+            logger.debug("Error closing idle connection %s: %r", agent, e)
+
+    if agent != OBSERVER_NAME:
+        scheduler = floor_schedulers.get(room)
+        if scheduler is not None:
+            # 発言権を持ったまま切断された場合は次のエージェントに引き継ぐ
+            speakers = scheduler.remove_agent(agent)
+            if speakers:
+                await grant_floor(room, speakers, {"sender": agent})
+        await announce_presence(room, agent, "leave")
+    return True
+
+async def join_room(room: str, agent: str, websocket: WebSocket, filters: Set[str], batch: bool = False):
+    """
+    接続をルームに登録し、発言権制御が有効であればエージェントに通知して、参加のプレゼンスイベントを配信します。
+    複数のルームに参加する接続は、ルームごとにこの処理を行います。
+    """
+    register_connection(room, agent, websocket, filters, batch)
+    if websocket in connection_rooms:
+        connection_rooms[websocket].add(room)
+    logger.info("WebSocket connected: %s to room '%s'", agent, room)
+
+    scheduler = get_floor_scheduler(room)
+    if scheduler is not None and agent != OBSERVER_NAME:
+        scheduler.add_agent(agent)
+        # エージェントに発言権制御が有効であることを通知する
+        await websocket.send_json({
+            "type": "control",
+            "action": "floor",
+            "room": room,
+            "policy": scheduler.policy,
+        })
+
+    # 接続時に既存のメッセージを送信（オプション、Web UIがGET /api/messagesを呼ぶためここでは不要）
+    if agent != OBSERVER_NAME:
+        await announce_presence(room, agent, "join")
+
+def active_rooms() -> Set[str]:
+    """このサーバーで活動中（接続がある、またはメッセージを受信した）のルーム名の集合を返します。"""
+    return set(active_connections) | set(room_ingestors) | set(latest_message_ids)
+
+async def attach_pattern_connections(room: str):
+    """パターンで参加する接続のうち、ルーム名が一致してまだ参加していないものをルームに参加させます。"""
+    for websocket, (agent, patterns, filters, batch) in list(room_patterns.items()):
+        if room in connection_rooms.get(websocket, ()) or not room_matches(room, patterns):
+            continue
+        await join_room(room, agent, websocket, filters, batch)
+
+async def announce_presence(room: str, agent: str, event: str):
+    """
+    参加（join）・退出（leave）のプレゼンスイベントをルームに配信します。
+    会話の一部ではないため保存はせず、観察者と presence の購読者にのみ届けます。
+    """
+    frame = {
+        "type": "presence",
+        "room": room,
+        "agent": agent,
+        "event": event,
+        "agents": list(presence.agents(room)),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    feed = room_feeds.get(room)
+    if feed is not None:
+        feed.publish(encode_event(json.dumps(frame, ensure_ascii=False, separators=(",", ":")), event="presence"))
+    await broadcast_message(room, frame)
+
+def heartbeat_settings() -> Tuple[float, float]:
+    """ハートビートの送信間隔と、応答がない接続を切断するまでの時間（秒）を返します。"""
+    return (
+        getattr(app.state, "heartbeat_interval", HEARTBEAT_INTERVAL),
+        getattr(app.state, "heartbeat_timeout", HEARTBEAT_TIMEOUT),
+    )
+
+async def reap_idle_connections(timeout: float) -> List[Tuple[str, str]]:
+    """
+    ハートビートに応答するクライアントのうち、最後の受信から timeout 秒以上経過した接続（半開きの接続など）を切断します。
+    pongを返したことのない接続は、受信がなくても切断しません（生きているが何も送らないクライアントを誤って切断しないため）。
+    """
+    reaped = []
+    for room, agent in presence.idle(timeout):
+        if active_connections.get(room, {}).get(agent) not in heartbeat_clients:
+            continue
+        logger.info("Reaping idle connection: %s in room '%s'", agent, room)
+        if await drop_connection(room, agent, close=True):
+            reaped.append((room, agent))
+    return reaped
+
+async def send_heartbeats():
+    """全ての接続にpingの制御フレームを送信します。クライアントはpongを返します。"""
+    sends = []
+    # 複数のルームに参加している接続にも1回だけ送る（pongの受信で全てのルームの最終受信時刻を更新する）
+    pinged: Set[int] = set()
+    for room, connections in list(active_connections.items()):
+        frame = {"type": "control", "action": "ping", "room": room}
+        for agent_name, connection in list(connections.items()):
+            if id(connection) in pinged:
+                continue
+            pinged.add(id(connection))
+            sends.append(send_with_timeout(connection, frame, agent_name))
+    if sends:
+        await asyncio.gather(*sends)
+
+async def heartbeat_loop():
+    """ハートビートを定期的に送信し、応答しない接続を切断します。"""
+    while True:
+        interval, timeout = heartbeat_settings()
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+        await reap_idle_connections(timeout)
+        await send_heartbeats()
+
+def latest_message_id(room: str) -> Optional[int]:
+    """ルームの最新メッセージIDを返します。メモリ上にない場合のみデータベースに問い合わせます。"""
+    if room not in latest_message_ids:
+        latest = get_storage().latest_id(room)
+        if latest is None:
+            return None
+        latest_message_ids[room] = latest
+    return latest_message_ids[room]
+
+def known_agents(room: str) -> List[str]:
+    """メンションの解決に使う、ルームに接続中のエージェント名のリストを返します。"""
+    return [name for name in active_connections.get(room, {}) if name != OBSERVER_NAME]
+
+def get_floor_scheduler(room: str) -> Optional[FloorScheduler]:
+    """
+    指定されたルームの発言権スケジューラを返します。
+    ターンポリシーが設定されていない場合はNoneを返します（全エージェントが自由に応答する）。
+    """
+    policy = getattr(app.state, "turn_policy", None)
+    if not policy:
+        return None
+    if room not in floor_schedulers:
+        floor_schedulers[room] = FloorScheduler(
+            policy=policy,
+            reply_budget=getattr(app.state, "reply_budget", 3),
+            moderator=getattr(app.state, "moderator", None),
+        )
+    return floor_schedulers[room]
+
+def is_agent_sender(room: str, sender: str) -> bool:
+    """送信者がルームに接続中のエージェントかどうかを判定します（それ以外は人間とみなす）。"""
+    return sender != OBSERVER_NAME and sender in active_connections.get(room, {})
+
+async def grant_floor(room: str, agents: List[str], message: Dict[str, Any]):
+    """
+    指定されたエージェントにだけ発言権を与える制御フレームを送信します。
+    """
+    control_frame = {
+        "type": "control",
+        "action": "speak",
+        "room": room,
+        "agents": agents,
+        "in_reply_to": {
+            "sender": message.get("sender"),
+            "timestamp": message.get("timestamp"),
+            "trace_id": message.get("trace_id"),
+            "from_agent": message.get("from_agent", False),
+        },
+    }
+    for agent_name in agents:
+        connection = active_connections.get(room, {}).get(agent_name)
+        if connection is None:
+            continue
+        try:
+            await connection.send_json(control_frame)
+        except Exception as e:
+            logger.warning("Error granting floor to %s: %s", agent_name, e)
+
+async def schedule_turn(room: str, message: Dict[str, Any]):
+    """
+    チャットメッセージをスケジューラに通知し、次の発言者に発言権を与えます。
+    """
+    scheduler = get_floor_scheduler(room)
+    if scheduler is None or message.get("type") != "chat":
+        return
+    sender = message.get("sender", "")
+    is_agent = message.get("from_agent", is_agent_sender(room, sender))
+    speakers = scheduler.on_message(sender, addressees(message), is_agent)
+    if speakers:
+        await grant_floor(room, speakers, message)
+
+def get_ingestor(room: str) -> RoomIngestor:
+    """
+    ルームの受信処理のアクターを返します（なければ起動する）。
+    まとめるメッセージを待つ時間は app.state.batch_window（秒）で変更できます。
+    """
+    ingestor = room_ingestors.get(room)
+    if ingestor is None or not ingestor.is_alive():
+        ingestor = RoomIngestor(
+            room, process_batch,
+            window=getattr(app.state, "batch_window", DEFAULT_BATCH_WINDOW),
+            on_exit=forget_ingestor,
+        )
+        room_ingestors[room] = ingestor
+    return ingestor
+
+def forget_ingestor(ingestor: RoomIngestor):
+    """終了したアクターを登録から取り除きます（同じルームで新しく起動したものは残す）。"""
+    if room_ingestors.get(ingestor.room) is ingestor:
+        del room_ingestors[ingestor.room]
+
+async def stop_ingestors():
+    """全てのアクターを、キューに残ったメッセージを処理してから停止します。"""
+    for ingestor in list(room_ingestors.values()):
+        if ingestor.is_alive():
+            await ingestor.stop()
+    room_ingestors.clear()
+
+async def ingest_message(full_message: Dict[str, Any], parent_trace_id: Optional[str] = None,
+                         wait: bool = True) -> Optional[int]:
+    """
+    受信したメッセージをルームのアクターに渡します。アクターが受信順に保存・配信し、発言権スケジューラに通知します。
+    HTTP と WebSocket のどちらから受信したメッセージもここを通り、各段階のタイミングを記録します。
+    wait=True の場合は配信まで完了するのを待ち、メッセージIDを返します。
+    """
+    room = full_message["room"]
+    get_tracer().mark(full_message, "received", sender=full_message.get("sender"), parent_trace_id=parent_trace_id)
+    if parent_trace_id:
+        full_message["parent_trace_id"] = parent_trace_id
+    log_sampled(logger, logging.DEBUG, "Received message in room '%s' from %s (trace %s)",
+                room, full_message.get("sender"), full_message["trace_id"])
+    future = await get_ingestor(room).submit(full_message, wait=wait)
+    return await future if future is not None else None
+
+async def process_batch(room: str, messages: List[Dict[str, Any]]):
+    """
+    ルームのアクターが受信順にまとめたメッセージを保存し、配信して発言権スケジューラに通知します。
+    複数のメッセージは1回の書き込みで保存します。
+    """
+    tracer = get_tracer()
+    if room_patterns:
+        # パターンで参加する接続は、ルームに最初のメッセージが届いた時点で参加させる
+        await attach_pattern_connections(room)
+    agents = known_agents(room)
+    rows = []
+    for full_message in messages:
+        # メンションは受信時に一度だけ解析し、配信先の決定とスケジューリングで再利用する
+        index_mentions(full_message, agents)
+        # 送信者がエージェントかどうか（エージェント側でLLM呼び出しの優先度決定に使う）
+        full_message["from_agent"] = is_agent_sender(room, full_message.get("sender", ""))
+        # 大きな本文は一度だけブロブとして保存し、行と配信にはプレビューと参照だけを含める
+        blob = await store_large_body(full_message)
+        rows.append((full_message["sender"], full_message["message"], full_message["type"], full_message["timestamp"], blob))
+
+    storage = get_storage()
+    if len(rows) == 1:
+        message_ids = [storage.add_message(room, *rows[0])]
+    else:
+        message_ids = storage.add_messages(room, rows)
+    for full_message, message_id in zip(messages, message_ids):
+        # クライアントが差分同期に使う、ルーム内で単調増加するID
+        full_message["id"] = message_id
+        tracer.mark(full_message, "persisted")
+    latest_message_ids[room] = message_ids[-1]
+    # 観戦者のバッファには保存と同時に（間にawaitを挟まずに）追加し、ストレージからの読み直しと矛盾しないようにする
+    publish_to_feed(room, messages)
+
+    await broadcast_messages(room, messages)
+    for full_message in messages:
+        # ブロードキャスト完了の時点ではフレームは送信済みのため、マークはトレースにのみ記録する
+        tracer.mark(full_message, "broadcast", carry=False)
+    for full_message in messages:
+        await schedule_turn(room, full_message)
+
+def build_message(message: MessageIn, room: Optional[str] = None) -> Dict[str, Any]:
+    """投稿されたメッセージに受信時刻を付け、ルーティングに使う完全なメッセージを作ります。"""
+    return {
+        "room": message.room or room,
+        "sender": message.sender or "unknown",
+        "message": message.message or "",
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "type": message.type,
+        "to": message.to,
+        "trace_id": message.trace_id,
+    }
+
+# 1回のリクエストで返すメッセージ数の上限
+MAX_PAGE_SIZE = 500
+
+def get_feed(room: str) -> RoomFeed:
+    """ルームの観戦者向けのイベントバッファを返します（なければ現在の最新IDから作成する）。"""
+    feed = room_feeds.get(room)
+    if feed is None:
+        feed = room_feeds[room] = RoomFeed(room, latest_message_id(room) or 0)
+    return feed
+
+def publish_to_feed(room: str, messages: List[Dict[str, Any]]):
+    """観戦者がいるルームでは、保存したメッセージをSSEのイベントとして一度だけエンコードしてバッファに追加します。"""
+    feed = room_feeds.get(room)
+    if feed is None:
+        return
+    for message in messages:
+        feed.publish(encode_event(json.dumps(message, ensure_ascii=False, separators=(",", ":")), message["id"]),
+                     message["id"])
+
+def backfill_events(room: str, after_id: int) -> List[Tuple[int, bytes]]:
+    """バッファにない範囲のメッセージを、ストレージから1ページ分SSEのイベントとして読み直します。"""
+    page = json.loads(get_storage().get_messages_json(room, limit=MAX_PAGE_SIZE, after_id=after_id))
+    return [
+        (message["id"], encode_event(json.dumps(message, ensure_ascii=False, separators=(",", ":")), message["id"]))
+        for message in page
     ]
-    return messages
+
+async def watch_feed(room: str, after_id: Optional[int]):
+    """観戦者1人分のSSEのストリーム。切断されたら観戦者の数を減らし、誰もいなくなったバッファは破棄します。"""
+    feed = get_feed(room)
+    feed.watchers += 1
+    admission.open_connection(room)
+    try:
+        async for chunk in stream_events(feed, after_id, lambda last_id: backfill_events(room, last_id)):
+            yield chunk
+    finally:
+        admission.close_connection(room)
+        feed.watchers -= 1
+        if feed.watchers == 0 and room_feeds.get(room) is feed:
+            del room_feeds[room]
+
+@app.get("/api/messages", response_model=List[ChatMessage])
+async def get_messages(request: Request, room: str, limit: int = 100,
+                       after_id: Optional[int] = None, before_id: Optional[int] = None) -> Response:
+    """
+    特定のチャットルームの過去のメッセージを取得します。
+    after_id を指定するとそれ以降の新しいメッセージ（差分）を、
+    before_id を指定するとそれより古いメッセージ（過去ページ）を返します。
+    ETagはルームの最新メッセージIDから計算するため、新しいメッセージがなければ304を返します。
+    本文はストレージが行から直接生成したJSONをそのまま返します。
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    latest = latest_message_id(room)
+    if before_id is not None and latest is not None and before_id <= latest:
+        # 既存のメッセージより前のページは今後変わらない
+        etag = make_etag(get_storage().identity, room, limit, "before", before_id)
+        cache_control = CACHE_IMMUTABLE
+    else:
+        etag = make_etag(get_storage().identity, room, limit, after_id, before_id, latest)
+        cache_control = CACHE_REVALIDATE
+
+    return cached_json_response(
+        request, etag,
+        lambda: get_storage().get_messages_json(room, limit=limit, after_id=after_id, before_id=before_id),
+        cache_control,
+    )
+
+# ブートストラップで返す直近メッセージ数の上限
+MAX_BOOTSTRAP_MESSAGES = 200
+
+@app.get("/api/bootstrap")
+async def get_bootstrap(request: Request, room: str, limit: int = 20, summary: bool = False) -> Response:
+    """
+    エージェントの起動時に使うコンテキストのスナップショットを返します。
+    システムメッセージを除いた直近 limit 件のメッセージと、summary=true の場合は
+    それより前の会話の要約を1回のリクエストで返します。
+    """
+    limit = max(1, min(limit, MAX_BOOTSTRAP_MESSAGES))
+    latest = latest_message_id(room)
+    etag = make_etag(get_storage().identity, "bootstrap", room, limit, summary, latest)
+
+    def load_snapshot() -> bytes:
+        storage = get_storage()
+        recent = storage.get_messages(room, limit=limit, exclude_types=EXCLUDED_TYPES)
+        summary_text = None
+        if summary and recent:
+            boundary_id = recent[0]["id"]
+            found, summary_text = room_summaries.get(room, boundary_id)
+            if not found:
+                older = storage.get_messages(room, limit=SUMMARY_SOURCE_LIMIT,
+                                             before_id=boundary_id, exclude_types=EXCLUDED_TYPES)
+                summary_text = build_summary(older)
+                room_summaries.put(room, boundary_id, summary_text)
+        # メッセージは履歴APIと同じ形式（ChatMessage）で一括してシリアライズする
+        head = json.dumps({"room": room, "last_id": latest, "summary": summary_text},
+                          ensure_ascii=False, separators=(",", ":"))
+        return head[:-1].encode("utf-8") + b',"messages":' + encode_messages(recent, room=room) + b"}"
+
+    return cached_json_response(request, etag, load_snapshot)
+
+@app.get("/api/blobs/{key}")
+async def get_blob(request: Request, key: str) -> Response:
+    """
+    ブロブとして保存した本文の全文を返します（text/plain）。
+    内容はハッシュで決まり変わらないため、永続的にキャッシュでき、ETagにはハッシュを使います。
+    保存済みのgzipの本文は、クライアントが対応していればそのまま返します。
+    """
+    # 存在しないブロブには If-None-Match（"*" を含む）に関わらず404を返す
+    if not get_blob_store().exists(key):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Blob not found")
+    headers = {"Cache-Control": CACHE_IMMUTABLE, "Vary": "Accept-Encoding"}
+    matched = match_etag(request.headers.get("if-none-match"), key)
+    if matched is not None:
+        headers["ETag"] = matched
+        return Response(status_code=304, headers=headers)
+    compressed = get_blob_store().get_compressed(key)
+    if compressed is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Blob not found")
+    if accepted_encodings(request.headers.get("accept-encoding")) & {"gzip", "*"}:
+        headers.update({"ETag": f'"{key}-gz"', "Content-Encoding": "gzip"})
+        body = compressed
+    else:
+        headers["ETag"] = f'"{key}"'
+        body = gzip.decompress(compressed)
+    return Response(content=body, media_type="text/plain; charset=utf-8", headers=headers)
 
 @app.post("/api/message")
-async def post_message(message: Dict[str, Any]):
+async def post_message(message: MessageIn):
     """
     新しいメッセージを投稿し、データベースに保存してWebSocketクライアントにブロードキャストします。
     """
-    room = message.get("room")
-    sender = message.get("sender")
-    message_content = message.get("message")
-    message_type = message.get("type", "chat") # デフォルトは'chat'
-    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-    if not all([room, sender, message_content]):
+    if not all([message.room, message.sender, message.message]):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Missing room, sender, or message"
         )
+    # 投稿はミドルウェアで人間の投稿として受け入れているため、エージェントの投稿は過負荷の状態で改めて判定する
+    if is_agent_sender(message.room, message.sender):
+        rejected = admission.check_overload("agent")
+        if rejected is not None:
+            raise overloaded_error(rejected)
 
-    # app.state.db_pathからデータベースパスを取得
-    conn = db.get_db(app.state.db_path)
-    db.add_message(conn, room, sender, message_content, message_type, timestamp)
-    conn.close()
-
-    full_message = {
-        "room": room,
-        "sender": sender,
-        "message": message_content,
-        "timestamp": timestamp,
-        "type": message_type
-    }
-    await broadcast_message(room, full_message)
+    await ingest_message(build_message(message), parent_trace_id=message.parent_trace_id)
     return {"status": "ok"}
 
+@app.get("/api/rooms/{room}/stream")
+async def stream_room(request: Request, room: str, after_id: Optional[int] = None) -> StreamingResponse:
+    """
+    ルームのメッセージとプレゼンスを読み取り専用のServer-Sent Eventsで配信します（観戦者向け）。
+    再接続時にブラウザが送る Last-Event-ID、または after_id より後のメッセージから再開します。
+    観戦者はエージェントの接続とは別に管理され、参加者の一覧にも含まれません。
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        try:
+            after_id = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Last-Event-ID")
+    rejected = admission.check_connection(room, "observer")
+    if rejected is not None:
+        raise overloaded_error(rejected)
+    return StreamingResponse(
+        watch_feed(room, after_id),
+        media_type="text/event-stream",
+        # プロキシ（nginxなど）にバッファさせない
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/api/agents")
-async def get_agents(room: str):
+async def get_agents(request: Request, room: str) -> Response:
     """
     指定されたチャットルームに参加しているエージェントのリストを取得します。
+    ETagは接続の集合のバージョンから計算するため、参加者に変化がなければ304を返します。
     """
-    if room not in active_connections:
-        return []
-    # agent_name のリストを返す
-    return list(active_connections[room].keys())
+    etag = make_etag(_instance_id, "agents", room, presence.version(room))
+    # 接続・切断のたびに更新しているスナップショットを返す
+    return cached_json_response(request, etag, lambda: list(presence.agents(room)))
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, room: str, agent: str = "human"):
+async def websocket_endpoint(websocket: WebSocket, room: Optional[str] = None, agent: str = "human",
+                             subscribe: Optional[str] = None, batch: bool = False, rooms: Optional[str] = None):
     """
     WebSocket接続を処理し、リアルタイムメッセージ通信を可能にします。
     agentクエリパラメータを受け取るように変更。
+    subscribeクエリパラメータ（例: "mentions,humans"）で受信するメッセージを絞り込めます。
+    batch=1 を指定すると、活発なルームで短い間隔に届いたメッセージを1つのバッチのフレームで受け取ります。
+    room の代わりに rooms（例: "design,project-*"）を指定すると、1つの接続で複数のルームに参加します。
+    パターンに一致するルームには、接続時に活動中のルームと、その後に最初のメッセージが届いたルームに参加します。
+    この場合、送信するメッセージには参加しているルームの room を指定します。
     """
-    await websocket.accept()
-    if room not in active_connections:
-        active_connections[room] = {}
-    active_connections[room][agent] = websocket
-    print(f"WebSocket connected: {agent} to room '{room}'")
+    multi = rooms is not None
+    try:
+        filters = parse_subscription(subscribe)
+        names, patterns = parse_room_spec(rooms) if multi else ([room] if room else [], [])
+    except ValueError as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+        return
+    if not names and not patterns:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Missing room or rooms")
+        return
+    # 複数のルームに参加する接続は、指定（rooms）を1つのルームとして接続数を数える
+    admission_room = rooms if multi else room
 
-    # 接続時に既存のメッセージを送信（オプション、Web UIがGET /api/messagesを呼ぶためここでは不要）
+    # Web UIなどの観察者はエージェントより先に断る
+    rejected = admission.check_connection(admission_room, "observer" if agent == OBSERVER_NAME else "agent")
+    if rejected is not None:
+        # クローズコードを届けるため、いったん受け入れてから1013（Try Again Later）で閉じる
+        await websocket.accept()
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=f"Server is overloaded ({rejected[0]})")
+        return
 
+    await websocket.accept()
+    if multi:
+        connection_rooms[websocket] = set()
+    for name in names:
+        await join_room(name, agent, websocket, filters, batch)
+    if patterns:
+        room_patterns[websocket] = (agent, tuple(patterns), filters, batch)
+        for name in sorted(active_rooms()):
+            if name not in names and room_matches(name, patterns):
+                await join_room(name, agent, websocket, filters, batch)
+
+    admission.open_connection(admission_room)
     try:
         while True:
             # クライアントからのメッセージをリッスン（エージェントが利用）
-            data = await websocket.receive_json()
-            
-            # WebSocket経由で受信したメッセージにもタイムスタンプを追加し、完全なメッセージオブジェクトを構築
-            received_room = data.get("room", room)
-            sender = data.get("sender", "unknown")
-            message_content = data.get("message", "")
-            message_type = data.get("type", "chat")
-            timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-            full_message = {
-                "room": received_room,
-                "sender": sender,
-                "message": message_content,
-                "timestamp": timestamp,
-                "type": message_type
-            }
-            
-            # データベースに保存（WebSocket経由のメッセージも保存する）
-            # app.state.db_pathからデータベースパスを取得
-            conn = db.get_db(app.state.db_path)
-            db.add_message(conn, received_room, sender, message_content, message_type, timestamp)
-            conn.close()
-
-            # 受信したメッセージを他のクライアントにブロードキャスト
-            await broadcast_message(received_room, full_message)
+            raw = await websocket.receive_text()
+            for joined in (connection_rooms.get(websocket, ()) if multi else (room,)):
+                presence.touch(joined, agent)
+            try:
+                data = MessageIn.model_validate_json(raw)
+            except ValidationError as e:
+                logger.warning("Ignoring invalid frame from %s in room '%s': %s", agent, admission_room,
+                               e.errors()[0].get("msg"))
+                continue
+            if data.type == "control":
+                # ハートビートへの応答（pong）などの制御フレームは最終受信時刻の更新のみ。
+                # pongを返した接続は、以後応答しなくなったら切断の対象にする
+                if data.action == "pong":
+                    heartbeat_clients.add(websocket)
+                continue
+            if multi and not (data.room in names or (data.room and room_matches(data.room, patterns))):
+                logger.warning("Ignoring frame from %s for room '%s' outside of '%s'", agent, data.room, rooms)
+                continue
+
+            # 受信時刻を付けてルームのアクターに渡す（WebSocket経由のメッセージも保存する）。
+            # 保存と配信の完了は待たずに次のフレームを受信し、同じ時間帯のメッセージをまとめられるようにする
+            await ingest_message(build_message(data, room), parent_trace_id=data.parent_trace_id, wait=False)
 
     except Exception as e:
-            print(f"WebSocket disconnected from room '{room}' agent '{agent}': {e}")
+            logger.info("WebSocket disconnected from room '%s' agent '%s': %s", admission_room, agent, e)
     finally:
-            # 接続がクローズされたら辞書から削除
-            if room in active_connections and agent in active_connections[room]:
-                del active_connections[room][agent]
-                if not active_connections[room]:
-                    del active_connections[room]
+            # 接続がクローズされたら辞書から削除（ハートビートで切断済みの場合は何もしない）
+            admission.close_connection(admission_room)
+            room_patterns.pop(websocket, None)
+            heartbeat_clients.discard(websocket)
+            for joined in (sorted(connection_rooms.pop(websocket, ())) if multi else (room,)):
+                await drop_connection(joined, agent, websocket)
 
 # 静的ファイルを提供するための設定
 # この行は、他の具体的なルート（/api/*, /ws）の後に置く必要があります。
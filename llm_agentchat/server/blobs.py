@@ -0,0 +1,88 @@
+# 大きなメッセージ本文のためのコンテンツアドレス型ブロブストア
+#
+# しきい値（BLOB_THRESHOLD バイト）を超える本文（長いコードの貼り付けやLLM・ツールの出力）は、
+# メッセージの行には先頭のプレビューだけを保存し、本文はSHA-256をキーにしたファイルとして
+# ストレージの隣のディレクトリ（<保存先>.blobs）に一度だけ保存します。
+#   <root>/<ハッシュの先頭2文字>/<ハッシュ>.gz  gzip圧縮した本文
+# 同じ本文は同じハッシュになるため重複して保存されず、内容が変わらないので
+# /api/blobs/{hash} の応答は永続的にキャッシュできます。
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional
+
+BLOB_THRESHOLD = 4096 # これより大きい本文（UTF-8のバイト数）をブロブとして保存する
+PREVIEW_CHARS = 500 # 配信・履歴に含めるプレビューの文字数
+BLOB_SUFFIX = ".gz"
+
+_HASH = re.compile(r"[0-9a-f]{64}")
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def is_blob_hash(value: str) -> bool:
+    """SHA-256の16進文字列（ブロブのキー）かどうかを返します。"""
+    return bool(_HASH.fullmatch(value))
+
+def make_preview(text: str, chars: int = PREVIEW_CHARS) -> str:
+    """本文の先頭 chars 文字のプレビューを返します（省略した場合は末尾に「…」を付ける）。"""
+    if len(text) <= chars:
+        return text
+    return text[:chars].rstrip() + "…"
+
+class BlobStore:
+    """本文をSHA-256のハッシュで保存・取得するブロブストア。書き込みは一時ファイルからの置き換えで行います。"""
+
+    def __init__(self, root: str, compresslevel: int = 6):
+        self.root = root
+        self.compresslevel = compresslevel
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + BLOB_SUFFIX)
+
+    def put(self, data: bytes) -> str:
+        """本文を保存してハッシュを返します。同じ本文がすでにあれば書き込みません。"""
+        key = blob_hash(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                # mtime=0 で同じ本文からは同じバイト列になるようにする
+                f.write(gzip.compress(data, compresslevel=self.compresslevel, mtime=0))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return key
+
+    def exists(self, key: str) -> bool:
+        """ブロブが保存されているかどうかを返します（本文は読み込まない）。"""
+        return is_blob_hash(key) and os.path.exists(self._path(key))
+
+    def get_compressed(self, key: str) -> Optional[bytes]:
+        """gzip圧縮されたままの本文を返します。存在しない場合（不正なキーを含む）はNoneを返します。"""
+        if not is_blob_hash(key):
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, key: str) -> Optional[bytes]:
+        """本文を返します。存在しない場合はNoneを返します。"""
+        compressed = self.get_compressed(key)
+        return gzip.decompress(compressed) if compressed is not None else None
+
+def blob_root_for(storage_path: str) -> str:
+    """ストレージの保存先（SQLiteのファイルまたはログのディレクトリ）に対応するブロブのディレクトリを返します。"""
+    if storage_path == ":memory:":
+        # インメモリのデータベース（テストなど）ではプロセスごとの一時ディレクトリを使う
+        return os.path.join(tempfile.gettempdir(), f"agentchat-blobs-{os.getpid()}")
+    return os.path.normpath(storage_path) + ".blobs"
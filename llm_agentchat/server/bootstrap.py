@@ -0,0 +1,54 @@
+# エージェントのウォームスタート用のコンテキストスナップショット
+#
+# 起動したばかりのエージェントが1回のリクエストで会話の文脈を取得できるように、
+# 直近のメッセージと、それより前の会話の簡単な要約を作成します。
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+# スナップショットから除外するメッセージの種類（参加通知などはLLMの文脈に不要）
+EXCLUDED_TYPES = ("system", "control")
+
+# 要約の対象にする、直近ウィンドウより前のメッセージ数の上限
+SUMMARY_SOURCE_LIMIT = 200
+# 要約に含める発言の行数と1行あたりの文字数
+SUMMARY_MAX_LINES = 10
+SUMMARY_LINE_CHARS = 160
+
+def build_summary(messages: List[Dict[str, Any]], max_lines: int = SUMMARY_MAX_LINES,
+                  line_chars: int = SUMMARY_LINE_CHARS) -> Optional[str]:
+    """
+    メッセージ（古い順）から、参加者ごとの発言数と最近の発言の冒頭をまとめた要約を作成します。
+    LLMを使わずに作成できる簡易的な要約で、メッセージがなければNoneを返します。
+    """
+    if not messages:
+        return None
+    counts = Counter(msg.get("sender") for msg in messages)
+    participants = ", ".join(f"{sender} ({count})" for sender, count in counts.most_common())
+    lines = [f"Earlier in this room: {len(messages)} messages from {participants}."]
+    for msg in messages[-max_lines:]:
+        text = " ".join(str(msg.get("message_content") or "").split())
+        if len(text) > line_chars:
+            text = text[:line_chars - 1] + "…"
+        lines.append(f"- {msg.get('sender')}: {text}")
+    return "\n".join(lines)
+
+class SummaryCache:
+    """
+    ルームごとの要約を保持するキャッシュ。
+    要約の対象範囲（直近ウィンドウの先頭ID）が変わらない限り再計算しません。
+    """
+    def __init__(self):
+        self._entries: Dict[str, Tuple[Any, Optional[str]]] = {}
+
+    def get(self, room: str, boundary_id: Any) -> Tuple[bool, Optional[str]]:
+        """(キャッシュにあったか, 要約) を返します。"""
+        entry = self._entries.get(room)
+        if entry is not None and entry[0] == boundary_id:
+            return True, entry[1]
+        return False, None
+
+    def put(self, room: str, boundary_id: Any, summary: Optional[str]):
+        self._entries[room] = (boundary_id, summary)
+
+    def clear(self):
+        self._entries.clear()
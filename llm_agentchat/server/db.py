@@ -1,10 +1,10 @@
 import sqlite3
 import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 
-def get_db(db_path: str) -> sqlite3.Connection:
+def get_db(db_path: str, check_same_thread: bool = True) -> sqlite3.Connection:
     """データベース接続を取得します。"""
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -18,29 +18,114 @@ def init_db(conn: sqlite3.Connection):
         sender TEXT NOT NULL,
         message_content TEXT NOT NULL,
         timestamp TEXT NOT NULL,
-        message_type TEXT NOT NULL
+        message_type TEXT NOT NULL,
+        blob_hash TEXT
     )
     """)
+    # 以前のバージョンで作成したデータベースには本文のブロブへの参照の列を追加する
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(messages)")}
+    if "blob_hash" not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN blob_hash TEXT")
     # メッセージ検索を高速化するためのインデックスを作成
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_room_name_timestamp ON messages (room_name, timestamp)")
+    # IDによるページング（差分同期・過去ページの読み込み）用のインデックス
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_room_name_id ON messages (room_name, id)")
     conn.commit()
 
-def add_message(conn: sqlite3.Connection, room_name: str, sender: str, message: str, message_type: str, timestamp: str):
-    """メッセージをデータベースに追加します。"""
+def add_message(conn: sqlite3.Connection, room_name: str, sender: str, message: str, message_type: str, timestamp: str,
+                blob: Optional[str] = None) -> int:
+    """
+    メッセージをデータベースに追加し、割り当てられたIDを返します。
+    blob には本文をブロブストアに保存した場合のハッシュを指定します（message はそのプレビュー）。
+    """
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO messages (room_name, sender, message_content, message_type, timestamp) VALUES (?, ?, ?, ?, ?)",
-        (room_name, sender, message, message_type, timestamp)
+        "INSERT INTO messages (room_name, sender, message_content, message_type, timestamp, blob_hash) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (room_name, sender, message, message_type, timestamp, blob)
     )
     conn.commit()
+    return cursor.lastrowid
 
-def get_messages_for_room(conn: sqlite3.Connection, room_name: str, limit: int = 100) -> List[Dict[str, Any]]:
-    """指定されたルームのメッセージを取得します。"""
+def add_messages(conn: sqlite3.Connection, room_name: str,
+                 messages: Sequence[Tuple[str, str, str, str, Optional[str]]]) -> List[int]:
+    """
+    (sender, message, message_type, timestamp, blob) のリストを1つのトランザクションで追加し、
+    割り当てられたIDのリストを返します。
+    """
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT sender, message_content, timestamp, message_type FROM messages WHERE room_name = ? ORDER BY timestamp ASC LIMIT ?",
-        (room_name, limit)
-    )
+    ids = []
+    try:
+        for sender, message, message_type, timestamp, blob in messages:
+            cursor.execute(
+                "INSERT INTO messages (room_name, sender, message_content, message_type, timestamp, blob_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (room_name, sender, message, message_type, timestamp, blob)
+            )
+            ids.append(cursor.lastrowid)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return ids
+
+def _page_query(columns: str, after_id: Optional[int], before_id: Optional[int],
+                exclude_types: Sequence[str]) -> tuple:
+    """ページ取得のSQL（IDの昇順）と、room_name と limit 以外のパラメータを返します。"""
+    type_filter = ""
+    if exclude_types:
+        type_filter = f" AND message_type NOT IN ({', '.join('?' for _ in exclude_types)})"
+    if after_id is not None:
+        sql = (f"SELECT {columns} FROM messages "
+               f"WHERE room_name = ? AND id > ?{type_filter} ORDER BY id ASC LIMIT ?")
+        return sql, (after_id, *exclude_types)
+    sql = (f"SELECT * FROM (SELECT {columns} FROM messages "
+           f"WHERE room_name = ? AND id < ?{type_filter} ORDER BY id DESC LIMIT ?) ORDER BY id ASC")
+    return sql, (before_id if before_id is not None else 2**63 - 1, *exclude_types)
+
+def get_messages_for_room(conn: sqlite3.Connection, room_name: str, limit: int = 100,
+                          after_id: Optional[int] = None, before_id: Optional[int] = None,
+                          exclude_types: Sequence[str] = ()) -> List[Dict[str, Any]]:
+    """
+    指定されたルームのメッセージをID（投稿順）の昇順で取得します。
+    - after_id を指定すると、そのIDより新しいメッセージを古い順に最大 limit 件返します（差分同期用）。
+    - それ以外は最新の limit 件（before_id 指定時はそのIDより古いもの）を返します（過去ページの読み込み用）。
+    - exclude_types に指定した種類のメッセージ（例: "system"）は除外します。
+    """
+    page_sql, params = _page_query("id, sender, message_content, timestamp, message_type, blob_hash AS blob",
+                                   after_id, before_id, exclude_types)
+    cursor = conn.cursor()
+    cursor.execute(page_sql, (room_name, *params, limit))
+    rows = cursor.fetchall()
     # sqlite3.Rowオブジェクトを辞書に変換します
-    messages = [dict(row) for row in cursor.fetchall()]
+    messages = [dict(row) for row in rows]
     return messages
+
+# APIの形式のメッセージ（ブロブへの参照がある場合のみ blob キーを含める）
+_MESSAGE_OBJECT = ("'id', id, 'room', ?, 'sender', sender, 'message', message_content, "
+                   "'timestamp', timestamp, 'type', message_type")
+
+def get_messages_json(conn: sqlite3.Connection, room_name: str, limit: int = 100,
+                      after_id: Optional[int] = None, before_id: Optional[int] = None) -> bytes:
+    """
+    get_messages_for_room と同じメッセージを、APIの形式（id, room, sender, message, timestamp, type）の
+    JSON配列としてSQLiteのJSON関数で直接生成して返します（Pythonの辞書を経由しない）。
+    """
+    page_sql, params = _page_query("id, sender, message_content, timestamp, message_type, blob_hash",
+                                   after_id, before_id, ())
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT COALESCE(json_group_array(CASE WHEN blob_hash IS NULL "
+        f"THEN json_object({_MESSAGE_OBJECT}) "
+        f"ELSE json_object({_MESSAGE_OBJECT}, 'blob', blob_hash) END), '[]') "
+        f"FROM ({page_sql})",
+        (room_name, room_name, room_name, *params, limit)
+    )
+    return cursor.fetchone()[0].encode("utf-8")
+
+def get_latest_message_id(conn: sqlite3.Connection, room_name: str) -> Optional[int]:
+    """指定されたルームの最新メッセージのIDを返します。メッセージがない場合はNoneを返します。"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(id) FROM messages WHERE room_name = ?", (room_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
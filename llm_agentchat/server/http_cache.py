@@ -0,0 +1,136 @@
+# HTTPキャッシュと圧縮のヘルパー
+#
+# ポーリングされるAPI（/api/messages, /api/agents）向けに、強いETagによる条件付きリクエスト（304）、
+# Accept-Encodingに応じたgzip/brotli圧縮、Cache-Controlヘッダーを付けたレスポンスを作成します。
+import gzip
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from fastapi import Request, Response
+
+try:
+    import brotli # 任意依存（未インストールならgzipのみ使用）
+except ImportError:
+    brotli = None
+
+# これより小さいレスポンスは圧縮しない（圧縮のコストとヘッダーのオーバーヘッドの方が大きい）
+MIN_COMPRESS_SIZE = 1024
+
+# 変更されうるリソースは毎回再検証させる（変更がなければ304で本文を送らない）
+CACHE_REVALIDATE = "no-cache"
+# 内容が変わらないリソース（過去ページなど）
+CACHE_IMMUTABLE = "private, max-age=31536000, immutable"
+
+_ENCODING_SUFFIX = {"br": "-br", "gzip": "-gz", "identity": ""}
+
+def accepted_encodings(accept_encoding: Optional[str]) -> Set[str]:
+    """Accept-Encodingヘッダーで受け入れられている圧縮方式（小文字、"*" を含む）の集合を返します。"""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        # q=0 は明示的な拒否
+        if params.replace(" ", "").lower() in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token)
+    return accepted
+
+def choose_encoding(accept_encoding: Optional[str]) -> str:
+    """Accept-Encodingヘッダーから使用する圧縮方式（br / gzip / identity）を選びます。"""
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return "identity"
+
+def make_etag(*parts: Any) -> str:
+    """リソースを識別する値（ルーム名、最新メッセージIDなど）から、引用符を含まないETagの値を作ります。"""
+    key = "\x1f".join(str(part) for part in parts)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+
+def match_etag(if_none_match: Optional[str], etag: str) -> Optional[str]:
+    """
+    If-None-MatchヘッダーがETag（圧縮方式ごとの派生も含む）に一致する場合、一致したタグを返します。
+    一致しない場合はNoneを返します。
+    """
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == "*":
+        return f'"{etag}"'
+    candidates = {f'"{etag}{suffix}"' for suffix in _ENCODING_SUFFIX.values()}
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in candidates:
+            return tag
+    return None
+
+class EncodedBodyCache:
+    """ETagと圧縮方式をキーに、シリアライズ・圧縮済みの本文を保持するLRUキャッシュ。"""
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[bytes, str]]" = OrderedDict()
+
+    def get(self, etag: str, encoding: str) -> Optional[Tuple[bytes, str]]:
+        """本文と実際に適用された圧縮方式を返します。キャッシュにない場合はNoneを返します。"""
+        key = (etag, encoding)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, etag: str, encoding: str, entry: Tuple[bytes, str]):
+        self._entries[(etag, encoding)] = entry
+        self._entries.move_to_end((etag, encoding))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+body_cache = EncodedBodyCache()
+
+def encode_body(payload: Any, encoding: str) -> Tuple[bytes, str]:
+    """
+    ペイロードをJSONにシリアライズし、しきい値以上なら圧縮します。
+    シリアライズ済みのJSON（bytes）はそのまま使います。実際に適用した圧縮方式と本文を返します。
+    """
+    if isinstance(payload, bytes):
+        body = payload
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(body) < MIN_COMPRESS_SIZE or encoding == "identity":
+        return body, "identity"
+    if encoding == "br":
+        return brotli.compress(body, quality=5), "br"
+    return gzip.compress(body, compresslevel=6), "gzip"
+
+def cached_json_response(request: Request, etag: str, build_payload: Callable[[], Any], cache_control: str = CACHE_REVALIDATE) -> Response:
+    """
+    ETag付きのJSONレスポンスを返します。etagは make_etag で作成した、リソースごとに一意な値です。
+    If-None-Matchが一致した場合は build_payload を呼ばずに304を返し、
+    同じETagの本文は圧縮済みのものを再利用します。
+    """
+    headers: Dict[str, str] = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    matched = match_etag(request.headers.get("if-none-match"), etag)
+    if matched is not None:
+        headers["ETag"] = matched
+        return Response(status_code=304, headers=headers)
+
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    entry = body_cache.get(etag, encoding)
+    if entry is None:
+        entry = encode_body(build_payload(), encoding)
+        body_cache.put(etag, encoding, entry)
+    body, applied = entry
+
+    headers["ETag"] = f'"{etag}{_ENCODING_SUFFIX[applied]}"'
+    if applied != "identity":
+        headers["Content-Encoding"] = applied
+    return Response(content=body, media_type="application/json", headers=headers)
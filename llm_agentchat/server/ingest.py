@@ -0,0 +1,130 @@
+# ルームごとの受信処理（インジェスト）アクター
+#
+# ルームごとに1つのタスクが、受信したメッセージをキューから受信順に取り出して保存と配信を行います。
+# HTTP と WebSocket のどちらから受信したメッセージも同じキューを通るため、
+# ルーム内では保存されたIDの順序と配信の順序が常に一致します。
+# 会話が活発なルーム（直前のメッセージから hot_gap 秒以内に次のメッセージが届いた）では、
+# 最初のメッセージから window 秒の間に届いたメッセージ（最大 max_batch 件）を1つのバッチにまとめ、
+# 保存は1回のトランザクション、配信はバッチに対応したクライアントには1つのフレームで行います。
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_WINDOW = 0.005 # まとめるメッセージを待つ時間（秒）
+MAX_BATCH = 64 # 1つのバッチにまとめるメッセージ数の上限
+HOT_GAP = 0.05 # 直前のメッセージとの間隔がこれより短ければ活発なルームとみなす（秒）
+IDLE_TIMEOUT = 60.0 # メッセージが届かないまま経過したらタスクを終了する時間（秒）
+MAX_PENDING = 1000 # キューに溜められるメッセージ数（満杯なら受信側を待たせる）
+
+# (メッセージ, 処理の完了を通知するFuture, 受信時刻)
+Pending = Tuple[Dict[str, Any], Optional[asyncio.Future], float]
+BatchHandler = Callable[[str, List[Dict[str, Any]]], Awaitable[None]]
+
+class RoomIngestor:
+    """
+    1つのルームの受信処理を行うアクター。submit() でキューに追加したメッセージを、
+    handler(room, messages) に受信順のバッチとして渡します。handler はバッチを保存・配信します。
+    """
+
+    def __init__(self, room: str, handler: BatchHandler, window: float = DEFAULT_BATCH_WINDOW,
+                 max_batch: int = MAX_BATCH, hot_gap: float = HOT_GAP, idle_timeout: float = IDLE_TIMEOUT,
+                 max_pending: int = MAX_PENDING, on_exit: Optional[Callable[["RoomIngestor"], None]] = None):
+        self.room = room
+        self.handler = handler
+        self.window = window
+        self.max_batch = max_batch
+        self.hot_gap = hot_gap
+        self.idle_timeout = idle_timeout
+        self.on_exit = on_exit
+        self.loop = asyncio.get_running_loop()
+        self.queue: "asyncio.Queue[Pending]" = asyncio.Queue(max_pending)
+        self.batches = 0 # 処理したバッチ数
+        self.messages = 0 # 処理したメッセージ数
+        self._last_arrival = 0.0
+        self.task = asyncio.create_task(self._run(), name=f"ingest {room}")
+
+    def is_alive(self) -> bool:
+        """タスクが実行中で、現在のイベントループに属しているかどうかを返します。"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        return not self.task.done() and running is self.loop
+
+    async def submit(self, message: Dict[str, Any], wait: bool = True) -> Optional[asyncio.Future]:
+        """
+        メッセージをキューに追加します。wait=True の場合は、処理の完了時にメッセージIDが設定される
+        Futureを返します。キューが満杯の場合は空きができるまで待ちます。
+        """
+        future = self.loop.create_future() if wait else None
+        await self.queue.put((message, future, time.monotonic()))
+        return future
+
+    async def _next_batch(self) -> Optional[List[Pending]]:
+        """次のバッチを取り出します。idle_timeout 秒の間メッセージが届かなければNoneを返します。"""
+        try:
+            first = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            return None
+        batch = [first]
+        hot = first[2] - self._last_arrival < self.hot_gap
+        if hot and self.window > 0:
+            # 活発なルームでは、最初のメッセージの受信から window 秒の間に届くメッセージを待つ
+            remaining = first[2] + self.window - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+        # すでにキューに溜まっているメッセージは待たずにまとめる
+        while len(batch) < self.max_batch and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        self._last_arrival = batch[-1][2]
+        return batch
+
+    async def _run(self):
+        try:
+            while True:
+                batch = await self._next_batch()
+                if batch is None:
+                    if self.queue.empty():
+                        break
+                    continue
+                messages = [message for message, _, _ in batch]
+                try:
+                    await self.handler(self.room, messages)
+                except Exception as e:
+                    logger.exception("Failed to ingest %d message(s) in room '%s'", len(messages), self.room)
+                    for _, future, _ in batch:
+                        if future is not None and not future.done():
+                            future.set_exception(e)
+                else:
+                    for message, future, _ in batch:
+                        if future is not None and not future.done():
+                            future.set_result(message.get("id"))
+                self.batches += 1
+                self.messages += len(batch)
+                for _ in batch:
+                    self.queue.task_done()
+        finally:
+            # 処理されずに残ったメッセージ（停止時）の送信元を待たせたままにしない
+            while not self.queue.empty():
+                _, future, _ = self.queue.get_nowait()
+                self.queue.task_done()
+                if future is not None and not future.done():
+                    future.cancel()
+            if self.on_exit is not None:
+                self.on_exit(self)
+
+    async def stop(self, timeout: float = 1.0):
+        """キューに残ったメッセージの処理を最大 timeout 秒待ってからタスクを停止します。"""
+        if not self.task.done():
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Dropping %d pending message(s) in room '%s' on shutdown", self.queue.qsize(), self.room)
+            self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
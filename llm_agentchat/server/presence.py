@@ -0,0 +1,70 @@
+# ルームごとの在室状況（プレゼンス）の管理
+#
+# 接続・切断のたびにスナップショットを更新しておき、/api/agents は計算せずにそれを返します。
+# 各接続の最終受信時刻も記録し、ハートビートに応答しない接続を検出します。
+import time
+from typing import Dict, List, Optional, Tuple
+
+class PresenceTracker:
+    """ルームごとの参加者のスナップショット、バージョン、最終受信時刻を管理します。"""
+
+    def __init__(self):
+        self._members: Dict[str, Dict[str, float]] = {} # {room: {name: last_seen}}（参加順）
+        self._snapshots: Dict[str, Tuple[str, ...]] = {}
+        self._versions: Dict[str, int] = {}
+
+    def join(self, room: str, name: str, now: Optional[float] = None):
+        """参加者を追加します（同名の再接続の場合は最終受信時刻のみ更新）。"""
+        members = self._members.setdefault(room, {})
+        is_new = name not in members
+        members[name] = time.monotonic() if now is None else now
+        if is_new:
+            self._changed(room)
+
+    def leave(self, room: str, name: str) -> bool:
+        """参加者を削除します。削除した場合はTrueを返します。"""
+        members = self._members.get(room)
+        if members is None or name not in members:
+            return False
+        del members[name]
+        if not members:
+            del self._members[room]
+        self._changed(room)
+        return True
+
+    def touch(self, room: str, name: str, now: Optional[float] = None):
+        """参加者からフレームを受信した時刻を記録します。"""
+        members = self._members.get(room)
+        if members is not None and name in members:
+            members[name] = time.monotonic() if now is None else now
+
+    def _changed(self, room: str):
+        self._versions[room] = self._versions.get(room, 0) + 1
+        members = self._members.get(room)
+        if members:
+            self._snapshots[room] = tuple(members)
+        else:
+            self._snapshots.pop(room, None)
+
+    def agents(self, room: str) -> Tuple[str, ...]:
+        """ルームの参加者のスナップショットを返します（O(1)）。"""
+        return self._snapshots.get(room, ())
+
+    def version(self, room: str) -> int:
+        """参加者の集合が変わるたびに増加するバージョンを返します。"""
+        return self._versions.get(room, 0)
+
+    def idle(self, timeout: float, now: Optional[float] = None) -> List[Tuple[str, str]]:
+        """最後の受信から timeout 秒以上経過した (room, name) のリストを返します。"""
+        now = time.monotonic() if now is None else now
+        return [
+            (room, name)
+            for room, members in self._members.items()
+            for name, last_seen in members.items()
+            if now - last_seen >= timeout
+        ]
+
+    def clear(self):
+        self._members.clear()
+        self._snapshots.clear()
+        self._versions.clear()
@@ -0,0 +1,104 @@
+import re
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# Web UIなどの観察者として扱う接続名（全てのメッセージを受信する）
+OBSERVER_NAME = "human"
+
+# エージェントが指定できる購読フィルタ
+# - all: 全ての（宛先指定のない）メッセージを受信する（デフォルト）
+# - mentions: 自分がメンションまたは宛先指定されたメッセージのみ受信する
+# - humans: 人間が送信したメッセージのみ受信する
+# - presence: 上記に加えて参加・退出のプレゼンスイベントも受信する（観察者には常に配信される）
+SUBSCRIPTION_FILTERS = ("all", "mentions", "humans", "presence")
+
+# @AgentName 形式のメンションを抽出するための正規表現
+MENTION_PATTERN = re.compile(r"@([\w\-.]+)")
+
+def parse_mentions(message_content: str) -> List[str]:
+    """メッセージ本文から @AgentName 形式のメンションを出現順に重複なく抽出します。"""
+    mentions: List[str] = []
+    for name in MENTION_PATTERN.findall(message_content or ""):
+        # 文末の句読点などに付いてきた "." は名前の一部とみなさない
+        name = name.rstrip(".")
+        if name and name not in mentions:
+            mentions.append(name)
+    return mentions
+
+def normalize_recipients(to: Any) -> List[str]:
+    """クライアントから渡された `to` フィールド（文字列またはリスト）を名前のリストに正規化します。"""
+    if not to:
+        return []
+    if isinstance(to, str):
+        to = to.split(",")
+    names: List[str] = []
+    for name in to:
+        name = str(name).strip().lstrip("@")
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def parse_subscription(value: Optional[str]) -> Set[str]:
+    """`subscribe` クエリパラメータ（カンマ区切り）を購読フィルタの集合に変換します。"""
+    if not value:
+        return {"all"}
+    filters = {f.strip() for f in value.split(",") if f.strip()}
+    unknown = filters - set(SUBSCRIPTION_FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown subscription filter(s): {', '.join(sorted(unknown))}")
+    if not filters - {"presence"}:
+        # presence は追加のフィルタなので、単独で指定された場合は全てのメッセージも受信する
+        filters.add("all")
+    return filters
+
+def index_mentions(message: Dict[str, Any], known_agents: Iterable[str]) -> Dict[str, Any]:
+    """
+    受信時に一度だけメンションを解析し、メッセージに `mentions` と `to` を設定します。
+    `mentions` にはルームに接続中のエージェント名のみを含めます
+    （タイプミスや無関係な "@" でメッセージが誰にも届かなくなるのを防ぐため）。
+    """
+    known = set(known_agents)
+    message["mentions"] = [name for name in parse_mentions(message.get("message", "")) if name in known]
+    message["to"] = normalize_recipients(message.get("to"))
+    return message
+
+def addressees(message: Dict[str, Any]) -> List[str]:
+    """メッセージの宛先（明示的な `to` とメンションの和）を順序を保って返します。空なら宛先指定なし。"""
+    names: List[str] = []
+    for name in list(message.get("to") or []) + list(message.get("mentions") or []):
+        if name not in names:
+            names.append(name)
+    return names
+
+def select_recipients(
+    connections: Iterable[str],
+    subscriptions: Dict[str, Set[str]],
+    message: Dict[str, Any],
+    sender_is_human: bool,
+) -> List[str]:
+    """
+    メッセージを配信すべき接続名のリストを返します。
+
+    宛先指定のあるメッセージは宛先のエージェントと観察者（Web UI）にのみ配信し、
+    宛先指定のないメッセージは各エージェントの購読フィルタに従って配信します。
+    プレゼンスイベントは観察者と presence を購読している接続にのみ配信します。
+    """
+    if message.get("type") == "presence":
+        return [
+            name for name in connections
+            if name == OBSERVER_NAME or "presence" in subscriptions.get(name, ())
+        ]
+    directed = set(addressees(message))
+    is_chat = message.get("type", "chat") == "chat"
+    recipients: List[str] = []
+    for name in connections:
+        if name == OBSERVER_NAME:
+            recipients.append(name)
+            continue
+        if directed:
+            if name in directed:
+                recipients.append(name)
+            continue
+        filters = subscriptions.get(name, {"all"})
+        if "all" in filters or ("humans" in filters and sender_is_human and is_chat):
+            recipients.append(name)
+    return recipients
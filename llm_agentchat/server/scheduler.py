@@ -0,0 +1,139 @@
+from typing import List, Optional, Set
+
+# サポートする発言権（フロア）制御ポリシー
+POLICIES = ("round_robin", "mention_first", "moderator")
+
+class FloorScheduler:
+    """
+    ルーム単位で「次に誰が発言するか」を決めるスケジューラ。
+
+    全エージェントが全メッセージに応答すると、N体のエージェントで1メッセージあたり
+    N回のLLM呼び出しが発生し、応答同士がさらに連鎖します。このスケジューラは
+    人間のメッセージごとに応答回数の上限（reply_budget）を設け、ポリシーに従って
+    1体（または選ばれた一部）のエージェントにだけ発言権を与えます。
+    """
+    def __init__(self, policy: str = "round_robin", reply_budget: int = 3, moderator: Optional[str] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown turn policy: {policy}")
+        if policy == "moderator" and not moderator:
+            raise ValueError("The 'moderator' turn policy requires a moderator agent name")
+        if reply_budget < 1:
+            raise ValueError("reply_budget must be at least 1")
+        self.policy = policy
+        self.reply_budget = reply_budget
+        self.moderator = moderator
+        self._rotation: List[str] = [] # 参加順のエージェント名（ラウンドロビン用）
+        self._next_index = 0
+        self._remaining = 0 # 現在の人間メッセージに対して残っている応答回数
+        self._pending: Set[str] = set() # 発言権を与えられ、まだ応答していないエージェント
+
+    @property
+    def agents(self) -> List[str]:
+        """スケジューリング対象のエージェント名のリストを返します。"""
+        return list(self._rotation)
+
+    @property
+    def pending(self) -> Set[str]:
+        """発言権を持っていて応答待ちのエージェントを返します。"""
+        return set(self._pending)
+
+    @property
+    def remaining_budget(self) -> int:
+        """現在のターンで残っている応答回数を返します。"""
+        return self._remaining
+
+    def add_agent(self, agent_name: str):
+        """エージェントをスケジューリング対象に追加します。"""
+        if agent_name not in self._rotation:
+            self._rotation.append(agent_name)
+
+    def remove_agent(self, agent_name: str) -> List[str]:
+        """
+        エージェントをスケジューリング対象から外します。
+        発言権を持ったまま切断された場合は、次に発言権を与えるエージェントのリストを返します。
+        """
+        if agent_name in self._rotation:
+            index = self._rotation.index(agent_name)
+            self._rotation.remove(agent_name)
+            if index < self._next_index:
+                self._next_index -= 1
+            if self._rotation:
+                self._next_index %= len(self._rotation)
+            else:
+                self._next_index = 0
+        if agent_name in self._pending:
+            self._pending.discard(agent_name)
+            if not self._pending:
+                return self._grant(agent_name, [])
+        return []
+
+    def on_message(self, sender: str, mentions: List[str], is_agent: bool) -> List[str]:
+        """
+        チャットメッセージを受け取り、発言権を与えるエージェントのリストを返します。
+        mentions にはメッセージの宛先（明示的な `to` と受信時に解析済みのメンション）を渡します。
+
+        人間のメッセージは新しいターンを開始し、応答回数の上限をリセットします。
+        エージェントのメッセージは、発言権を持つエージェントからの応答であれば上限を消費し、
+        応答待ちのエージェントがいなくなった時点で次の発言者を選びます。
+        """
+        if not is_agent:
+            self._remaining = self.reply_budget
+            self._pending.clear()
+            return self._grant(sender, mentions)
+
+        if sender not in self._pending:
+            # 発言権を持たないエージェントの発言はスケジューリングに影響させない
+            return []
+        self._pending.discard(sender)
+        if self._pending:
+            return []
+        return self._grant(sender, mentions)
+
+    def _grant(self, sender: str, mentions: List[str]) -> List[str]:
+        """ポリシーに従って次の発言者を選び、応答回数の上限を消費します。"""
+        if self._remaining <= 0:
+            return []
+        speakers = self._choose(sender, mentions)[:self._remaining]
+        self._remaining -= len(speakers)
+        self._pending.update(speakers)
+        return speakers
+
+    def _choose(self, sender: str, mentions: List[str]) -> List[str]:
+        """
+        次に発言するエージェントの候補を選びます（発言者自身は除外）。
+        宛先指定（mentions）のあるメッセージは宛先のエージェントにしか配信されないため、
+        どのポリシーでも宛先のエージェントの中から選びます（メッセージを受け取っていない相手には発言権を与えない）。
+        """
+        candidates = [name for name in self._rotation if name != sender]
+        if not candidates:
+            return []
+        if mentions:
+            mentioned = [name for name in mentions if name in candidates]
+            if self.policy == "round_robin":
+                return self._next_in_rotation(sender, among=mentioned)
+            return mentioned
+
+        if self.policy == "mention_first":
+            return self._next_in_rotation(sender)
+
+        if self.policy == "moderator":
+            if sender == self.moderator:
+                # 司会役が誰も指名しなかった場合はターンを終了する
+                return []
+            if self.moderator in candidates:
+                return [self.moderator]
+            # 司会役が不在の場合はラウンドロビンにフォールバック
+            return self._next_in_rotation(sender)
+
+        return self._next_in_rotation(sender)
+
+    def _next_in_rotation(self, sender: str, among: Optional[List[str]] = None) -> List[str]:
+        """ラウンドロビンで次のエージェントを1体選びます。among を指定した場合はその中から選びます。"""
+        if among is not None and not among:
+            return []
+        for _ in range(len(self._rotation)):
+            name = self._rotation[self._next_index % len(self._rotation)]
+            self._next_index = (self._next_index + 1) % len(self._rotation)
+            if name != sender and (among is None or name in among):
+                return [name]
+        return []
@@ -0,0 +1,373 @@
+# 追記専用のセグメントログによるストレージエンジン
+#
+# チャットの書き込みはほぼ「追記して直近を読む」だけなので、ルームごとの追記専用ログに保存します。
+#   <root>/<room>/<先頭のシーケンスID:020d>.seg  セグメントファイル（レコードを連結したもの）
+#   <root>/<room>/index                          オフセットインデックス（mmapで参照）
+# レコードは [本文の長さ u32][本文のCRC32 u32][JSON本文] の形式です。
+# インデックスはシーケンスID n のエントリを (n-1)*16 バイト目に
+# (セグメントの先頭ID u64, オフセット u32, レコード長 u32) として保持するため、IDからO(1)でシークできます。
+# fsyncは書き込みごとではなく、件数または経過時間でまとめて行います。
+# 開いているルームのログ（インデックスのmmapとファイルディスクリプタ）は最近使った max_open_rooms 件までに
+# 制限し、それを超えたら最も長く使っていないルームのログを閉じます（次に使うときに開き直す）。
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+from llm_agentchat.server.storage import MessageStore
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<II") # 本文の長さ, CRC32
+INDEX_ENTRY = struct.Struct("<QII") # セグメントの先頭ID, オフセット, レコード長
+INDEX_FILE = "index"
+SEGMENT_SUFFIX = ".seg"
+INITIAL_INDEX_ENTRIES = 4096
+MAX_SEGMENT_BYTES = 2**32 - 1 # インデックスのオフセットは u32 のため、セグメントはこれより大きくできない
+DEFAULT_MAX_OPEN_ROOMS = 256 # 同時に開いておくルームのログの上限
+
+def _room_dirname(room_name: str) -> str:
+    """ルーム名をディレクトリ名として安全な文字列に変換します（"." や "/" もエスケープする）。"""
+    return quote(room_name, safe="").replace(".", "%2E")
+
+def _segment_name(first_seq: int) -> str:
+    return f"{first_seq:020d}{SEGMENT_SUFFIX}"
+
+class _RoomLog:
+    """1つのルームのセグメントとインデックスを管理します。"""
+
+    def __init__(self, directory: str, segment_bytes: int):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.segments: List[int] = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._readers: Dict[int, int] = {} # セグメントの先頭ID -> 読み込み用ファイルディスクリプタ
+        self._writer = None
+        self._writer_segment: Optional[int] = None
+        self.dirty = False
+        self._open_index()
+        self.count = self._find_count()
+        self._recover()
+
+    # --- インデックス ---
+
+    def _open_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        self._index_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._index_fd).st_size
+        if size < INITIAL_INDEX_ENTRIES * INDEX_ENTRY.size:
+            size = INITIAL_INDEX_ENTRIES * INDEX_ENTRY.size
+            os.ftruncate(self._index_fd, size)
+        self._index = mmap.mmap(self._index_fd, size)
+
+    @property
+    def _capacity(self) -> int:
+        return len(self._index) // INDEX_ENTRY.size
+
+    def _grow_index(self):
+        """インデックスの容量を2倍に拡張します。"""
+        size = len(self._index) * 2
+        self._index.flush()
+        self._index.close()
+        os.ftruncate(self._index_fd, size)
+        self._index = mmap.mmap(self._index_fd, size)
+
+    def _entry(self, seq: int):
+        return INDEX_ENTRY.unpack_from(self._index, (seq - 1) * INDEX_ENTRY.size)
+
+    def _set_entry(self, seq: int, segment: int, offset: int, length: int):
+        while seq > self._capacity:
+            self._grow_index()
+        INDEX_ENTRY.pack_into(self._index, (seq - 1) * INDEX_ENTRY.size, segment, offset, length)
+
+    def _find_count(self) -> int:
+        """使用中のエントリ数を二分探索で求めます（エントリは先頭から隙間なく埋まっている）。"""
+        low, high = 0, self._capacity
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle + 1)[2] != 0:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # --- 復旧 ---
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, _segment_name(segment))
+
+    def _read_at(self, segment: int, offset: int, length: int) -> bytes:
+        fd = self._readers.get(segment)
+        if fd is None:
+            fd = os.open(self._segment_path(segment), os.O_RDONLY)
+            self._readers[segment] = fd
+        return os.pread(fd, length, offset)
+
+    def _decode(self, raw: bytes) -> Optional[Dict[str, Any]]:
+        """レコードを検証してデコードします。壊れている場合はNoneを返します。"""
+        if len(raw) < RECORD_HEADER.size:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(raw)
+        body = raw[RECORD_HEADER.size:RECORD_HEADER.size + length]
+        if len(body) != length or zlib.crc32(body) != crc:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    def _recover(self):
+        """
+        クラッシュ後の不整合を修復します。
+        - インデックスの末尾が書き込まれていないレコードを指していれば取り除く
+        - インデックスに登録される前のレコードがセグメントに残っていれば登録する
+        - セグメント末尾の書きかけのレコードは切り詰める
+        """
+        while self.count > 0:
+            segment, offset, length = self._entry(self.count)
+            if segment in self.segments and self._decode(self._read_at(segment, offset, length)) is not None:
+                break
+            self._set_entry(self.count, 0, 0, 0)
+            self.count -= 1
+
+        if self.count > 0:
+            segment, offset, length = self._entry(self.count)
+            position = offset + length
+        else:
+            segment, position = (self.segments[0], 0) if self.segments else (None, 0)
+        if segment is None:
+            return
+
+        recovered = 0
+        for current in [s for s in self.segments if s >= segment]:
+            size = os.path.getsize(self._segment_path(current))
+            while position < size:
+                header = self._read_at(current, position, RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length = RECORD_HEADER.size + RECORD_HEADER.unpack(header)[0]
+                record = self._decode(self._read_at(current, position, length))
+                if record is None or record.get("id") != self.count + 1:
+                    break
+                self._set_entry(self.count + 1, current, position, length)
+                self.count += 1
+                position += length
+                recovered += 1
+            if position < size:
+                logger.warning("Truncating torn record at %s offset %d", self._segment_path(current), position)
+                os.truncate(self._segment_path(current), position)
+                self._drop_segments_after(current)
+                break
+            position = 0
+        if recovered:
+            logger.info("Recovered %d unindexed records in %s", recovered, self.directory)
+            self.dirty = True
+
+    def _drop_segments_after(self, segment: int):
+        """切り詰めたセグメントより後のセグメント（不整合のため読めない）を削除します。"""
+        for later in [s for s in self.segments if s > segment]:
+            self._close_reader(later)
+            os.remove(self._segment_path(later))
+            self.segments.remove(later)
+
+    # --- 読み書き ---
+
+    def append(self, record: Dict[str, Any]) -> int:
+        """レコードを追記し、割り当てたシーケンスIDを返します。"""
+        seq = self.count + 1
+        record["id"] = seq
+        body = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        data = RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+        writer = self._current_writer()
+        if writer.tell() > 0 and writer.tell() + len(data) > self.segment_bytes:
+            writer = self._roll_over(seq)
+        offset = writer.tell()
+        writer.write(data)
+        writer.flush() # fsyncはまとめて行うが、読み込み用のディスクリプタから見えるようにOSには渡す
+        self._set_entry(seq, self._writer_segment, offset, len(data))
+        self.count = seq
+        self.dirty = True
+        return seq
+
+    def _current_writer(self):
+        if self._writer is None:
+            if not self.segments:
+                self.segments.append(self.count + 1)
+            self._writer_segment = self.segments[-1]
+            self._writer = open(self._segment_path(self._writer_segment), "ab")
+        return self._writer
+
+    def _roll_over(self, first_seq: int):
+        """現在のセグメントを閉じて、新しいセグメントに切り替えます。"""
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self.segments.append(first_seq)
+        self._writer_segment = first_seq
+        self._writer = open(self._segment_path(first_seq), "ab")
+        return self._writer
+
+    def read(self, seq: int) -> Dict[str, Any]:
+        """シーケンスIDのレコードを読み込みます。"""
+        segment, offset, length = self._entry(seq)
+        raw = self._read_at(segment, offset, length)
+        return json.loads(raw[RECORD_HEADER.size:])
+
+    def sync(self):
+        """セグメントとインデックスをディスクに書き出します。"""
+        if not self.dirty:
+            return
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+        self._index.flush()
+        self.dirty = False
+
+    def _close_reader(self, segment: int):
+        fd = self._readers.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        self.sync()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for segment in list(self._readers):
+            self._close_reader(segment)
+        self._index.close()
+        os.close(self._index_fd)
+
+class SegmentLogStore(MessageStore):
+    """
+    ルームごとの追記専用セグメントログを使う保存先。
+
+    segment_bytes を超えると新しいセグメントに切り替えます。fsyncは fsync_batch 件ごと、
+    または fsync_interval 秒ごと（`sync()` の定期呼び出しを含む）にまとめて行います。
+    開いておくルームのログは最近使った max_open_rooms 件までです。
+    """
+
+    def __init__(self, root: str, segment_bytes: int = 64 * 1024 * 1024,
+                 fsync_interval: float = 1.0, fsync_batch: int = 256, max_open_rooms: int = DEFAULT_MAX_OPEN_ROOMS):
+        if not 0 < segment_bytes <= MAX_SEGMENT_BYTES:
+            raise ValueError(f"segment_bytes must be between 1 and {MAX_SEGMENT_BYTES}")
+        if max_open_rooms < 1:
+            raise ValueError("max_open_rooms must be at least 1")
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.max_open_rooms = max_open_rooms
+        os.makedirs(root, exist_ok=True)
+        self._rooms: "OrderedDict[str, _RoomLog]" = OrderedDict() # 最近使った順
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @property
+    def identity(self) -> str:
+        return f"log:{self.root}"
+
+    def _room(self, room_name: str, create: bool) -> Optional[_RoomLog]:
+        log = self._rooms.get(room_name)
+        if log is not None:
+            self._rooms.move_to_end(room_name)
+            return log
+        directory = os.path.join(self.root, _room_dirname(room_name))
+        if not create and not os.path.isdir(directory):
+            return None
+        log = _RoomLog(directory, self.segment_bytes)
+        self._rooms[room_name] = log
+        while len(self._rooms) > self.max_open_rooms:
+            # 最も長く使っていないルームのログを閉じる（閉じる前に書き出すため、未同期の書き込みも失われない）
+            _, evicted = self._rooms.popitem(last=False)
+            evicted.close()
+        return log
+
+    def add_message(self, room_name: str, sender: str, message: str, message_type: str, timestamp: str,
+                    blob: Optional[str] = None) -> int:
+        record = {
+            "sender": sender,
+            "message_content": message,
+            "timestamp": timestamp,
+            "message_type": message_type,
+        }
+        if blob is not None:
+            record["blob"] = blob
+        with self._lock:
+            seq = self._room(room_name, create=True).append(record)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync_locked()
+            return seq
+
+    def add_messages(self, room_name: str, messages: Sequence[Tuple[str, str, str, str, Optional[str]]]) -> List[int]:
+        with self._lock:
+            log = self._room(room_name, create=True)
+            seqs = []
+            for sender, message, message_type, timestamp, blob in messages:
+                record = {"sender": sender, "message_content": message, "timestamp": timestamp,
+                          "message_type": message_type}
+                if blob is not None:
+                    record["blob"] = blob
+                seqs.append(log.append(record))
+            self._unsynced += len(seqs)
+            if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync_locked()
+            return seqs
+
+    def get_messages(self, room_name: str, limit: int = 100, after_id: Optional[int] = None,
+                     before_id: Optional[int] = None, exclude_types: Sequence[str] = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            log = self._room(room_name, create=False)
+            if log is None:
+                return []
+            if after_id is not None:
+                seqs = range(max(after_id, 0) + 1, log.count + 1)
+            else:
+                end = log.count if before_id is None else min(log.count, before_id - 1)
+                seqs = range(end, 0, -1)
+            messages = []
+            for seq in seqs:
+                if len(messages) >= limit:
+                    break
+                record = log.read(seq)
+                if record.get("message_type") in exclude_types:
+                    continue
+                messages.append(record)
+            if after_id is None:
+                messages.reverse()
+            return messages
+
+    def latest_id(self, room_name: str) -> Optional[int]:
+        with self._lock:
+            log = self._room(room_name, create=False)
+            if log is None or log.count == 0:
+                return None
+            return log.count
+
+    def _sync_locked(self):
+        for log in self._rooms.values():
+            log.sync()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        with self._lock:
+            self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            for log in self._rooms.values():
+                log.close()
+            self._rooms.clear()
@@ -0,0 +1,121 @@
+# 観戦者向けのServer-Sent Events（SSE）配信
+#
+# 読み取り専用の観戦者（Web UIなど）は /api/rooms/{room}/stream にSSEで接続します。
+# ルームごとに1つの RoomFeed が、イベントをSSEの形式に一度だけエンコードして上限付きのバッファに追加し、
+# 各観戦者はバッファ上の自分の位置から未送信のイベントをまとめて読み出して送信します。
+# 追加にかかる時間は観戦者の数によらず一定で、遅い観戦者は自分への送信が遅れるだけなので、
+# エージェントの接続（active_connections）への配信を遅らせることはありません。
+# メッセージのイベントIDはメッセージIDで、再接続時は Last-Event-ID 以降のメッセージから再開します。
+# バッファから溢れた範囲はストレージから読み直します。
+import asyncio
+import itertools
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, List, Optional, Tuple
+
+FEED_BUFFER_SIZE = 1024 # ルームごとに保持するイベント数
+KEEPALIVE_INTERVAL = 15.0 # イベントがない間に送るコメント行の間隔（秒）。プロキシによる切断を防ぐ
+RETRY_MS = 3000 # ブラウザが再接続するまでの待ち時間（ミリ秒）
+
+# (バッファ内の通し番号, メッセージID（プレゼンスなどはNone）, エンコード済みのイベント)
+FeedEvent = Tuple[int, Optional[int], bytes]
+# after_id より後のメッセージを (メッセージID, エンコード済みのイベント) のリストで返す関数（1ページ分）
+Backfill = Callable[[int], List[Tuple[int, bytes]]]
+
+def encode_event(data: str, event_id: Optional[int] = None, event: Optional[str] = None) -> bytes:
+    """データ（JSON）をSSEのイベントにエンコードします。"""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+class RoomFeed:
+    """ルームのエンコード済みのイベントを保持し、全ての観戦者で共有するバッファ。"""
+
+    def __init__(self, room: str, latest_id: int = 0, size: int = FEED_BUFFER_SIZE):
+        self.room = room
+        self.size = size
+        # floor_id 以前のメッセージはバッファにない（作成時点の最新ID、または最後に溢れたメッセージのID）
+        self.floor_id = latest_id
+        self.latest_id = latest_id
+        self.seq = 0
+        self.watchers = 0
+        self._events: Deque[FeedEvent] = deque()
+        self.changed = asyncio.Event()
+
+    def publish(self, chunk: bytes, message_id: Optional[int] = None):
+        """エンコード済みのイベントを追加し、待っている観戦者を起こします。"""
+        self.seq += 1
+        self._events.append((self.seq, message_id, chunk))
+        if message_id is not None:
+            self.latest_id = max(self.latest_id, message_id)
+        while len(self._events) > self.size:
+            _, evicted_id, _ = self._events.popleft()
+            if evicted_id is not None:
+                self.floor_id = evicted_id
+        # 待っている観戦者は古いイベントを参照しているため、セットしてから新しいものに差し替える
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def read(self, cursor: int) -> Optional[List[FeedEvent]]:
+        """通し番号が cursor より後のイベントを返します。cursor の直後がすでに溢れていればNoneを返します。"""
+        first_seq = self.seq - len(self._events) + 1
+        if cursor + 1 < first_seq:
+            return None
+        return list(itertools.islice(self._events, cursor + 1 - first_seq, None))
+
+    def cursor_after(self, message_id: int) -> Optional[int]:
+        """メッセージID message_id の次のメッセージから読むための位置を返します。バッファで足りなければNoneを返します。"""
+        if message_id < self.floor_id:
+            return None
+        cursor = self.seq - len(self._events)
+        for seq, event_id, _ in self._events:
+            if event_id is None:
+                continue
+            if event_id > message_id:
+                break
+            cursor = seq
+        return cursor
+
+async def stream_events(feed: RoomFeed, after_id: Optional[int], backfill: Backfill,
+                        keepalive: float = KEEPALIVE_INTERVAL) -> AsyncIterator[bytes]:
+    """
+    観戦者1人分のSSEのストリームを生成します。after_id（Last-Event-ID）を指定した場合は
+    それより後のメッセージから、省略した場合は接続以降のイベントから送信します。
+    """
+    # 開始位置は最初の送信より前に決める（ジェネレーターが最初に進められた時点が接続時刻）
+    if after_id is None:
+        cursor: Optional[int] = feed.seq
+        last_id = feed.latest_id
+    else:
+        cursor = None
+        last_id = after_id
+    yield f"retry: {RETRY_MS}\n\n".encode("utf-8")
+    while True:
+        if cursor is None:
+            cursor = feed.cursor_after(last_id)
+            if cursor is None:
+                # バッファにない範囲はストレージから1ページずつ読み直す
+                page = backfill(last_id)
+                if page:
+                    last_id = page[-1][0]
+                    yield b"".join(chunk for _, chunk in page)
+                    continue
+                cursor = feed.seq
+        events = feed.read(cursor)
+        if events is None:
+            # 送信が遅れている間にバッファから溢れた
+            cursor = None
+            continue
+        if events:
+            cursor = events[-1][0]
+            last_id = max([last_id] + [event_id for _, event_id, _ in events if event_id is not None])
+            yield b"".join(chunk for _, _, chunk in events)
+            continue
+        changed = feed.changed
+        try:
+            await asyncio.wait_for(changed.wait(), keepalive)
+        except asyncio.TimeoutError:
+            yield b": keepalive\n\n"
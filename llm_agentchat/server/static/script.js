@@ -1,5 +1,6 @@
 document.addEventListener('DOMContentLoaded', async () => {
     const messagesUl = document.getElementById('messages');
+    const statusDiv = document.getElementById('status');
     const form = document.getElementById('form');
     const input = document.getElementById('input');
 
@@ -7,101 +8,294 @@ document.addEventListener('DOMContentLoaded', async () => {
     const urlParams = new URLSearchParams(window.location.search);
     const roomName = urlParams.get('room') || 'default_room'; // デフォルトルーム名を設定
 
-    // 過去のメッセージを取得して表示する関数
-    async function fetchAndDisplayMessages() {
+    const PAGE_SIZE = 50; // 1回のAPI呼び出しで取得するメッセージ数
+    const ESTIMATED_ROW_HEIGHT = 80; // 未計測の行の高さの見積もり（px）
+    const OVERSCAN_PX = 600; // 表示領域の上下に余分に描画する範囲（px）
+    const LOAD_OLDER_THRESHOLD_PX = 200; // 上端からこの距離以内にスクロールしたら過去ページを読み込む
+
+    // メッセージの状態（IDの昇順）
+    const messages = []; // 受信済みのメッセージ
+    const knownIds = new Set(); // 重複排除用
+    const renderCache = new Map(); // id -> 描画済みHTML（marked.parseはメッセージごとに1回だけ）
+    const rowHeights = new Map(); // id -> 計測した行の高さ
+    let lastSeenId = null; // 差分同期の起点
+    let hasMoreOlder = true; // サーバーにさらに古いメッセージがあるか
+    let loadingOlder = false;
+
+    // 仮想リストの上下の余白（描画しない行の高さ分）
+    const topSpacer = document.createElement('li');
+    const bottomSpacer = document.createElement('li');
+    topSpacer.setAttribute('aria-hidden', 'true');
+    bottomSpacer.setAttribute('aria-hidden', 'true');
+
+    // 接続状態などのお知らせを表示する（メッセージ一覧には含めない）
+    function showStatus(text, isError = false) {
+        statusDiv.textContent = text;
+        statusDiv.className = isError
+            ? 'text-sm text-center p-2 mb-2 rounded-lg bg-red-100 text-red-800'
+            : 'text-sm text-center p-2 mb-2 rounded-lg bg-yellow-100 text-yellow-800';
+    }
+
+    async function fetchMessages(params) {
+        const query = new URLSearchParams({ room: roomName, limit: PAGE_SIZE, ...params });
+        const response = await fetch(`/api/messages?${query}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+    }
+
+    // 受信したメッセージを状態に追加する（IDを持たないものは末尾に追加）
+    function addMessages(newMessages) {
+        let added = false;
+        for (const msg of newMessages) {
+            if (msg.id != null) {
+                if (knownIds.has(msg.id)) continue;
+                knownIds.add(msg.id);
+                if (lastSeenId === null || msg.id > lastSeenId) lastSeenId = msg.id;
+            }
+            messages.push(msg);
+            added = true;
+        }
+        if (added) {
+            messages.sort((a, b) => (a.id ?? Infinity) - (b.id ?? Infinity));
+        }
+        return added;
+    }
+
+    // 接続（再接続）時は前回以降のメッセージだけを取得する
+    async function syncMessages() {
         try {
-            const response = await fetch(`/api/messages?room=${roomName}`);
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+            if (lastSeenId === null) {
+                const page = await fetchMessages({});
+                hasMoreOlder = page.length === PAGE_SIZE;
+                addMessages(page);
+            } else {
+                // 切断中に溜まった分をページ単位で取得
+                while (true) {
+                    const page = await fetchMessages({ after_id: lastSeenId });
+                    addMessages(page);
+                    if (page.length < PAGE_SIZE) break;
+                }
             }
-            const messages = await response.json();
-            messagesUl.innerHTML = ''; // 既存のメッセージをクリア
-            messages.forEach(msg => {
-                displayMessage(msg);
-            });
+            render(true);
         } catch (error) {
             console.error('Failed to fetch messages:', error);
-            const errorItem = document.createElement('li');
-            errorItem.textContent = `Error loading past messages: ${error.message}`;
-            errorItem.style.color = 'red';
-            messagesUl.appendChild(errorItem);
+            showStatus(`Error loading past messages: ${error.message}`, true);
         }
     }
 
-    // メッセージをUIに表示するヘルパー関数
-    function displayMessage(msg) {
-        const item = document.createElement('li');
-        const timestamp = new Date(msg.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+    // 上端までスクロールしたら過去のメッセージを1ページ読み込む
+    async function loadOlderMessages() {
+        if (loadingOlder || !hasMoreOlder) return;
+        const oldest = messages.find(msg => msg.id != null);
+        if (!oldest) return;
+        loadingOlder = true;
+        try {
+            const page = await fetchMessages({ before_id: oldest.id });
+            hasMoreOlder = page.length === PAGE_SIZE;
+            const previousHeight = totalHeight();
+            if (addMessages(page)) {
+                // 先頭に追加した分だけスクロール位置をずらして表示位置を保つ
+                messagesUl.scrollTop += totalHeight() - previousHeight;
+                render(false);
+            }
+        } catch (error) {
+            console.error('Failed to fetch older messages:', error);
+        } finally {
+            loadingOlder = false;
+        }
+    }
 
+    // メッセージのHTMLを生成するヘルパー関数（結果はIDごとにキャッシュする）
+    function messageHtml(msg) {
+        if (msg.id != null && renderCache.has(msg.id)) {
+            return renderCache.get(msg.id);
+        }
+        const timestamp = new Date(msg.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+        // 大きな本文はプレビューだけが届くため、全文を読み込むボタンを付ける
+        const showFull = msg.blob
+            ? `<button type="button" class="show-full text-xs underline mt-1" data-id="${msg.id}">Show full message</button>`
+            : '';
+        let html;
         // メッセージの種類に応じてスタイルを決定
         if (msg.sender === 'human') {
-            item.className = 'flex justify-end';
-            item.innerHTML = `
-                <div class="bg-blue-500 text-white p-3 rounded-lg max-w-lg">
-                    <p class="whitespace-pre-wrap">${msg.message}</p>
-                    <div class="text-right text-xs text-blue-200 mt-1">${timestamp}</div>
+            html = `
+                <div class="flex justify-end">
+                    <div class="bg-blue-500 text-white p-3 rounded-lg max-w-lg">
+                        <p class="whitespace-pre-wrap">${msg.message}</p>
+                        ${showFull}
+                        <div class="text-right text-xs text-blue-200 mt-1">${timestamp}</div>
+                    </div>
                 </div>`;
-        } else if (msg.sender === 'System' && msg.type === 'system') {
-            // "System"からのシステムメッセージ（接続/切断など）
-            item.className = 'flex justify-center'; // 中央揃え
-            item.innerHTML = `
-                <div class="bg-yellow-100 text-yellow-800 text-sm p-2 rounded-lg max-w-lg text-center">
-                    ${msg.message}
+        } else if (msg.type === 'system') {
+            html = `
+                <div class="flex justify-center">
+                    <div class="bg-yellow-100 text-yellow-800 text-sm p-2 rounded-lg max-w-lg text-center">
+                        ${msg.message}
+                        ${showFull}
+                    </div>
                 </div>`;
-        } else { // エージェントからのメッセージ（チャットと参加/離脱などのシステムメッセージを含む）
-            item.className = 'flex justify-start';
+        } else { // エージェントからのメッセージ
             const messageContent = (typeof marked !== 'undefined') ? marked.parse(msg.message) : msg.message;
-            item.innerHTML = `
-                <div class="bg-gray-200 text-gray-800 p-3 rounded-lg max-w-lg">
-                    <div class="font-bold">${msg.sender}</div>
-                    <div class="prose prose-sm max-w-none mt-1">${messageContent}</div>
-                    <div class="text-right text-xs text-gray-500 mt-1">${timestamp}</div>
+            html = `
+                <div class="flex justify-start">
+                    <div class="bg-gray-200 text-gray-800 p-3 rounded-lg max-w-lg">
+                        <div class="font-bold">${msg.sender}</div>
+                        <div class="prose prose-sm max-w-none mt-1">${messageContent}</div>
+                        ${showFull}
+                        <div class="text-right text-xs text-gray-500 mt-1">${timestamp}</div>
+                    </div>
                 </div>`;
         }
-        messagesUl.prepend(item);
+        if (msg.id != null) {
+            renderCache.set(msg.id, html);
+        }
+        return html;
+    }
+
+    function rowKey(msg, index) {
+        return msg.id != null ? msg.id : `local-${index}`;
+    }
+
+    function rowHeight(msg, index) {
+        return rowHeights.get(rowKey(msg, index)) || ESTIMATED_ROW_HEIGHT;
+    }
+
+    function totalHeight() {
+        let height = 0;
+        for (let i = 0; i < messages.length; i++) height += rowHeight(messages[i], i);
+        return height;
     }
 
-    // WebSocket接続
-    const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${wsProtocol}//${window.location.host}/ws?room=${roomName}`;
-    let socket;
-    let reconnectAttempts = 0;
-    const maxReconnectAttempts = 5; // 再接続試行の最大回数
-
-    function connectWebSocket() {
-        socket = new WebSocket(wsUrl);
-
-        socket.onopen = (event) => {
-            reconnectAttempts = 0; // 接続成功時にリセット
-            console.log('WebSocket connected:', event);
-            // 接続成功後に過去のメッセージをロード
-            fetchAndDisplayMessages();
-            displayMessage({ sender: 'System', message: 'Connected to chat.', timestamp: new Date().toISOString(), type: 'system' });
+    function isNearBottom() {
+        return messagesUl.scrollHeight - messagesUl.scrollTop - messagesUl.clientHeight < 50;
+    }
+
+    // 表示領域（と前後の余白）に入る行だけをDOMに描画する
+    function render(stickToBottom) {
+        const viewTop = messagesUl.scrollTop - OVERSCAN_PX;
+        const viewBottom = messagesUl.scrollTop + messagesUl.clientHeight + OVERSCAN_PX;
+
+        let offset = 0;
+        let start = messages.length;
+        let end = messages.length;
+        let topHeight = 0;
+        for (let i = 0; i < messages.length; i++) {
+            const height = rowHeight(messages[i], i);
+            if (start === messages.length && offset + height >= viewTop) {
+                start = i;
+                topHeight = offset;
+            }
+            if (offset > viewBottom) {
+                end = i;
+                break;
+            }
+            offset += height;
+        }
+        let bottomHeight = 0;
+        for (let i = end; i < messages.length; i++) bottomHeight += rowHeight(messages[i], i);
+
+        const fragment = document.createDocumentFragment();
+        topSpacer.style.height = `${topHeight}px`;
+        bottomSpacer.style.height = `${bottomHeight}px`;
+        fragment.appendChild(topSpacer);
+        const rendered = [];
+        for (let i = start; i < end; i++) {
+            const item = document.createElement('li');
+            item.className = 'py-2';
+            item.innerHTML = messageHtml(messages[i]);
+            fragment.appendChild(item);
+            rendered.push([rowKey(messages[i], i), item]);
+        }
+        fragment.appendChild(bottomSpacer);
+        messagesUl.replaceChildren(fragment);
+
+        // 実際の高さを計測して次回以降の配置に使う
+        for (const [key, item] of rendered) {
+            rowHeights.set(key, item.offsetHeight);
+        }
+        if (stickToBottom) {
+            messagesUl.scrollTop = messagesUl.scrollHeight;
+        }
+    }
+
+    // 「Show full message」でブロブの全文を取得してプレビューと置き換える（応答は永続的にキャッシュされる）
+    messagesUl.addEventListener('click', async (event) => {
+        const button = event.target.closest('.show-full');
+        if (!button) return;
+        const msg = messages.find(m => String(m.id) === button.dataset.id);
+        if (!msg || !msg.blob) return;
+        button.disabled = true;
+        try {
+            const response = await fetch(`/api/blobs/${msg.blob}`);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            msg.message = await response.text();
+            delete msg.blob;
+            renderCache.delete(msg.id);
+            rowHeights.delete(msg.id);
+            render(false);
+        } catch (error) {
+            button.disabled = false;
+            console.error('Failed to fetch full message:', error);
+            showStatus(`Error loading full message: ${error.message}`, true);
+        }
+    });
+
+    let scrollScheduled = false;
+    messagesUl.addEventListener('scroll', () => {
+        if (scrollScheduled) return;
+        scrollScheduled = true;
+        requestAnimationFrame(() => {
+            scrollScheduled = false;
+            render(false);
+            if (messagesUl.scrollTop < LOAD_OLDER_THRESHOLD_PX) {
+                loadOlderMessages();
+            }
+        });
+    });
+
+    // 読み取り専用のServer-Sent Eventsでルームを購読する（送信はHTTP POSTで行う）
+    // 切断されるとブラウザが自動的に再接続し、Last-Event-ID以降のメッセージから再開する
+    const streamUrl = `/api/rooms/${encodeURIComponent(roomName)}/stream`;
+    let source;
+
+    function connectStream() {
+        source = new EventSource(streamUrl);
+
+        source.onopen = () => {
+            console.log('Event stream connected');
+            showStatus('Connected to chat.');
+            // 接続（再接続）後に前回以降のメッセージだけを同期
+            syncMessages();
         };
 
-        socket.onmessage = (event) => {
+        source.onmessage = (event) => {
             const message = JSON.parse(event.data);
-            displayMessage(message);
-            messagesUl.scrollTop = 0; // 新しいメッセージ表示後に一番上までスクロール
+            const stick = isNearBottom(); // 最下部を見ている場合のみ新着に追従する
+            if (addMessages([message])) {
+                render(stick);
+            }
         };
 
-        socket.onclose = (event) => {
-            console.log('WebSocket disconnected:', event);
-            if (reconnectAttempts < maxReconnectAttempts) {
-                reconnectAttempts++;
-                displayMessage({ sender: 'System', message: `Disconnected from chat. Reconnecting... (Attempt ${reconnectAttempts}/${maxReconnectAttempts})`, timestamp: new Date().toISOString(), type: 'system' });
-                setTimeout(connectWebSocket, 3000); // 3秒後に再接続を試みる
+        source.addEventListener('presence', (event) => {
+            // 参加・退出の通知は一覧には追加せず、ステータス欄に表示する
+            const message = JSON.parse(event.data);
+            const verb = message.event === 'join' ? 'joined' : 'left';
+            showStatus(`${message.agent} ${verb} the chat. In room: ${message.agents.join(', ')}`);
+        });
+
+        source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED) {
+                // サーバーが接続を拒否した場合などはブラウザが再接続しないため、少し待って接続し直す
+                showStatus('Disconnected from chat. Reconnecting...', true);
+                setTimeout(connectStream, 3000);
             } else {
-                displayMessage({ sender: 'System', message: 'Could not reconnect to the server. Please refresh the page.', timestamp: new Date().toISOString(), type: 'system' });
+                showStatus('Disconnected from chat. Reconnecting...');
             }
         };
-
-        socket.onerror = (error) => {
-            console.error('WebSocket error:', error);
-            // styleプロパティを削除
-            displayMessage({ sender: 'System', message: `WebSocket error: ${error.message}`, timestamp: new Date().toISOString(), type: 'system' });
-            socket.close(); // エラー時は接続を閉じて再接続を試みる
-        };
     }
 
     // Ctrl+Enterで送信するためのイベントリスナー
@@ -143,11 +337,11 @@ document.addEventListener('DOMContentLoaded', async () => {
 
             } catch (error) {
                 console.error('Failed to send message:', error);
-                displayMessage({ sender: 'System', message: `Error sending message: ${error.message}`, timestamp: new Date().toISOString(), type: 'system', style: 'color: red;' });
+                showStatus(`Error sending message: ${error.message}`, true);
             }
         }
     });
 
     // アプリケーション開始
-    connectWebSocket();
+    connectStream();
 });
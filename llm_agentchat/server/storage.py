@@ -0,0 +1,127 @@
+# チャット履歴のストレージインターフェース
+#
+# app.py はこのインターフェースに対してコードを書き、実際の保存方式（エンジン）は
+# `agentchat-server --storage-engine` で切り替えます。
+# - sqlite: SQLiteデータベース（db.py）
+# - log: ルームごとの追記専用セグメントログ（segment_log.py）
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import llm_agentchat.server.db as db
+from llm_agentchat.schema import encode_messages
+
+ENGINES = ("sqlite", "log")
+
+# エンジンごとのデフォルトの保存先
+DEFAULT_PATHS = {"sqlite": "chat_history.db", "log": "chat_history_log"}
+
+class MessageStore(ABC):
+    """
+    チャットメッセージの保存先のインターフェース。
+
+    メッセージIDはルーム内で単調増加する整数です（ルームをまたいで連番である必要はありません）。
+    取得したメッセージは `id`, `sender`, `message_content`, `timestamp`, `message_type` を持つ辞書です。
+    本文をブロブストアに保存したメッセージは、`message_content` がプレビューで、`blob` にそのハッシュを持ちます。
+    """
+
+    @property
+    @abstractmethod
+    def identity(self) -> str:
+        """保存先を識別する文字列（ETagの計算などに使用）。"""
+
+    @abstractmethod
+    def add_message(self, room_name: str, sender: str, message: str, message_type: str, timestamp: str,
+                    blob: Optional[str] = None) -> int:
+        """メッセージを追加し、割り当てられたIDを返します。blob は本文のブロブのハッシュです。"""
+
+    def add_messages(self, room_name: str, messages: Sequence[Tuple[str, str, str, str, Optional[str]]]) -> List[int]:
+        """
+        (sender, message, message_type, timestamp, blob) のリストをまとめて追加し、割り当てられたIDのリストを返します。
+        エンジンが1回の書き込み（トランザクション）で追加できる場合はオーバーライドします。
+        """
+        return [self.add_message(room_name, *message) for message in messages]
+
+    @abstractmethod
+    def get_messages(self, room_name: str, limit: int = 100, after_id: Optional[int] = None,
+                     before_id: Optional[int] = None, exclude_types: Sequence[str] = ()) -> List[Dict[str, Any]]:
+        """
+        ルームのメッセージをIDの昇順で返します。
+        - after_id を指定すると、そのIDより新しいメッセージを古い順に最大 limit 件返します。
+        - それ以外は最新の limit 件（before_id 指定時はそのIDより古いもの）を返します。
+        - exclude_types に指定した種類のメッセージは除外します。
+        """
+
+    def get_messages_json(self, room_name: str, limit: int = 100, after_id: Optional[int] = None,
+                          before_id: Optional[int] = None) -> bytes:
+        """
+        get_messages と同じメッセージを、APIの形式（ChatMessage のリスト）のJSONバイト列で返します。
+        エンジンが直接JSONを生成できる場合はオーバーライドします。
+        """
+        return encode_messages(self.get_messages(room_name, limit=limit, after_id=after_id, before_id=before_id),
+                               room=room_name)
+
+    @abstractmethod
+    def latest_id(self, room_name: str) -> Optional[int]:
+        """ルームの最新メッセージのIDを返します。メッセージがない場合はNoneを返します。"""
+
+    def sync(self):
+        """書き込みを永続化します。書き込みごとに永続化するエンジンでは何もしません。"""
+
+    def close(self):
+        """保存先を閉じます。"""
+
+class SqliteStore(MessageStore):
+    """SQLiteデータベースを使う保存先。接続は1つを使い回します。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = db.get_db(path, check_same_thread=False)
+        db.init_db(self._conn)
+        self._lock = threading.Lock()
+
+    @property
+    def identity(self) -> str:
+        return f"sqlite:{self.path}"
+
+    def add_message(self, room_name: str, sender: str, message: str, message_type: str, timestamp: str,
+                    blob: Optional[str] = None) -> int:
+        with self._lock:
+            return db.add_message(self._conn, room_name, sender, message, message_type, timestamp, blob)
+
+    def add_messages(self, room_name: str, messages: Sequence[Tuple[str, str, str, str, Optional[str]]]) -> List[int]:
+        with self._lock:
+            return db.add_messages(self._conn, room_name, messages)
+
+    def get_messages(self, room_name: str, limit: int = 100, after_id: Optional[int] = None,
+                     before_id: Optional[int] = None, exclude_types: Sequence[str] = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            return db.get_messages_for_room(self._conn, room_name, limit=limit, after_id=after_id,
+                                            before_id=before_id, exclude_types=exclude_types)
+
+    def get_messages_json(self, room_name: str, limit: int = 100, after_id: Optional[int] = None,
+                          before_id: Optional[int] = None) -> bytes:
+        with self._lock:
+            return db.get_messages_json(self._conn, room_name, limit=limit, after_id=after_id, before_id=before_id)
+
+    def latest_id(self, room_name: str) -> Optional[int]:
+        with self._lock:
+            return db.get_latest_message_id(self._conn, room_name)
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+
+def open_storage(engine: str, path: Optional[str] = None, **options: Any) -> MessageStore:
+    """エンジン名と保存先のパスからストレージを開きます。"""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown storage engine '{engine}'. Choose from: {', '.join(ENGINES)}")
+    path = path or DEFAULT_PATHS[engine]
+    if engine == "log":
+        from llm_agentchat.server.segment_log import SegmentLogStore
+        return SegmentLogStore(path, **options)
+    return SqliteStore(path)
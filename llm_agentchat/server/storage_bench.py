@@ -0,0 +1,303 @@
+# ストレージ層のマイクロベンチマーク
+#
+# 実運用に近い規模（数百万行・数千ルーム）の履歴をディスク上に合成し、各ストレージエンジンについて
+# 次の値を計測します（benchmarks/bench_storage.py から実行します）。
+# - 書き込みのスループット（1件ずつの add_message と、add_messages によるまとめ書き）
+# - 直近のウィンドウの読み込み（get_messages / get_messages_json）、ブートストラップ、最新IDの取得
+# - before_id による過去ページのページング
+# - エージェントの長期記憶（FTS5）による検索
+# - ディスク上のサイズ（SQLiteはテーブル・インデックスごとのサイズと各クエリが使うインデックスも表示）
+# 合成した履歴は保存先のディレクトリに残し、同じ規模で再実行するときは再利用します。
+# 結果はしきい値ファイル（benchmarks/storage_thresholds.json）と比較でき、性能の退行を検出できます。
+import itertools
+import json
+import os
+import random
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import llm_agentchat.server.db as db
+from llm_agentchat.server.bootstrap import EXCLUDED_TYPES
+from llm_agentchat.server.storage import ENGINES, MessageStore, open_storage
+
+# 合成するメッセージの語彙（検索のクエリにも使う）。頻出語と、Zipf分布で現れる多数の合成語からなる
+_COMMON_WORDS = (
+    "deploy review refactor test bug fix api schema index query latency cache token model prompt agent room "
+    "websocket sqlite segment batch commit rollback migration config persona summary memory trace profile "
+    "実装 設計 レビュー テスト 修正 性能 遅延 索引 検索 要約 履歴 設定 障害 確認 提案 方針 決定"
+).split()
+_SYLLABLES = "ka ri to mu se na zo pe lu ji be ko da fi ra no su we ga hi".split()
+
+def _build_vocabulary(size: int = 5000) -> Tuple[List[str], List[float]]:
+    rng = random.Random("vocabulary")
+    words = list(_COMMON_WORDS)
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    # 累積の重み（rng.choices に渡すと呼び出しごとの累積の計算を省ける）
+    return words, list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+
+_WORDS, _WORD_CUM_WEIGHTS = _build_vocabulary()
+_SENDERS = ("human", "ProgrammerAgent", "ReviewerAgent", "ResearcherAgent", "PlannerAgent")
+MANIFEST = "manifest.json"
+
+def _percentile(samples: Sequence[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def _room_weights(rooms: int, skew: float = 1.1) -> List[float]:
+    """ルームごとのメッセージの割合（Zipf分布。少数のルームに会話が集中する）。"""
+    return [1.0 / (rank + 1) ** skew for rank in range(rooms)]
+
+def room_name(index: int) -> str:
+    return f"room-{index:05d}"
+
+def synthetic_message(rng: random.Random) -> Tuple[str, str, str]:
+    """(sender, message, message_type) を1件合成します。本文の長さは対数正規分布に従います。"""
+    kind = rng.random()
+    if kind < 0.03:
+        return "system", f"{rng.choice(_SENDERS)} joined the chat.", "system"
+    words = max(3, min(400, int(rng.lognormvariate(3.0, 0.9))))
+    text = " ".join(rng.choices(_WORDS, cum_weights=_WORD_CUM_WEIGHTS, k=words))
+    return rng.choice(_SENDERS), text, "tool" if kind < 0.08 else "chat"
+
+def generate_rows(rows: int, rooms: int, seed: int, chunk: int = 50000):
+    """ルームごとにまとめた (room, [(sender, message, type, timestamp, blob), ...]) を chunk 件ずつ生成します。"""
+    rng = random.Random(seed)
+    weights = _room_weights(rooms)
+    base = 1_700_000_000
+    produced = 0
+    while produced < rows:
+        size = min(chunk, rows - produced)
+        grouped: Dict[int, List[Tuple[str, str, str, str, Optional[str]]]] = {}
+        for room in rng.choices(range(rooms), weights=weights, k=size):
+            sender, message, message_type = synthetic_message(rng)
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(base + produced))
+            grouped.setdefault(room, []).append((sender, message, message_type, timestamp, None))
+            produced += 1
+        for room, messages in grouped.items():
+            yield room_name(room), messages
+
+def dataset_path(engine: str, root: str, rows: int, rooms: int, seed: int) -> str:
+    name = f"{engine}-{rows}-{rooms}-{seed}"
+    return os.path.join(root, name + (".db" if engine == "sqlite" else ""))
+
+def prepare_dataset(engine: str, root: str, rows: int, rooms: int, seed: int = 0,
+                    log: Callable[[str], None] = print) -> str:
+    """
+    合成した履歴を保存先に作成してパスを返します。同じ規模の履歴がすでにあれば再利用します。
+    生成はベンチマークの対象ではないため、SQLiteは同期書き込みを無効にした接続で一括して書き込みます。
+    """
+    os.makedirs(root, exist_ok=True)
+    path = dataset_path(engine, root, rows, rooms, seed)
+    manifest_path = path + "." + MANIFEST
+    if os.path.exists(manifest_path):
+        return path
+    log(f"Generating {rows:,} messages across {rooms:,} rooms for {engine} at {path} ...")
+    started = time.perf_counter()
+    if engine == "sqlite":
+        if os.path.exists(path):
+            os.remove(path)
+        conn = db.get_db(path)
+        db.init_db(conn)
+        conn.execute("PRAGMA synchronous=OFF")
+        for room, messages in generate_rows(rows, rooms, seed):
+            conn.executemany(
+                "INSERT INTO messages (room_name, sender, message_content, message_type, timestamp, blob_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(room, *message) for message in messages],
+            )
+        conn.commit()
+        conn.close()
+    else:
+        store = open_storage(engine, path, fsync_interval=3600.0, fsync_batch=2**31)
+        for room, messages in generate_rows(rows, rooms, seed):
+            store.add_messages(room, messages)
+        store.close()
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"engine": engine, "rows": rows, "rooms": rooms, "seed": seed}, f)
+    log(f"  generated in {time.perf_counter() - started:.1f} s")
+    return path
+
+def disk_size(path: str) -> int:
+    """ファイルまたはディレクトリ以下の合計サイズ（バイト）。"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+def sqlite_details(path: str) -> Dict[str, Any]:
+    """SQLiteのテーブル・インデックスごとのサイズと、各クエリが使うインデックス（EXPLAIN QUERY PLAN）。"""
+    conn = sqlite3.connect(path)
+    try:
+        try:
+            sizes = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+        except sqlite3.OperationalError:
+            sizes = {} # dbstat なしでビルドされたSQLite
+        plans = {}
+        queries = {
+            "recent": db._page_query("id", None, None, ()),
+            "after": db._page_query("id", 1, None, ()),
+            "bootstrap": db._page_query("id", None, None, EXCLUDED_TYPES),
+        }
+        for name, (sql, params) in queries.items():
+            rows = conn.execute("EXPLAIN QUERY PLAN " + sql, (room_name(0), *params, 50)).fetchall()
+            plans[name] = "; ".join(row[-1] for row in rows)
+        rows = conn.execute("EXPLAIN QUERY PLAN SELECT MAX(id) FROM messages WHERE room_name = ?",
+                            (room_name(0),)).fetchall()
+        plans["latest_id"] = "; ".join(row[-1] for row in rows)
+    finally:
+        conn.close()
+    return {"object_bytes": sizes, "plans": plans}
+
+def _timed(samples: List[float], func: Callable[[], Any]) -> Any:
+    started = time.perf_counter()
+    result = func()
+    samples.append((time.perf_counter() - started) * 1000)
+    return result
+
+def measure_reads(store: MessageStore, rooms: int, rng: random.Random, queries: int) -> Dict[str, float]:
+    """直近のウィンドウ・ブートストラップ・最新IDの読み込みの待ち時間（ミリ秒）を計測します。"""
+    weights = _room_weights(rooms)
+    targets = [room_name(i) for i in rng.choices(range(rooms), weights=weights, k=queries)]
+    recent, recent_json, bootstrap, latest = [], [], [], []
+    for room in targets:
+        _timed(recent, lambda: store.get_messages(room, limit=50))
+        _timed(recent_json, lambda: store.get_messages_json(room, limit=50))
+        _timed(bootstrap, lambda: store.get_messages(room, limit=20, exclude_types=EXCLUDED_TYPES))
+        _timed(latest, lambda: store.latest_id(room))
+    return {
+        "recent_p50_ms": _percentile(recent, 0.5),
+        "recent_p95_ms": _percentile(recent, 0.95),
+        "recent_json_p95_ms": _percentile(recent_json, 0.95),
+        "bootstrap_p95_ms": _percentile(bootstrap, 0.95),
+        "latest_id_p95_ms": _percentile(latest, 0.95),
+    }
+
+def measure_pagination(store: MessageStore, rooms: int, pages: int = 10, page_size: int = 50,
+                       walks: int = 20) -> Dict[str, float]:
+    """会話の多いルームを最新から before_id で pages ページさかのぼる1ページあたりの待ち時間を計測します。"""
+    samples: List[float] = []
+    for index in range(min(walks, rooms)):
+        room = room_name(index)
+        before_id = None
+        for _ in range(pages):
+            page = _timed(samples, lambda: store.get_messages(room, limit=page_size, before_id=before_id))
+            if not page:
+                break
+            before_id = page[0]["id"]
+    return {"page_p50_ms": _percentile(samples, 0.5), "page_p95_ms": _percentile(samples, 0.95)}
+
+def measure_inserts(store: MessageStore, rooms: int, rng: random.Random, count: int,
+                    batch_size: int = 100) -> Dict[str, float]:
+    """1件ずつの書き込みと、batch_size 件ずつのまとめ書きのスループット（件/秒）を計測します。"""
+    weights = _room_weights(rooms)
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())
+
+    def message():
+        sender, text, message_type = synthetic_message(rng)
+        return sender, text, message_type, stamp, None
+
+    targets = [room_name(i) for i in rng.choices(range(rooms), weights=weights, k=count)]
+    started = time.perf_counter()
+    for room in targets:
+        store.add_message(room, *message())
+    store.sync()
+    single = count / (time.perf_counter() - started)
+
+    batches = [(room_name(i), [message() for _ in range(batch_size)])
+               for i in rng.choices(range(rooms), weights=weights, k=max(1, count // batch_size))]
+    started = time.perf_counter()
+    for room, messages in batches:
+        store.add_messages(room, messages)
+    store.sync()
+    batched = len(batches) * batch_size / (time.perf_counter() - started)
+    return {"insert_single_rows_per_s": single, "insert_batch_rows_per_s": batched}
+
+def measure_memory_search(messages: int, rng: random.Random, queries: int = 200) -> Dict[str, float]:
+    """エージェントの長期記憶（FTS5）に messages 件を索引付けしたときの検索の待ち時間を計測します。"""
+    from llm_agentchat.client.memory import AgentMemory
+    memory = AgentMemory()
+    started = time.perf_counter()
+    batch = []
+    for _ in range(messages):
+        sender, text, _ = synthetic_message(rng)
+        batch.append((sender, text))
+        if len(batch) >= 1000:
+            memory.add_many(batch)
+            batch = []
+    if batch:
+        memory.add_many(batch)
+    indexed = messages / (time.perf_counter() - started)
+    samples: List[float] = []
+    for _ in range(queries):
+        query = " ".join(rng.choices(_WORDS, cum_weights=_WORD_CUM_WEIGHTS, k=8))
+        _timed(samples, lambda: memory.search(query, k=5, before_seq=memory.count - 10))
+    memory.close()
+    return {"memory_index_rows_per_s": indexed, "memory_search_p95_ms": _percentile(samples, 0.95)}
+
+def run_suite(root: str, engines: Sequence[str] = ENGINES, rows: int = 1_000_000, rooms: int = 2000,
+              seed: int = 0, queries: int = 300, inserts: int = 2000, memory_messages: int = 20000,
+              log: Callable[[str], None] = print) -> Dict[str, Any]:
+    """全ての計測を行い、エンジンごとの結果を返します。"""
+    results: Dict[str, Any] = {"dataset": {"rows": rows, "rooms": rooms, "seed": seed}}
+    for engine in engines:
+        path = prepare_dataset(engine, root, rows, rooms, seed, log=log)
+        rng = random.Random(seed + 1)
+        store = open_storage(engine, path)
+        try:
+            metrics: Dict[str, Any] = {"bytes_per_row": disk_size(path) / rows}
+            metrics.update(measure_reads(store, rooms, rng, queries))
+            metrics.update(measure_pagination(store, rooms))
+            metrics.update(measure_inserts(store, rooms, rng, inserts))
+        finally:
+            store.close()
+        if engine == "sqlite":
+            metrics["details"] = sqlite_details(path)
+        results[engine] = metrics
+    if memory_messages:
+        results["memory"] = measure_memory_search(memory_messages, random.Random(seed + 2))
+    return results
+
+def check_thresholds(results: Dict[str, Any], thresholds: Dict[str, Any]) -> List[str]:
+    """
+    結果をしきい値と比較し、退行した項目の説明のリストを返します（空なら合格）。
+    しきい値は {"<エンジン>": {"<指標>": {"min": ...} または {"max": ...}}} の形式です。
+    """
+    failures = []
+    for section, limits in thresholds.items():
+        if section.startswith("_") or section == "dataset" or section not in results:
+            continue
+        for metric, bound in limits.items():
+            value = results[section].get(metric)
+            if value is None:
+                failures.append(f"{section}.{metric}: not measured")
+            elif "min" in bound and value < bound["min"]:
+                failures.append(f"{section}.{metric}: {value:,.2f} < min {bound['min']:,}")
+            elif "max" in bound and value > bound["max"]:
+                failures.append(f"{section}.{metric}: {value:,.2f} > max {bound['max']:,}")
+    return failures
+
+def format_results(results: Dict[str, Any]) -> str:
+    """結果を表形式の文字列にします。"""
+    dataset = results["dataset"]
+    lines = [f"Dataset: {dataset['rows']:,} messages across {dataset['rooms']:,} rooms (seed {dataset['seed']})"]
+    for section, metrics in results.items():
+        if section == "dataset":
+            continue
+        lines.append("")
+        lines.append(f"[{section}]")
+        for metric, value in metrics.items():
+            if metric == "details":
+                continue
+            lines.append(f"  {metric:<28} {value:>14,.2f}")
+        details = metrics.get("details")
+        if details:
+            for name, size in sorted(details["object_bytes"].items(), key=lambda item: -item[1]):
+                lines.append(f"  size {name:<23} {size / 1024 / 1024:>11,.1f} MB")
+            for name, plan in details["plans"].items():
+                lines.append(f"  plan {name:<10} {plan}")
+    return "\n".join(lines)
@@ -0,0 +1,254 @@
+# メッセージ単位のレイテンシトレースとサンプリング付きロギング
+#
+# 各メッセージはサーバーの受信時に trace_id を割り当てられ、処理の各段階で
+# タイミングマーク（received, persisted, broadcast, agent_received, delay_end,
+# llm_start, llm_end, reply_sent）が記録されます。マークはJSONLファイル、または
+# OpenTelemetry（インストールされている場合）のスパンとして出力でき、
+# `llm agentchat-trace` コマンドでメッセージごとの内訳として表示できます。
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 処理段階の順序（内訳表示の並び替えに使用）
+STAGES = (
+    "received",
+    "persisted",
+    "broadcast",
+    "agent_received",
+    "delay_end",
+    "llm_start",
+    "llm_end",
+    "reply_sent",
+)
+
+def new_trace_id() -> str:
+    """新しいトレースIDを生成します（OpenTelemetryと同じ128bitの16進文字列）。"""
+    return uuid.uuid4().hex
+
+def is_sampled(trace_id: Optional[str], rate: float) -> bool:
+    """
+    トレースIDから決定的にサンプリング対象かどうかを判定します。
+    サーバーとエージェントが同じ判定になるため、サンプリングの有無を伝搬する必要がありません。
+    """
+    if rate >= 1.0:
+        return True
+    if rate <= 0.0 or not trace_id:
+        return False
+    try:
+        return int(trace_id[:8], 16) / 0xFFFFFFFF < rate
+    except ValueError:
+        return False
+
+class JsonlTraceExporter:
+    """トレースレコードを1行1JSONでファイルに追記するエクスポータ。"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def export(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class OpenTelemetryExporter:
+    """
+    同一トレース・同一サービス内の連続するマークの区間をOpenTelemetryのスパンとして出力するエクスポータ。
+    `opentelemetry-api` が必要です（SDKやエクスポータの設定は利用者側で行います）。
+    """
+    def __init__(self, service: str):
+        from opentelemetry import trace as otel_trace # 任意依存
+        self._tracer = otel_trace.get_tracer("llm_agentchat", schema_url=None)
+        self.service = service
+        self._last_marks: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def export(self, record: Dict[str, Any]):
+        key = f"{record['trace_id']}:{record.get('agent') or ''}"
+        with self._lock:
+            previous = self._last_marks.get(key)
+            self._last_marks[key] = record
+            if len(self._last_marks) > 10000:
+                # 古いトレースの状態を捨ててメモリを制限する
+                self._last_marks.pop(next(iter(self._last_marks)))
+        if previous is None:
+            return
+        span = self._tracer.start_span(
+            f"{previous['name']}->{record['name']}",
+            start_time=int(previous["ts"] * 1e9),
+            attributes={
+                "agentchat.trace_id": record["trace_id"],
+                "agentchat.service": self.service,
+                "agentchat.agent": record.get("agent") or "",
+                "agentchat.room": record.get("room") or "",
+            },
+        )
+        span.end(end_time=int(record["ts"] * 1e9))
+
+    def close(self):
+        pass
+
+class Tracer:
+    """
+    メッセージにタイミングマークを付け、有効なエクスポータに出力するクラス。
+    エクスポータが1つもない場合は、トレースIDの割り当てのみ行います（マークの記録と出力は省略）。
+    """
+    def __init__(self, service: str, exporters: Optional[List[Any]] = None, sample_rate: float = 1.0):
+        self.service = service
+        self.exporters = exporters or []
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    def ensure_trace(self, message: Dict[str, Any]) -> str:
+        """メッセージにトレースIDがなければ割り当てて返します。"""
+        trace_id = message.get("trace_id")
+        if not trace_id:
+            trace_id = new_trace_id()
+            message["trace_id"] = trace_id
+        return trace_id
+
+    def mark(self, message: Dict[str, Any], name: str, carry: bool = True, **attributes: Any) -> float:
+        """
+        メッセージにタイミングマークを記録します。
+        carry=Trueの場合はメッセージの `trace` フィールドにもマークを残し、下流のプロセスに伝えます
+        （トレースが無効な場合は、配信するフレームを大きくしないよう `trace` フィールドを付けない）。
+        """
+        ts = time.time()
+        trace_id = self.ensure_trace(message)
+        if carry and self.enabled:
+            message.setdefault("trace", {})[name] = ts
+        self.record(trace_id, name, ts, room=message.get("room"), **attributes)
+        return ts
+
+    def record(self, trace_id: Optional[str], name: str, ts: Optional[float] = None, **attributes: Any):
+        """トレースIDに対するマークをエクスポータに出力します（メッセージを持たない場合に使用）。"""
+        if not self.exporters or not trace_id or not is_sampled(trace_id, self.sample_rate):
+            return
+        record = {"trace_id": trace_id, "name": name, "ts": ts if ts is not None else time.time(), "service": self.service}
+        record.update({k: v for k, v in attributes.items() if v is not None})
+        for exporter in self.exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                logger.warning("Failed to export trace record: %s", e)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+_tracer = Tracer("agentchat")
+
+def configure_tracing(service: str, trace_file: Optional[str] = None, otel: bool = False,
+                      sample_rate: Optional[float] = None) -> Tracer:
+    """
+    プロセス全体で使うトレーサーを設定します。
+    引数が省略された場合は環境変数 AGENTCHAT_TRACE_FILE / AGENTCHAT_TRACE_OTEL /
+    AGENTCHAT_TRACE_SAMPLE_RATE の値を使います。
+    """
+    global _tracer
+    trace_file = trace_file or os.environ.get("AGENTCHAT_TRACE_FILE")
+    otel = otel or os.environ.get("AGENTCHAT_TRACE_OTEL", "") not in ("", "0", "false")
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("AGENTCHAT_TRACE_SAMPLE_RATE", "1.0"))
+
+    exporters: List[Any] = []
+    if trace_file:
+        exporters.append(JsonlTraceExporter(trace_file))
+    if otel:
+        try:
+            exporters.append(OpenTelemetryExporter(service))
+        except ImportError:
+            logger.warning("opentelemetry-api is not installed. OpenTelemetry export is disabled.")
+    _tracer.close()
+    _tracer = Tracer(service, exporters, sample_rate)
+    return _tracer
+
+def get_tracer() -> Tracer:
+    """設定済みのトレーサーを返します。"""
+    return _tracer
+
+# ---------------------------------------------------------------------------
+# サンプリング付きロギング
+# ---------------------------------------------------------------------------
+
+_log_sample_rate = float(os.environ.get("AGENTCHAT_LOG_SAMPLE_RATE", "1.0"))
+
+def set_log_sample_rate(rate: float):
+    """メッセージ単位のログ（送受信ログ）のサンプリング率を設定します（0.0〜1.0）。"""
+    global _log_sample_rate
+    _log_sample_rate = max(0.0, min(1.0, rate))
+
+def log_sampled(log: logging.Logger, level: int, msg: str, *args: Any):
+    """
+    メッセージごとに出力されるログをサンプリングして出力します。
+    ログレベルが無効な場合は引数のフォーマットも行いません。
+    """
+    if not log.isEnabledFor(level):
+        return
+    if _log_sample_rate < 1.0 and random.random() >= _log_sample_rate:
+        return
+    log.log(level, msg, *args)
+
+def configure_logging(level: str = "INFO", sample_rate: Optional[float] = None):
+    """CLIから呼び出され、ログレベルとサンプリング率を設定します。"""
+    logging.basicConfig(
+        level=getattr(logging, level.upper(), logging.INFO),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    if sample_rate is not None:
+        set_log_sample_rate(sample_rate)
+
+# ---------------------------------------------------------------------------
+# 内訳の表示
+# ---------------------------------------------------------------------------
+
+def load_trace_records(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    """1つ以上のJSONLトレースファイル（サーバーとエージェントの両方など）を読み込みます。"""
+    records: List[Dict[str, Any]] = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+def group_by_trace(records: Iterable[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """レコードをトレースIDごとにまとめ、時刻順に並べます。"""
+    traces: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        traces.setdefault(record["trace_id"], []).append(record)
+    for marks in traces.values():
+        marks.sort(key=lambda r: (r["ts"], STAGES.index(r["name"]) if r["name"] in STAGES else len(STAGES)))
+    return traces
+
+def format_breakdown(trace_id: str, marks: List[Dict[str, Any]]) -> str:
+    """1つのトレースについて、段階ごとの経過時間を表形式の文字列にします。"""
+    if not marks:
+        return f"trace {trace_id}: no records"
+    start = marks[0]["ts"]
+    lines = [f"trace {trace_id} ({marks[0].get('room') or '-'}) total {(marks[-1]['ts'] - start) * 1000:.1f} ms"]
+    previous_by_actor: Dict[str, float] = {}
+    for record in marks:
+        actor = record.get("agent") or record.get("service", "")
+        # 同じエージェント内の直前のマークからの差分（エージェント側は並行して進むため）
+        previous = previous_by_actor.get(actor, previous_by_actor.get("server", start))
+        delta = (record["ts"] - previous) * 1000
+        offset = (record["ts"] - start) * 1000
+        lines.append(f"  {offset:9.1f} ms  +{delta:8.1f} ms  {record['name']:<15} {actor}")
+        previous_by_actor[actor] = record["ts"]
+    return "\n".join(lines)
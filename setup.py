@@ -14,11 +14,13 @@ setup(
     packages=find_packages(),
     entry_points={"llm": ["agentchat = llm_agentchat"]},
     install_requires=[
-        "llm",
+        "llm>=0.26",
         "llm-gemini",
         "fastapi",
         "uvicorn[standard]",
         "websockets",
+        "httpx",
+        "pydantic>=2",
         "PyYAML",
     ],
     python_requires=">=3.9",
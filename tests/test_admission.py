@@ -0,0 +1,120 @@
+import asyncio
+import pytest
+
+try:
+    from llm_agentchat.server.admission import AdmissionController, request_priority
+    _admission_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _admission_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from starlette.websockets import WebSocketDisconnect
+    from llm_agentchat.server import app as app_module
+    from llm_agentchat.server.app import app, admission, active_connections, loop_lag
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+
+pytestmark = pytest.mark.skipif(not _admission_module_found, reason="llm_agentchat.server.admission not found")
+
+def test_limits_reserve_headroom_for_agents():
+    controller = AdmissionController()
+    controller.configure(max_connections=10, max_room_connections=5, lag_threshold=0, backlog_threshold=0)
+    for _ in range(4):
+        assert controller.check_connection("room1", "observer") is None
+        controller.open_connection("room1")
+    # 観察者はルームの上限の8割（4）までしか使えない
+    assert controller.check_connection("room1", "observer") == ("room connections", 2)
+    assert controller.check_connection("room1", "agent") is None
+    controller.open_connection("room1")
+    assert controller.check_connection("room1", "agent") == ("room connections", 2)
+    controller.close_connection("room1")
+    assert controller.check_connection("room1", "agent") is None
+    assert controller.shed[("observer", "room connections")] == 1
+
+def test_overload_sheds_observers_first_then_agents():
+    backlog = [0]
+    lag = [0.0]
+    controller = AdmissionController(backlog=lambda: backlog[0], lag=lambda: lag[0])
+    controller.configure(lag_threshold=0.1, backlog_threshold=100)
+    assert controller.overload_level() == 0
+    lag[0] = 0.15
+    assert controller.overload_level() == 1
+    assert controller.check_request("observer") == ("overloaded", 2)
+    assert controller.check_request("agent") is None
+    lag[0] = 0.0
+    backlog[0] = 400
+    assert controller.overload_level() == 2
+    assert controller.check_overload("agent") == ("critical", 2)
+    assert controller.check_request("human") is None
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+def test_server_sheds_observers_with_503_and_1013():
+    """過負荷のとき、観察者は503・1013で断られ、人間の投稿とエージェントの接続は受け入れられることをテストします。"""
+    app.state.db_path = ":memory:"
+    active_connections.clear()
+    client = TestClient(app)
+    lag = [0.2]
+    admission.configure(lag_threshold=0.1, backlog_threshold=0)
+    admission.lag = lambda: lag[0]
+    try:
+        response = client.get("/api/messages?room=shed-room")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "2"
+        # エージェントの履歴の取得（エージェント名のヘッダー付き）は観察者より優先して受け入れる
+        assert request_priority("GET", "/api/bootstrap", from_agent=True) == "agent"
+        response = client.get("/api/messages?room=shed-room", headers={"X-Agent-Name": "Alice"})
+        assert response.status_code == 200
+        response = client.get("/api/rooms/shed-room/stream")
+        assert response.status_code == 503
+
+        with client.websocket_connect("/ws?room=shed-room&agent=human") as observer:
+            with pytest.raises(WebSocketDisconnect) as closed:
+                observer.receive_json()
+            assert closed.value.code == 1013
+
+        with client.websocket_connect("/ws?room=shed-room&agent=Alice") as alice:
+            response = client.post("/api/message", json={"room": "shed-room", "sender": "human", "message": "stop!"})
+            assert response.status_code == 200
+            assert alice.receive_json()["message"] == "stop!"
+            assert admission.total_connections == 1
+
+            # 深刻な過負荷ではエージェントの投稿も断る
+            lag[0] = 0.5
+            response = client.post("/api/message", json={"room": "shed-room", "sender": "Alice", "message": "hi"})
+            assert response.status_code == 503
+    finally:
+        admission.configure()
+        admission.lag = loop_lag
+
+class SlowConnection:
+    """送信が終わらない（受信の遅い）接続。"""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+
+    async def send_text(self, payload):
+        self.started.set()
+        await asyncio.sleep(10)
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+@pytest.mark.asyncio
+async def test_slow_consumers_count_as_outbound_backlog():
+    """遅い接続への送信待ちのフレームが配信待ちとして数えられ、過負荷の判定に使われることをテストします。"""
+    slow, other = SlowConnection(), SlowConnection()
+    active_connections["slow-room"] = {"Alice": slow, "Bob": other}
+    admission.configure(lag_threshold=0, backlog_threshold=2)
+    try:
+        message = {"room": "slow-room", "sender": "human", "message": "hi", "type": "chat"}
+        sending = asyncio.create_task(app_module.broadcast_message("slow-room", message))
+        await asyncio.wait_for(slow.started.wait(), 1)
+        assert app_module.outbound_backlog() == 2
+        assert admission.overload_level() == 1
+        sending.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await sending
+        assert app_module.outbound_backlog() == 0
+    finally:
+        active_connections.pop("slow-room", None)
+        admission.configure()
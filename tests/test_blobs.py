@@ -0,0 +1,84 @@
+import threading
+import pytest
+from unittest.mock import patch
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server.app import app, store_large_body
+    from llm_agentchat.server.blobs import BlobStore, blob_hash
+    _blobs_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _blobs_module_found = False
+
+pytestmark = pytest.mark.skipif(not _blobs_module_found, reason="llm_agentchat.server.blobs not found")
+
+def test_blob_store_deduplicates_and_compresses(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    body = ("def handler():\n    return 42\n" * 500).encode("utf-8")
+    key = store.put(body)
+    assert key == blob_hash(body)
+    assert store.put(body) == key
+    files = list((tmp_path / "blobs").rglob("*.gz"))
+    assert len(files) == 1
+    assert files[0].stat().st_size < len(body) / 10
+    assert store.get(key) == body
+    assert store.exists(key) and not store.exists("0" * 64) and not store.exists("../etc/passwd")
+    assert store.get("0" * 64) is None
+    assert store.get("../etc/passwd") is None
+
+@pytest.mark.parametrize("engine", ["sqlite", "log"])
+def test_large_message_is_sent_as_preview_and_reference(tmp_path, engine):
+    settings = ("storage_engine", "db_path", "blob_threshold")
+    saved = {name: getattr(app.state, name) for name in settings if hasattr(app.state, name)}
+    app.state.storage_engine = engine
+    app.state.db_path = str(tmp_path / "chat")
+    app.state.blob_threshold = 1024
+    body = "print('hello')\n" * 1000
+    try:
+        with TestClient(app) as client:
+            with client.websocket_connect("/ws?room=blobs&agent=observer") as ws:
+                client.post("/api/message", json={"room": "blobs", "sender": "human", "message": "short"})
+                client.post("/api/message", json={"room": "blobs", "sender": "human", "message": body})
+                assert "blob" not in ws.receive_json()
+                frame = ws.receive_json()
+            assert len(frame["message"]) < 1000
+            assert frame["blob"] == blob_hash(body.encode("utf-8"))
+
+            history = client.get("/api/messages?room=blobs").json()
+            assert [m.get("blob") for m in history] == [None, frame["blob"]]
+            assert history[1]["message"] == frame["message"]
+
+            response = client.get(f"/api/blobs/{frame['blob']}")
+            assert response.status_code == 200
+            assert response.text == body
+            assert response.headers["content-encoding"] == "gzip"
+            assert "immutable" in response.headers["cache-control"]
+            cached = client.get(f"/api/blobs/{frame['blob']}", headers={"If-None-Match": response.headers["etag"]})
+            assert cached.status_code == 304
+            assert client.get(f"/api/blobs/{'0' * 64}").status_code == 404
+            # 存在しないブロブは If-None-Match: * でも304ではなく404
+            assert client.get(f"/api/blobs/{'0' * 64}", headers={"If-None-Match": "*"}).status_code == 404
+    finally:
+        for name in settings:
+            if name in saved:
+                setattr(app.state, name, saved[name])
+            else:
+                delattr(app.state, name)
+
+@pytest.mark.asyncio
+async def test_large_body_is_written_off_the_event_loop(tmp_path):
+    """ブロブの圧縮と書き込みがイベントループのスレッドの外で行われることを確認します。"""
+    store = BlobStore(str(tmp_path / "blobs"))
+    writers = []
+    put = store.put
+
+    def recording_put(data):
+        writers.append(threading.get_ident())
+        return put(data)
+
+    store.put = recording_put
+    message = {"message": "x" * (1 << 20)}
+    with patch("llm_agentchat.server.app.get_blob_store", return_value=store):
+        key = await store_large_body(message)
+    assert message["blob"] == key and store.exists(key)
+    assert writers and writers[0] != threading.get_ident()
@@ -27,3 +27,91 @@ def test_agent_initialization(agent_config):
     assert agent.model == "gpt-3.5-turbo"
     assert agent.persona == "You are a test assistant."
 
+
+@pytest.mark.skipif(not _agent_module_found, reason="llm_agentchat.client.agent module not found")
+@pytest.mark.asyncio
+async def test_agent_stops_listening_when_client_closes(agent_config):
+    """WebSocketクライアントが停止したらstart_listeningが終了することをテストします。"""
+    import asyncio
+    agent = Agent(config=agent_config, room_name="test_room", server_url="ws://localhost:8000", common_settings={})
+    ws_client = MagicMock()
+    ws_client.closed = asyncio.Event()
+    agent.set_websocket_client(ws_client)
+
+    listening = asyncio.create_task(agent.start_listening())
+    await asyncio.sleep(0.01)
+    assert not listening.done()
+    ws_client.closed.set()
+    await asyncio.wait_for(listening, timeout=1)
+
+
+@pytest.mark.skipif(not _agent_module_found, reason="llm_agentchat.client.agent module not found")
+@pytest.mark.asyncio
+async def test_agent_bootstrap_loads_history(agent_config):
+    """起動時に1回のリクエストで会話履歴と要約を読み込むことをテストします。"""
+    import httpx
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={
+            "room": "test_room",
+            "last_id": 7,
+            "summary": "Earlier in this room: 5 messages from human (5).",
+            "messages": [
+                {"id": 6, "sender": "human", "message": "hi", "type": "chat"},
+                {"id": 7, "sender": "TestAgent", "message": "hello", "type": "chat"},
+            ],
+        })
+
+    agent = Agent(config=agent_config, room_name="test_room", server_url="ws://localhost:8000",
+                  common_settings={"bootstrap_messages": 2, "memory_top_k": 0})
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        with patch('llm_agentchat.client.agent.get_http_client', return_value=http_client):
+            assert await agent.bootstrap() is True
+
+    assert len(requests) == 1
+    assert requests[0].url.path == "/api/bootstrap"
+    assert requests[0].url.params["limit"] == "2"
+    assert [m["message"] for m in agent.chat_history] == ["hi", "hello"]
+    assert agent.context_summary.startswith("Earlier in this room")
+
+
+@pytest.mark.skipif(not _agent_module_found, reason="llm_agentchat.client.agent module not found")
+@pytest.mark.asyncio
+async def test_agent_joins_before_bootstrap_and_keeps_messages_posted_meanwhile(agent_config):
+    """接続してから会話履歴を取得し、その間に投稿されたメッセージを取りこぼさず、重複もしないことをテストします。"""
+    import asyncio
+    import httpx
+    from unittest.mock import AsyncMock
+    events = []
+    agent = Agent(config=agent_config, room_name="test_room", server_url="ws://localhost:8000",
+                  common_settings={"bootstrap_messages": 5, "memory_top_k": 0})
+    agent._respond = AsyncMock()
+    ws_client = MagicMock()
+    ws_client.start.side_effect = lambda: events.append("connect")
+    ws_client.wait_connected = AsyncMock(return_value=True)
+    agent.set_websocket_client(ws_client)
+    delivered = []
+
+    async def handler(request):
+        events.append("bootstrap")
+        # 接続後・スナップショットの前に投稿されたメッセージ（id 7）と、
+        # スナップショットの直後に投稿されたメッセージ（id 8）がWebSocketで届く
+        for message_id, text in ((7, "posted while joining"), (8, "posted after the snapshot")):
+            delivered.append(asyncio.create_task(agent.handle_message_from_server(
+                {"id": message_id, "room": "test_room", "sender": "human", "message": text, "type": "chat"})))
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"room": "test_room", "last_id": 7, "summary": None, "messages": [
+            {"id": 6, "sender": "human", "message": "hi", "type": "chat"},
+            {"id": 7, "sender": "human", "message": "posted while joining", "type": "chat"},
+        ]})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        with patch('llm_agentchat.client.agent.get_http_client', return_value=http_client):
+            assert await agent.join() is True
+            await asyncio.gather(*delivered)
+
+    assert events == ["connect", "bootstrap"]
+    assert [m["message"] for m in agent.chat_history] == ["hi", "posted while joining", "posted after the snapshot"]
+    assert agent._respond.await_args.args[0]["id"] == 8
@@ -23,7 +23,8 @@ def memory_db():
         sender TEXT NOT NULL,
         message_content TEXT NOT NULL,
         timestamp TEXT NOT NULL,
-        message_type TEXT NOT NULL
+        message_type TEXT NOT NULL,
+        blob_hash TEXT
     )
     """)
     conn.commit()
@@ -63,9 +64,9 @@ def test_get_messages_for_room(memory_db):
     conn = memory_db
     # get_messagesをテストするために手動でデータを挿入します
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO messages VALUES (NULL, 'room1', 'agent1', 'msg1', '2023-01-01T12:00:00Z', 'chat')")
-    cursor.execute("INSERT INTO messages VALUES (NULL, 'room2', 'agent2', 'msg2', '2023-01-01T12:01:00Z', 'chat')")
-    cursor.execute("INSERT INTO messages VALUES (NULL, 'room1', 'agent3', 'msg3', '2023-01-01T12:02:00Z', 'chat')")
+    cursor.execute("INSERT INTO messages VALUES (NULL, 'room1', 'agent1', 'msg1', '2023-01-01T12:00:00Z', 'chat', NULL)")
+    cursor.execute("INSERT INTO messages VALUES (NULL, 'room2', 'agent2', 'msg2', '2023-01-01T12:01:00Z', 'chat', NULL)")
+    cursor.execute("INSERT INTO messages VALUES (NULL, 'room1', 'agent3', 'msg3', '2023-01-01T12:02:00Z', 'chat', NULL)")
     conn.commit()
 
     messages = db.get_messages_for_room(conn, "room1")
@@ -73,3 +74,25 @@ def test_get_messages_for_room(memory_db):
     assert len(messages) == 2
     assert messages[0]["sender"] == "agent1"
     assert messages[1]["sender"] == "agent3"
+
+@pytest.mark.skipif(db is None, reason="llm_agentchat.server.db module not found")
+def test_get_messages_for_room_pagination(memory_db):
+    """after_id / before_id によるページングをテストします。"""
+    conn = memory_db
+    ids = [
+        db.add_message(conn, "room1", "agent", f"msg{i}", "chat", f"2023-01-01T12:00:{i:02d}Z")
+        for i in range(5)
+    ]
+
+    # 指定しない場合は最新の limit 件を古い順に返す
+    latest = db.get_messages_for_room(conn, "room1", limit=2)
+    assert [m["message_content"] for m in latest] == ["msg3", "msg4"]
+    assert [m["id"] for m in latest] == ids[3:]
+
+    # 差分同期
+    newer = db.get_messages_for_room(conn, "room1", after_id=ids[2])
+    assert [m["message_content"] for m in newer] == ["msg3", "msg4"]
+
+    # 過去ページ
+    older = db.get_messages_for_room(conn, "room1", limit=2, before_id=ids[3])
+    assert [m["message_content"] for m in older] == ["msg1", "msg2"]
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import pytest
+
+try:
+    from llm_agentchat.client.hedging import HedgePolicy, HedgeStats, run_hedged
+    from llm_agentchat.client.agent import Agent
+    from llm_agentchat.client.mock_model import MOCK_MODEL_ID, configure_mock_model, ensure_mock_model_registered
+    _hedging_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _hedging_module_found = False
+
+pytestmark = pytest.mark.skipif(not _hedging_module_found, reason="llm_agentchat.client.hedging not found")
+
+def fake_attempt(first_token_delay, total_delay, fail=False):
+    cancelled = []
+
+    async def start(notify):
+        try:
+            await asyncio.sleep(first_token_delay)
+            notify()
+            await asyncio.sleep(total_delay - first_token_delay)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        if fail:
+            raise RuntimeError("provider error")
+        return total_delay
+
+    return start, cancelled
+
+@pytest.mark.asyncio
+async def test_hedge_launches_after_deadline_and_cancels_loser():
+    stats = HedgeStats()
+    slow, slow_cancelled = fake_attempt(1.0, 1.0)
+    fast, _ = fake_attempt(0.05, 0.1)
+    policy = HedgePolicy(["fast"], default_delay=0.1)
+
+    started = time.monotonic()
+    winner, result = await run_hedged([("slow", slow), ("fast", fast)], policy, stats)
+    elapsed = time.monotonic() - started
+
+    assert (winner, result) == (1, 0.1)
+    assert elapsed < 0.5
+    await asyncio.sleep(0)
+    assert slow_cancelled == [True]
+    summary = stats.summary()
+    assert summary["fast"]["wins"] == 1 and summary["fast"]["hedges"] == 1
+    assert summary["slow"]["wins"] == 0 and summary["slow"]["launches"] == 1
+
+@pytest.mark.asyncio
+async def test_no_hedge_when_first_token_arrives_in_time():
+    stats = HedgeStats()
+    for _ in range(10):
+        stats.latency["primary"].first_token.append(0.5)
+    primary, _ = fake_attempt(0.05, 0.3)
+    backup, _ = fake_attempt(0.01, 0.02)
+    # 最初のトークンが p95（0.5秒）より前に届けば、応答の完了が遅くても予備のモデルは起動しない
+    winner, _ = await run_hedged([("primary", primary), ("backup", backup)], HedgePolicy(["backup"]), stats)
+    assert winner == 0
+    assert stats.launches["backup"] == 0
+
+@pytest.mark.asyncio
+async def test_latency_of_losing_attempts_is_recorded():
+    stats = HedgeStats()
+    primary, _ = fake_attempt(0.02, 1.0)
+    backup, _ = fake_attempt(0.05, 0.1)
+    winner, _ = await run_hedged([("primary", primary), ("backup", backup)], HedgePolicy(["backup"], "parallel"), stats)
+    assert winner == 1
+    # 負けた主モデルも最初のトークンまでの時間は記録し、完了までの時間は完了した試行だけ記録する
+    assert len(stats.latency["primary"].first_token) == 1
+    assert stats.latency["primary"].first_token[0] < 0.05
+    assert len(stats.latency["primary"].total) == 0
+    assert len(stats.latency["backup"].first_token) == 1 and len(stats.latency["backup"].total) == 1
+
+@pytest.mark.asyncio
+async def test_failure_falls_back_to_next_model():
+    stats = HedgeStats()
+    broken, _ = fake_attempt(0.01, 0.02, fail=True)
+    backup, _ = fake_attempt(0.01, 0.02)
+    winner, _ = await run_hedged([("broken", broken), ("backup", backup)], HedgePolicy(["backup"], "fallback"), stats)
+    assert winner == 1
+    assert stats.failures["broken"] == 1
+
+@pytest.mark.asyncio
+async def test_agent_uses_faster_hedge_model():
+    ensure_mock_model_registered()
+    configure_mock_model(seed=0)
+    agent = Agent(
+        config={
+            "name": "HedgedAgent", "model": MOCK_MODEL_ID, "persona": "test",
+            "options": {"latency": 0.5, "output_tokens": 3},
+            "hedge": {"models": [{"model": MOCK_MODEL_ID, "options": {"latency": 0.01, "output_tokens": 1}}],
+                      "default_delay_ms": 50},
+        },
+        room_name="test_room", server_url="ws://localhost:8000", common_settings={"memory_top_k": 0},
+    )
+    agent.chat_history.append({"sender": "human", "message": "hello", "type": "chat"})
+    started = time.monotonic()
+    text = await agent._generate_response()
+    assert time.monotonic() - started < 0.4
+    assert len(text.split()) == 1
@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+
+try:
+    from llm_agentchat.server.ingest import RoomIngestor
+    _ingest_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _ingest_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server.app import app, active_connections
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+    app = None
+
+@pytest.mark.skipif(not _ingest_module_found, reason="llm_agentchat.server.ingest not found")
+@pytest.mark.asyncio
+async def test_burst_is_coalesced_in_order():
+    """活発なルームで短い間隔に届いたメッセージが、受信順のまま少数のバッチにまとめられることをテストします。"""
+    batches = []
+
+    async def handler(room, messages):
+        for message in messages:
+            message["id"] = message["n"]
+        batches.append([message["n"] for message in messages])
+
+    ingestor = RoomIngestor("room1", handler, window=0.02)
+    assert await (await ingestor.submit({"n": 0})) == 0
+    futures = [await ingestor.submit({"n": n}) for n in range(1, 11)]
+    assert await asyncio.gather(*futures) == list(range(1, 11))
+    assert [n for batch in batches for n in batch] == list(range(11))
+    assert len(batches) < 11
+    assert ingestor.messages == 11
+    await ingestor.stop()
+
+@pytest.mark.skipif(not _ingest_module_found, reason="llm_agentchat.server.ingest not found")
+@pytest.mark.asyncio
+async def test_handler_error_is_reported_and_actor_keeps_running():
+    async def handler(room, messages):
+        if messages[0].get("fail"):
+            raise RuntimeError("disk full")
+        messages[0]["id"] = 1
+
+    ingestor = RoomIngestor("room1", handler, window=0)
+    with pytest.raises(RuntimeError):
+        await (await ingestor.submit({"fail": True}))
+    assert await (await ingestor.submit({})) == 1
+    await ingestor.stop()
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+def test_batched_frames_for_opted_in_clients():
+    """バッチを指定した接続にはまとめたフレームが、それ以外の接続には1件ずつのフレームが届くことをテストします。"""
+    previous = getattr(app.state, "batch_window", None)
+    app.state.db_path = ":memory:"
+    app.state.batch_window = 0.05
+    active_connections.clear()
+    room = "ingest-room"
+    try:
+        with TestClient(app) as client:
+            with client.websocket_connect(f"/ws?room={room}&agent=human&batch=1") as observer, \
+                    client.websocket_connect(f"/ws?room={room}&agent=Alice") as alice, \
+                    client.websocket_connect(f"/ws?room={room}&agent=Bob") as bob:
+                for _ in range(2):
+                    observer.receive_json() # Alice と Bob の参加通知
+                for i in range(6):
+                    bob.send_json({"message": f"m{i}", "sender": "Bob"})
+
+                received = []
+                frames = 0
+                while len(received) < 6:
+                    frame = observer.receive_json()
+                    frames += 1
+                    received.extend(frame["messages"] if frame["type"] == "batch" else [frame])
+                assert [m["message"] for m in received] == [f"m{i}" for i in range(6)]
+                ids = [m["id"] for m in received]
+                assert ids == sorted(ids)
+                assert frames < 6
+
+                assert [alice.receive_json()["message"] for _ in range(6)] == [f"m{i}" for i in range(6)]
+                history = client.get(f"/api/messages?room={room}").json()
+                assert [m["id"] for m in history] == ids
+    finally:
+        if previous is None:
+            del app.state.batch_window
+        else:
+            app.state.batch_window = previous
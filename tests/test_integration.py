@@ -27,8 +27,8 @@ class TestServerClientIntegration:
         active_connections.clear()
 
     @pytest.mark.asyncio # async テストを認識させるために必要
-    @patch('llm_agentchat.server.app.db')
-    async def test_http_post_message_broadcasts_to_websocket(self, mock_db):
+    @patch('llm_agentchat.server.app.get_storage')
+    async def test_http_post_message_broadcasts_to_websocket(self, mock_get_storage):
         """
         HTTP POSTでメッセージが投稿されたときに、接続済みのWebSocketクライアントに
         正しくブロードキャストされることをテストします。
@@ -37,11 +37,10 @@ class TestServerClientIntegration:
         test_message_content = "Hello from integration test!"
         sender_name = "human_user"
 
-        # データベースモックのセットアップ
-        # add_message と get_messages_for_room は呼ばれるが、ここでは詳細な動作は不要
-        mock_db.add_message.return_value = None
-        from unittest.mock import MagicMock # AsyncMockではなくMagicMockをインポート
-        mock_db.get_db.return_value = MagicMock() # get_dbもモックしておく
+        # ストレージモックのセットアップ
+        # add_message は呼ばれるが、ここでは詳細な動作は不要
+        mock_storage = mock_get_storage.return_value
+        mock_storage.add_message.return_value = None
 
         # WebSocketクライアントを接続
         with self.client.websocket_connect(f"/ws?room={room_name}") as websocket:
@@ -74,17 +73,17 @@ class TestServerClientIntegration:
             assert received_message["type"] == "chat"
 
             # データベースへの保存が呼ばれたことを確認
-            mock_db.add_message.assert_called_once()
+            mock_storage.add_message.assert_called_once()
             # 引数は位置引数で渡されるため、call_args.argsから取得
-            call_args = mock_db.add_message.call_args.args
-            assert call_args[1] == room_name  # room_nameは2番目の位置引数
-            assert call_args[2] == sender_name # senderは3番目の位置引数
-            assert call_args[3] == test_message_content # messageは4番目の位置引数
-            assert call_args[4] == "chat" # message_typeは5番目の位置引数
+            call_args = mock_storage.add_message.call_args.args
+            assert call_args[0] == room_name  # room_nameは1番目の位置引数
+            assert call_args[1] == sender_name # senderは2番目の位置引数
+            assert call_args[2] == test_message_content # messageは3番目の位置引数
+            assert call_args[3] == "chat" # message_typeは4番目の位置引数
 
     @pytest.mark.asyncio # async テストを認識させるために必要
-    @patch('llm_agentchat.server.app.db')
-    async def test_websocket_client_sends_message_and_broadcasts_to_others(self, mock_db):
+    @patch('llm_agentchat.server.app.get_storage')
+    async def test_websocket_client_sends_message_and_broadcasts_to_others(self, mock_get_storage):
         """
         WebSocketクライアントがメッセージを送信したときに、他の接続済みクライアントに
         正しくブロードキャストされることをテストします。
@@ -93,9 +92,8 @@ class TestServerClientIntegration:
         test_message_content = "Message from WS client!"
         sender_name = "ws_agent"
 
-        from unittest.mock import MagicMock # AsyncMockではなくMagicMockをインポート
-        mock_db.add_message.return_value = None
-        mock_db.get_db.return_value = MagicMock()
+        mock_storage = mock_get_storage.return_value
+        mock_storage.add_message.return_value = None
 
         with self.client.websocket_connect(f"/ws?room={room_name}&agent=ws_sender") as ws_sender:
             with self.client.websocket_connect(f"/ws?room={room_name}&agent=ws_receiver") as ws_receiver:
@@ -124,13 +122,13 @@ class TestServerClientIntegration:
                 assert received_message["type"] == "chat"
 
                 # データベースへの保存が呼ばれたことを確認（WebSocketからのメッセージも保存されるようになったため）
-                mock_db.add_message.assert_called_once()
+                mock_storage.add_message.assert_called_once()
                 # 引数の検証（タイムスタンプは動的に生成されるため、他の項目を確認）
-                call_args = mock_db.add_message.call_args.args
-                assert call_args[1] == room_name
-                assert call_args[2] == sender_name
-                assert call_args[3] == test_message_content
-                assert call_args[4] == "chat"
+                call_args = mock_storage.add_message.call_args.args
+                assert call_args[0] == room_name
+                assert call_args[1] == sender_name
+                assert call_args[2] == test_message_content
+                assert call_args[3] == "chat"
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock
 import asyncio
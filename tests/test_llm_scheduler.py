@@ -0,0 +1,92 @@
+import pytest
+import asyncio
+import time
+from types import SimpleNamespace
+
+try:
+    from llm_agentchat.client.llm_scheduler import (
+        LLMScheduler, TokenBucket, CircuitOpenError, RetriesExhaustedError,
+        PRIORITY_AGENT, PRIORITY_HUMAN, retry_after_seconds,
+    )
+    _scheduler_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _scheduler_module_found = False
+
+pytestmark = pytest.mark.skipif(not _scheduler_module_found, reason="llm_agentchat.client.llm_scheduler not found")
+
+class RateLimited(Exception):
+    """Retry-Afterヘッダー付きのレスポンスを持つ、プロバイダの429エラーを模した例外。"""
+    def __init__(self, retry_after: str):
+        super().__init__("429 Too Many Requests")
+        self.response = SimpleNamespace(headers={"retry-after": retry_after})
+
+def test_retry_after_parsing():
+    assert retry_after_seconds(RateLimited("1.5")) == 1.5
+    assert retry_after_seconds(ValueError("boom")) is None
+
+def test_token_bucket_wait_time():
+    bucket = TokenBucket(rate_per_minute=60)
+    assert bucket.time_until(60) == 0
+    bucket.consume(60)
+    assert bucket.time_until(1) == pytest.approx(1.0, abs=0.05)
+
+@pytest.mark.asyncio
+async def test_retry_honors_retry_after():
+    """Retry-After が指定された場合、その時間だけ待ってからリトライすることを確認します。"""
+    scheduler = LLMScheduler(base_backoff=10)
+    attempts = []
+
+    def call():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RateLimited("0.1")
+        return "ok"
+
+    assert await scheduler.submit("model-a", call) == "ok"
+    assert len(attempts) == 2
+    # バックオフ（10秒）ではなく Retry-After（0.1秒）に従う
+    assert 0.09 <= attempts[1] - attempts[0] < 5
+
+@pytest.mark.asyncio
+async def test_human_replies_run_before_agent_chatter():
+    """レーンが待機中に溜まった呼び出しは、人間への応答から先に実行されることを確認します。"""
+    scheduler = LLMScheduler()
+    scheduler.lane_for("model-a").pause(0.05)
+    order = []
+
+    agent_call = asyncio.create_task(scheduler.submit("model-a", lambda: order.append("agent"), priority=PRIORITY_AGENT))
+    await asyncio.sleep(0)
+    human_call = asyncio.create_task(scheduler.submit("model-a", lambda: order.append("human"), priority=PRIORITY_HUMAN))
+    await asyncio.gather(agent_call, human_call)
+    assert order == ["human", "agent"]
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens_after_repeated_failures():
+    scheduler = LLMScheduler(max_retries=2, base_backoff=0.01, failure_threshold=2, reset_timeout=60)
+
+    def failing():
+        raise RuntimeError("provider down")
+
+    with pytest.raises(RetriesExhaustedError):
+        await scheduler.submit("model-b", failing)
+    with pytest.raises(CircuitOpenError):
+        await scheduler.submit("model-b", lambda: "never called")
+
+@pytest.mark.asyncio
+async def test_half_open_trial_cancelled_while_waiting_does_not_block_breaker():
+    """half-open の試行がレート制限の待ち中にキャンセルされても、次の呼び出しが試行できることを確認します。"""
+    scheduler = LLMScheduler(failure_threshold=1, reset_timeout=0.01)
+    lane = scheduler.lane_for("model-c")
+    lane.breaker.record_failure()
+    await asyncio.sleep(0.02)
+    assert lane.breaker.state == "half_open"
+
+    lane.pause(10)
+    trial = asyncio.create_task(scheduler.submit("model-c", lambda: "never called"))
+    await asyncio.sleep(0.01)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    lane.paused_until = 0
+    assert await scheduler.submit("model-c", lambda: "ok") == "ok"
+    assert lane.breaker.state == "closed"
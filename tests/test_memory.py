@@ -0,0 +1,48 @@
+import pytest
+
+try:
+    from llm_agentchat.client.memory import AgentMemory, build_fts_query
+    from llm_agentchat.client.agent import Agent
+    _memory_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _memory_module_found = False
+
+pytestmark = pytest.mark.skipif(not _memory_module_found, reason="llm_agentchat.client.memory not found")
+
+def test_search_ranks_relevant_older_messages():
+    memory = AgentMemory()
+    memory.add("human", "データベースはPostgreSQLではなくSQLiteを使うことに決定しました")
+    memory.add("ReviewerAgent", "The deploy target is a single VPS behind nginx")
+    for i in range(20):
+        memory.add("ProgrammerAgent", f"テストを追加しました ({i})")
+    memory.add("system", "human joined the room", "system")
+    assert memory.count == 22
+
+    hits = memory.search("どのデータベースを使いますか？", k=3)
+    assert hits[0]["sender"] == "human"
+    assert "SQLite" in hits[0]["message"]
+    assert memory.search("nginx deploy", k=1)[0]["sender"] == "ReviewerAgent"
+    # before_seq より新しいメッセージは検索しない
+    assert memory.search("nginx deploy", k=3, before_seq=2)[0]["seq"] == 2
+    assert memory.search("nginx", k=3, before_seq=1) == []
+
+def test_build_fts_query_splits_japanese_into_trigrams():
+    query = build_fts_query("SQLiteで決定", "trigram")
+    assert '"sqliteで決定"' not in query
+    assert '"で決定"' in query
+    assert build_fts_query("a b ?", "trigram") is None
+
+@pytest.mark.asyncio
+async def test_agent_prompt_includes_recalled_messages():
+    agent = Agent(config={"name": "TestAgent", "model": "gpt-3.5-turbo", "persona": "You are a test assistant."},
+                  room_name="test_room", server_url="ws://localhost:8000",
+                  common_settings={"chat_history_limit": 3, "memory_top_k": 2})
+    await agent._add_to_history("human", "The API key rotation happens every Tuesday")
+    for i in range(5):
+        await agent._add_to_history("human", f"unrelated chatter {i}")
+    await agent._add_to_history("human", "When does the key rotation happen?")
+
+    recalled = await agent._recall(agent.chat_history[-agent.chat_history_limit:])
+    assert "every Tuesday" in recalled
+    # 直近のウィンドウ内のメッセージは重複して含めない
+    assert "When does" not in recalled
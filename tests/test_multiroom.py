@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+try:
+    from llm_agentchat.schema import parse_room_spec, room_matches
+    from llm_agentchat.client.agent import Agent
+    from llm_agentchat.client.websocket_client import WebSocketClient
+    _agent_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _agent_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server.app import app, active_connections, connection_rooms, presence, room_patterns
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+
+pytestmark = pytest.mark.skipif(not _agent_module_found, reason="llm_agentchat.client.agent not found")
+
+def test_room_spec_splits_names_and_patterns():
+    assert parse_room_spec("design, project-*,design,,ops-[ab]") == (["design"], ["project-*", "ops-[ab]"])
+    assert parse_room_spec(["alpha"]) == (["alpha"], [])
+    assert room_matches("project-api", ["project-*"])
+    assert not room_matches("Project-api", ["project-*"])
+    url = WebSocketClient("ws://localhost:8000", ["design", "project-*"], "Reviewer", on_message=None).url
+    assert "rooms=design%2Cproject-%2A" in url and "room=" not in url.replace("rooms=", "")
+    assert "room=design&" in WebSocketClient("ws://localhost:8000", "design", "Reviewer", on_message=None).url
+
+@pytest.mark.asyncio
+async def test_agent_keeps_isolated_bounded_context_per_room():
+    """ルームごとに上限付きの会話履歴を持ち、パターンに一致するルームには最初のメッセージで参加することをテストします。"""
+    agent = Agent(config={"name": "Reviewer", "model": "gpt-3.5-turbo", "persona": "You review code."},
+                  room_name="design,project-*", server_url="ws://localhost:8000",
+                  common_settings={"chat_history_limit": 2, "bootstrap_messages": 0, "memory_top_k": 0})
+    agent._respond = AsyncMock()
+    for text in ("one", "two", "three"):
+        await agent.handle_message_from_server({"room": "design", "sender": "human", "message": text, "type": "chat"})
+    await agent.handle_message_from_server({"room": "project-api", "sender": "human", "message": "hi", "type": "chat"})
+    await agent.handle_message_from_server({"room": "random", "sender": "human", "message": "ignored", "type": "chat"})
+
+    assert sorted(agent.rooms) == ["design", "project-api"]
+    assert [m["message"] for m in agent.rooms["design"].chat_history] == ["two", "three"]
+    assert [m["message"] for m in agent.rooms["project-api"].chat_history] == ["hi"]
+    assert agent._respond.call_args.args[1] is agent.rooms["project-api"]
+
+    # 発言権制御もルームごと
+    await agent.handle_message_from_server({"type": "control", "action": "floor", "room": "design", "policy": "round_robin"})
+    assert agent.rooms["design"].floor_controlled
+    assert not agent.rooms["project-api"].floor_controlled
+
+@pytest.mark.asyncio
+@patch('llm_agentchat.client.agent.llm')
+async def test_rooms_share_one_model_and_reply_in_their_own_room(mock_llm):
+    mock_model = MagicMock()
+    mock_model.prompt.return_value.text.return_value = "LGTM"
+    mock_llm.get_model.return_value = mock_model
+    agent = Agent(config={"name": "Reviewer", "model": "gpt-3.5-turbo", "persona": "You review code."},
+                  room_name=["alpha", "beta"], server_url="ws://localhost:8000",
+                  common_settings={"bootstrap_messages": 0, "memory_top_k": 0})
+    agent.set_websocket_client(AsyncMock())
+    await agent._add_to_history("human", "review alpha.py", context=agent.rooms["alpha"])
+    await agent._add_to_history("human", "review beta.py", context=agent.rooms["beta"])
+
+    await asyncio.gather(agent._respond(None, agent.rooms["alpha"]), agent._respond(None, agent.rooms["beta"]))
+    mock_llm.get_model.assert_called_once_with("gpt-3.5-turbo")
+    prompts = [call.args[0] for call in mock_model.prompt.call_args_list]
+    assert sorted(prompts) == ["user: review alpha.py", "user: review beta.py"]
+    sent = [call.args[0] for call in agent.websocket_client.send_message.call_args_list]
+    assert sorted(message["room"] for message in sent) == ["alpha", "beta"]
+    assert agent.rooms["alpha"].chat_history[-1] == {"sender": "Reviewer", "message": "LGTM", "type": "chat"}
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+def test_one_connection_joins_listed_and_matching_rooms():
+    """1つの接続で、指定したルームとパターンに一致するルームのメッセージを受信・送信できることをテストします。"""
+    app.state.db_path = ":memory:"
+    active_connections.clear()
+    client = TestClient(app)
+    with client.websocket_connect("/ws?rooms=design,project-*&agent=Reviewer") as ws:
+        assert "Reviewer" in presence.agents("design")
+        client.post("/api/message", json={"room": "design", "sender": "human", "message": "hello design"})
+        assert ws.receive_json()["room"] == "design"
+        # パターンに一致するルームには最初のメッセージで参加する
+        client.post("/api/message", json={"room": "project-api", "sender": "human", "message": "hello api"})
+        received = ws.receive_json()
+        assert (received["room"], received["message"]) == ("project-api", "hello api")
+        assert "Reviewer" in presence.agents("project-api")
+
+        # 参加していないルーム宛てのメッセージは無視し、参加しているルーム宛てのメッセージは保存・配信する
+        ws.send_text(json.dumps({"room": "random", "sender": "Reviewer", "message": "nope"}))
+        ws.send_text(json.dumps({"room": "project-api", "sender": "Reviewer", "message": "on it"}))
+        for _ in range(50):
+            messages = client.get("/api/messages?room=project-api").json()
+            if len(messages) == 2:
+                break
+            time.sleep(0.02)
+        assert [m["message"] for m in messages] == ["hello api", "on it"]
+        assert client.get("/api/messages?room=random").json() == []
+    assert not room_patterns and not connection_rooms
+    assert "Reviewer" not in presence.agents("design")
+    assert "Reviewer" not in presence.agents("project-api")
@@ -0,0 +1,141 @@
+import time
+import pytest
+from unittest.mock import AsyncMock
+
+try:
+    from llm_agentchat.server.presence import PresenceTracker
+    _presence_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _presence_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from starlette.websockets import WebSocketDisconnect
+    from llm_agentchat.server.app import app, active_connections
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+    app = None
+
+try:
+    from llm_agentchat.client.agent import Agent
+    _agent_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _agent_module_found = False
+
+@pytest.mark.skipif(not _presence_module_found, reason="llm_agentchat.server.presence not found")
+def test_presence_snapshot_and_idle_detection():
+    tracker = PresenceTracker()
+    tracker.join("room1", "Alice", now=0)
+    tracker.join("room1", "Bob", now=0)
+    version = tracker.version("room1")
+    tracker.join("room1", "Alice", now=5) # 再接続はスナップショットを変えない
+    assert tracker.agents("room1") == ("Alice", "Bob")
+    assert tracker.version("room1") == version
+
+    tracker.touch("room1", "Bob", now=9)
+    assert tracker.idle(timeout=5, now=10) == [("room1", "Alice")]
+    assert tracker.leave("room1", "Alice")
+    assert not tracker.leave("room1", "Alice")
+    assert tracker.agents("room1") == ("Bob",)
+    assert tracker.version("room1") == version + 1
+
+@pytest.mark.skipif(not _presence_module_found, reason="llm_agentchat.server.presence not found")
+def test_idle_expiry_follows_the_last_frame():
+    tracker = PresenceTracker()
+    tracker.join("room1", "Alice", now=0)
+    tracker.join("room2", "Alice", now=0)
+    assert tracker.idle(timeout=5, now=4.9) == []
+    # 受信はルームごとに記録し、参加していない相手への touch は無視する
+    tracker.touch("room1", "Alice", now=4)
+    tracker.touch("room1", "Mallory", now=4)
+    assert tracker.idle(timeout=5, now=5) == [("room2", "Alice")]
+    assert tracker.idle(timeout=5, now=9) == [("room1", "Alice"), ("room2", "Alice")]
+    assert tracker.agents("room1") == ("Alice",)
+    # 再接続は最終受信時刻を更新する
+    tracker.join("room2", "Alice", now=8)
+    assert tracker.idle(timeout=5, now=9) == [("room1", "Alice")]
+
+@pytest.mark.skipif(not _presence_module_found, reason="llm_agentchat.server.presence not found")
+def test_version_bumps_after_leave_and_rejoin():
+    tracker = PresenceTracker()
+    tracker.join("room1", "Alice", now=0)
+    version = tracker.version("room1")
+    # 最後の参加者が退出してもバージョンは増え、スナップショットは空になる
+    assert tracker.leave("room1", "Alice")
+    assert tracker.version("room1") == version + 1
+    assert tracker.agents("room1") == ()
+    assert tracker.idle(timeout=0, now=100) == []
+    # 存在しない参加者の退出ではバージョンは変わらない
+    assert not tracker.leave("room1", "Alice")
+    assert not tracker.leave("unknown", "Alice")
+    assert tracker.version("room1") == version + 1
+    assert tracker.version("unknown") == 0
+    tracker.join("room1", "Alice", now=1)
+    assert tracker.version("room1") == version + 2
+    assert tracker.agents("room1") == ("Alice",)
+
+@pytest.mark.skipif(not _agent_module_found, reason="llm_agentchat.client.agent not found")
+@pytest.mark.asyncio
+async def test_agent_ignores_presence_frames():
+    """presence を購読したエージェントが、プレゼンスイベントを会話履歴に入れず応答もしないことをテストします。"""
+    agent = Agent(config={"name": "Watcher", "model": "gpt-3.5-turbo", "persona": "You watch."},
+                  room_name="room1", server_url="ws://localhost:8000",
+                  common_settings={"bootstrap_messages": 0, "memory_top_k": 0})
+    agent._respond = AsyncMock()
+    await agent.handle_message_from_server({"type": "presence", "room": "room1", "agent": "Bob", "event": "join",
+                                            "agents": ["Bob", "Watcher"]})
+    assert agent.rooms["room1"].chat_history == []
+    agent._respond.assert_not_called()
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+class TestHeartbeat:
+    """ハートビートに応答しない接続が切断され、プレゼンスイベントが配信されることをテストするクラス。"""
+
+    def setup_method(self):
+        app.state.db_path = ":memory:"
+        app.state.heartbeat_interval = 0.05
+        app.state.heartbeat_timeout = 0.3
+        active_connections.clear()
+
+    def teardown_method(self):
+        del app.state.heartbeat_interval
+        del app.state.heartbeat_timeout
+
+    def test_idle_agent_is_reaped(self):
+        room = "heartbeat-room"
+        with TestClient(app) as client:
+            with client.websocket_connect(f"/ws?room={room}") as observer:
+                with client.websocket_connect(f"/ws?room={room}&agent=Silent") as silent:
+                    joined = observer.receive_json()
+                    assert (joined["type"], joined["event"], joined["agent"]) == ("presence", "join", "Silent")
+                    # 一度 pong を返した（ハートビートに対応した）エージェントが応答しなくなると切断され、
+                    # 観察者に退出が通知される
+                    silent.send_json({"type": "control", "action": "pong"})
+                    while True:
+                        event = observer.receive_json()
+                        if event["type"] == "control":
+                            # 観察者はpongを返して接続を維持する
+                            observer.send_json({"type": "control", "action": "pong"})
+                            continue
+                        break
+                    assert (event["type"], event["event"], event["agent"]) == ("presence", "leave", "Silent")
+                    assert silent.receive_json() == {"type": "control", "action": "ping", "room": room}
+                    with pytest.raises(WebSocketDisconnect):
+                        while True:
+                            silent.receive_json()
+                    assert client.get(f"/api/agents?room={room}").json() == ["human"]
+
+    def test_quiet_client_without_heartbeat_support_is_kept(self):
+        """pong を返したことのないクライアントは、何も送らなくても切断されないことを確認します。"""
+        room = "quiet-room"
+        with TestClient(app) as client:
+            with client.websocket_connect(f"/ws?room={room}") as observer:
+                with client.websocket_connect(f"/ws?room={room}&agent=Quiet"):
+                    assert observer.receive_json()["event"] == "join"
+                    deadline = time.monotonic() + 3 * app.state.heartbeat_timeout
+                    while time.monotonic() < deadline:
+                        event = observer.receive_json()
+                        assert event["type"] == "control", event # 退出のプレゼンスイベントは届かない
+                        observer.send_json({"type": "control", "action": "pong"})
+                    assert "Quiet" in client.get(f"/api/agents?room={room}").json()
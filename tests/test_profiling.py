@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+try:
+    from llm_agentchat.profiling import LoopMonitor
+    _profiling_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _profiling_module_found = False
+
+pytestmark = pytest.mark.skipif(not _profiling_module_found, reason="llm_agentchat.profiling not found")
+
+def blocking_sqlite_call():
+    """ループを止める同期処理の代わり。"""
+    time.sleep(0.3)
+
+def busy_handler_work(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+@pytest.mark.asyncio
+async def test_blocking_call_is_logged_with_its_stack(caplog):
+    monitor = LoopMonitor("server", threshold=0.1, check_interval=0.02)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.1)
+        with caplog.at_level(logging.WARNING, logger="llm_agentchat.profiling"):
+            blocking_sqlite_call()
+            await asyncio.sleep(0.1)
+    finally:
+        monitor.stop()
+
+    assert monitor.stalls == 1
+    assert any("blocking_sqlite_call" in record.getMessage() for record in caplog.records)
+    assert monitor.summary()["max_ms"] >= 200
+
+@pytest.mark.asyncio
+async def test_profile_is_written_per_task(tmp_path):
+    output = tmp_path / "agent.folded"
+    monitor = LoopMonitor("agent", threshold=10, output=str(output), sample_interval=0.002)
+    monitor.start()
+
+    async def handler():
+        busy_handler_work(0.3)
+
+    try:
+        await asyncio.create_task(handler(), name="handle chat message")
+    finally:
+        monitor.stop()
+
+    lines = output.read_text().splitlines()
+    handler_samples = sum(
+        int(line.rsplit(" ", 1)[1]) for line in lines
+        if line.startswith("handle chat message;") and "busy_handler_work" in line
+    )
+    assert handler_samples >= 10
+
+@pytest.mark.asyncio
+async def test_watchdog_captures_each_stall_once_with_its_task(caplog):
+    """停止ごとに1回だけ、ループを止めているタスクの名前付きでスタックを記録し、しきい値未満の停止は記録しないことをテストします。"""
+    monitor = LoopMonitor("server", threshold=0.1, check_interval=0.02)
+    monitor.start()
+
+    async def handler(seconds: float):
+        busy_handler_work(seconds)
+
+    try:
+        await asyncio.sleep(0.1)
+        with caplog.at_level(logging.WARNING, logger="llm_agentchat.profiling"):
+            await asyncio.create_task(handler(0.03), name="GET /api/agents")
+            await asyncio.sleep(0.1)
+            assert monitor.stalls == 0
+            for _ in range(2):
+                await asyncio.create_task(handler(0.4), name="POST /api/message")
+                await asyncio.sleep(0.1)
+    finally:
+        monitor.stop()
+
+    warnings = [record.getMessage() for record in caplog.records if record.levelno == logging.WARNING]
+    assert monitor.stalls == 2
+    assert len(warnings) == 2
+    assert all("task 'POST /api/message'" in message and "busy_handler_work" in message for message in warnings)
+
+@pytest.mark.asyncio
+async def test_lag_only_mode_measures_lag_without_watchdog(caplog):
+    """watch=False では遅延（受け入れ制御が使う指数移動平均）だけを計測し、ウォッチドッグは動かないことをテストします。"""
+    monitor = LoopMonitor("server", threshold=0.1, check_interval=0.02)
+    monitor.start(watch=False)
+    try:
+        await asyncio.sleep(0.1)
+        assert monitor.lag < 0.05
+        with caplog.at_level(logging.WARNING, logger="llm_agentchat.profiling"):
+            for _ in range(5):
+                busy_handler_work(0.3)
+                await asyncio.sleep(0.001)
+        assert monitor.lag > 0.1
+    finally:
+        monitor.stop()
+
+    assert monitor.stalls == 0
+    assert not caplog.records
+    assert monitor._threads == []
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+try:
+    import llm
+    from llm_agentchat.client.mock_model import MOCK_MODEL_ID, configure_mock_model, ensure_mock_model_registered
+    from llm_agentchat.replay import (
+        AcceleratedClock, AcceleratedEventLoop, load_script, run_replay, synthetic_script,
+    )
+    _replay_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _replay_module_found = False
+
+pytestmark = pytest.mark.skipif(not _replay_module_found, reason="llm_agentchat.replay not found")
+
+def test_accelerated_loop_runs_timers_faster():
+    clock = AcceleratedClock(speed=100)
+    loop = AcceleratedEventLoop(clock)
+    try:
+        wall_start = time.perf_counter()
+        virtual_start = loop.time()
+        loop.run_until_complete(asyncio.sleep(5))
+        assert loop.time() - virtual_start >= 5
+        assert time.perf_counter() - wall_start < 1
+    finally:
+        loop.close()
+
+def test_mock_model_is_reproducible():
+    ensure_mock_model_registered()
+    model = llm.get_model(MOCK_MODEL_ID)
+
+    def run():
+        configure_mock_model(seed=7, clock=AcceleratedClock(speed=1000))
+        return [model.prompt("hi", system="agent", latency=0.5, latency_dist="exponential").text() for _ in range(3)]
+
+    try:
+        first, second = run(), run()
+    finally:
+        configure_mock_model()
+    assert first == second
+    assert len(first[0].split()) == 40
+
+def test_load_script_skips_replayed_agents(tmp_path):
+    path = tmp_path / "room.json"
+    path.write_text(json.dumps([
+        {"sender": "human", "message": "hello", "type": "chat", "timestamp": "2025-01-01T00:00:00+00:00"},
+        {"sender": "Bot", "message": "hi", "type": "chat", "timestamp": "2025-01-01T00:00:01+00:00"},
+        {"sender": "System", "message": "joined", "type": "system", "timestamp": "2025-01-01T00:00:02+00:00"},
+        {"sender": "human", "message": "thanks", "type": "chat", "timestamp": "2025-01-01T00:00:04+00:00"},
+    ]))
+    script = load_script(str(path), skip_senders=["Bot"])
+    assert [(m["at"], m["message"]) for m in script] == [(0.0, "hello"), (4.0, "thanks")]
+
+def test_replay_reports_agent_side_metrics():
+    script = synthetic_script(3, interval=2.0, seed=1)
+    report = run_replay(
+        script,
+        [{"name": "Bot", "model": "unused", "persona": "You are a test bot."}],
+        mock_options={"latency": 1.0, "latency_dist": "constant", "tokens_per_second": 10, "output_tokens": 10},
+        speed=20,
+        turn_policy=None,
+        drain=1.0,
+    )
+    assert report["injected"] == 3
+    assert report["replies"] == 3
+    # 待ち時間は仮想時間で報告される（1秒 + 10トークン / 10トークン毎秒）
+    assert 1.9 <= report["model_time"]["p50"] <= 2.5
+    assert report["queue_delay"]["p50"] >= 0
+    assert report["cpu"]["generate"]["calls"] == 3
+    assert report["cpu"]["model"]["calls"] == 3
+    assert report["wall_seconds"] < report["virtual_seconds"]
@@ -0,0 +1,84 @@
+import pytest
+from unittest.mock import patch
+
+try:
+    from llm_agentchat.server.routing import (
+        parse_mentions, parse_subscription, index_mentions, select_recipients,
+    )
+    _routing_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _routing_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server.app import app, active_connections
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+    app = None
+
+@pytest.mark.skipif(not _routing_module_found, reason="llm_agentchat.server.routing not found")
+class TestRouting:
+    """メンション解析と配信先の決定をテストするクラス。"""
+
+    def test_parse_mentions(self):
+        assert parse_mentions("@A please ask @B. Thanks @A") == ["A", "B"]
+        assert parse_mentions("no mentions here") == []
+
+    def test_index_mentions_keeps_only_known_agents(self):
+        message = index_mentions({"message": "@Alice and @nobody", "to": "Bob"}, ["Alice", "Bob"])
+        assert message["mentions"] == ["Alice"]
+        assert message["to"] == ["Bob"]
+
+    def test_parse_subscription(self):
+        assert parse_subscription(None) == {"all"}
+        assert parse_subscription("mentions,humans") == {"mentions", "humans"}
+        with pytest.raises(ValueError):
+            parse_subscription("everything")
+
+    def test_directed_message_goes_to_addressees_and_observers(self):
+        connections = ["human", "Alice", "Bob", "Carol"]
+        message = {"type": "chat", "message": "@Alice hi", "mentions": ["Alice"], "to": []}
+        assert select_recipients(connections, {}, message, sender_is_human=True) == ["human", "Alice"]
+
+    def test_subscription_filters(self):
+        connections = ["Alice", "Bob", "Carol"]
+        subscriptions = {"Alice": {"mentions"}, "Bob": {"humans"}, "Carol": {"all"}}
+        message = {"type": "chat", "message": "hello", "mentions": [], "to": []}
+        assert select_recipients(connections, subscriptions, message, sender_is_human=True) == ["Bob", "Carol"]
+        assert select_recipients(connections, subscriptions, message, sender_is_human=False) == ["Carol"]
+
+    def test_presence_events_go_to_observers_and_subscribers(self):
+        connections = ["human", "Alice", "Bob"]
+        subscriptions = {"Alice": parse_subscription("presence"), "Bob": {"all"}}
+        assert subscriptions["Alice"] == {"presence", "all"}
+        event = {"type": "presence", "agent": "Carol", "event": "join"}
+        assert select_recipients(connections, subscriptions, event, sender_is_human=False) == ["human", "Alice"]
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+class TestTargetedDelivery:
+    """サーバーが宛先指定のあるメッセージを宛先にのみ配信することをテストするクラス。"""
+
+    def setup_method(self):
+        app.state.db_path = ":memory:"
+        self.client = TestClient(app)
+        active_connections.clear()
+
+    @patch('llm_agentchat.server.app.get_storage')
+    def test_mention_is_delivered_only_to_addressee(self, mock_get_storage):
+        mock_get_storage.return_value.add_message.return_value = 1
+        room_name = "routing-room"
+        with self.client.websocket_connect(f"/ws?room={room_name}&agent=Alice") as alice:
+            with self.client.websocket_connect(f"/ws?room={room_name}&agent=Bob") as bob:
+                response = self.client.post("/api/message", json={"room": room_name, "sender": "human", "message": "@Alice ping"})
+                assert response.status_code == 200
+                response = self.client.post("/api/message", json={"room": room_name, "sender": "human", "message": "everyone", "to": ["Bob"]})
+                assert response.status_code == 200
+
+                received = alice.receive_json()
+                assert received["message"] == "@Alice ping"
+                assert received["mentions"] == ["Alice"]
+                # Bob には自分宛てのメッセージだけが届く
+                received = bob.receive_json()
+                assert received["message"] == "everyone"
+                assert received["to"] == ["Bob"]
@@ -0,0 +1,139 @@
+import pytest
+from unittest.mock import patch, AsyncMock
+
+try:
+    from llm_agentchat.server.scheduler import FloorScheduler
+    _scheduler_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _scheduler_module_found = False
+    FloorScheduler = None
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server.app import app, active_connections, floor_schedulers
+    from llm_agentchat.client.agent import Agent
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+    app = None
+
+@pytest.mark.skipif(not _scheduler_module_found, reason="llm_agentchat.server.scheduler not found")
+class TestFloorScheduler:
+    """発言権スケジューラの各ポリシーをテストするクラス。"""
+
+    def _scheduler(self, policy="round_robin", reply_budget=3, moderator=None):
+        scheduler = FloorScheduler(policy=policy, reply_budget=reply_budget, moderator=moderator)
+        for name in ["A", "B", "C"]:
+            scheduler.add_agent(name)
+        return scheduler
+
+    def test_round_robin_grants_one_agent_per_turn(self):
+        """人間のメッセージ1件につき1体ずつ、予算の範囲内で発言権が回ることを確認します。"""
+        scheduler = self._scheduler(reply_budget=2)
+        assert scheduler.on_message("human", [], is_agent=False) == ["A"]
+        # 発言権を持たないエージェントの発言は無視される
+        assert scheduler.on_message("C", [], is_agent=True) == []
+        assert scheduler.on_message("A", [], is_agent=True) == ["B"]
+        # 予算を使い切ったらそれ以上発言権は与えられない
+        assert scheduler.on_message("B", [], is_agent=True) == []
+        assert scheduler.remaining_budget == 0
+
+    def test_mention_first_prefers_mentioned_agents(self):
+        scheduler = self._scheduler(policy="mention_first")
+        assert scheduler.on_message("human", ["B", "C"], is_agent=False) == ["B", "C"]
+        # 全員が応答するまで次の発言者は選ばれない
+        assert scheduler.on_message("B", [], is_agent=True) == []
+        assert scheduler.on_message("C", [], is_agent=True) == ["A"]
+
+    def test_moderator_policy(self):
+        scheduler = self._scheduler(policy="moderator", reply_budget=5, moderator="A")
+        assert scheduler.on_message("human", [], is_agent=False) == ["A"]
+        assert scheduler.on_message("A", ["C"], is_agent=True) == ["C"]
+        assert scheduler.on_message("C", [], is_agent=True) == ["A"]
+        # 司会役が誰も指名しなければターンは終了する
+        assert scheduler.on_message("A", [], is_agent=True) == []
+
+    def test_directed_messages_grant_the_floor_only_to_addressees(self):
+        """宛先指定のあるメッセージは宛先にしか届かないため、どのポリシーでも宛先の中から発言権を与えることを確認します。"""
+        scheduler = self._scheduler(reply_budget=5)
+        # ラウンドロビンの次の番（A）ではなく、宛先の中で次の番のエージェントを選ぶ
+        assert scheduler.on_message("human", ["C", "B"], is_agent=False) == ["B"]
+        assert scheduler.on_message("B", ["C"], is_agent=True) == ["C"]
+        # 宛先が接続中のエージェントでなければ、誰にも発言権を与えない
+        assert scheduler.on_message("C", ["Nobody"], is_agent=True) == []
+        assert scheduler.on_message("human", [], is_agent=False) == ["A"]
+
+        moderated = self._scheduler(policy="moderator", moderator="A")
+        assert moderated.on_message("human", ["B"], is_agent=False) == ["B"]
+
+    def test_disconnect_hands_floor_to_next_agent(self):
+        scheduler = self._scheduler()
+        assert scheduler.on_message("human", [], is_agent=False) == ["A"]
+        assert scheduler.remove_agent("A") == ["B"]
+        assert scheduler.agents == ["B", "C"]
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+class TestFloorControlIntegration:
+    """サーバーが制御フレームで発言権を通知することをテストするクラス。"""
+
+    def setup_method(self):
+        app.state.db_path = ":memory:"
+        app.state.turn_policy = "round_robin"
+        app.state.reply_budget = 1
+        self.client = TestClient(app)
+        active_connections.clear()
+        floor_schedulers.clear()
+
+    def teardown_method(self):
+        app.state.turn_policy = None
+        floor_schedulers.clear()
+
+    @patch('llm_agentchat.server.app.get_storage')
+    def test_human_message_grants_floor_to_one_agent(self, mock_get_storage):
+        mock_get_storage.return_value.add_message.return_value = 1
+        room_name = "floor-room"
+        with self.client.websocket_connect(f"/ws?room={room_name}&agent=agent1") as ws1:
+            assert ws1.receive_json() == {"type": "control", "action": "floor", "room": room_name, "policy": "round_robin"}
+            response = self.client.post("/api/message", json={"room": room_name, "sender": "human", "message": "hi"})
+            assert response.status_code == 200
+
+            assert ws1.receive_json()["message"] == "hi"
+            control = ws1.receive_json()
+            assert control["type"] == "control"
+            assert control["action"] == "speak"
+            assert control["agents"] == ["agent1"]
+
+    @patch('llm_agentchat.server.app.get_storage')
+    def test_directed_message_grants_floor_to_its_addressee(self, mock_get_storage):
+        mock_get_storage.return_value.add_message.return_value = 1
+        room_name = "directed-floor-room"
+        with self.client.websocket_connect(f"/ws?room={room_name}&agent=agent1") as ws1, \
+                self.client.websocket_connect(f"/ws?room={room_name}&agent=agent2") as ws2:
+            assert ws1.receive_json()["action"] == "floor"
+            assert ws2.receive_json()["action"] == "floor"
+            response = self.client.post("/api/message", json={"room": room_name, "sender": "human", "message": "@agent2 hi"})
+            assert response.status_code == 200
+
+            # ラウンドロビンの次の番は agent1 だが、メッセージを受け取った agent2 に発言権が与えられる
+            assert ws2.receive_json()["message"] == "@agent2 hi"
+            control = ws2.receive_json()
+            assert (control["action"], control["agents"]) == ("speak", ["agent2"])
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+@pytest.mark.asyncio
+async def test_agent_waits_for_floor():
+    """発言権制御が有効なエージェントは、speak フレームを受け取るまで応答しないことを確認します。"""
+    agent = Agent(
+        config={"name": "TestAgent", "model": "gpt-3.5-turbo", "persona": "test"},
+        room_name="test_room", server_url="ws://localhost:8000", common_settings={},
+    )
+    agent._respond = AsyncMock()
+    await agent.handle_message_from_server({"type": "control", "action": "floor", "room": "test_room", "policy": "round_robin"})
+    assert agent.floor_controlled
+
+    await agent.handle_message_from_server({"room": "test_room", "sender": "human", "message": "hello", "type": "chat"})
+    agent._respond.assert_not_called()
+    assert agent.chat_history[-1]["message"] == "hello"
+
+    await agent.handle_message_from_server({"type": "control", "action": "speak", "room": "test_room", "agents": ["TestAgent"]})
+    agent._respond.assert_called_once()
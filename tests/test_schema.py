@@ -0,0 +1,27 @@
+import pytest
+
+try:
+    from pydantic import ValidationError
+    from llm_agentchat.schema import ChatMessage, MessageIn, encode_messages
+    _schema_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _schema_module_found = False
+
+pytestmark = pytest.mark.skipif(not _schema_module_found, reason="llm_agentchat.schema not found")
+
+def test_storage_rows_load_as_chat_messages():
+    row = {"id": 3, "sender": "agent", "message_content": "hi", "timestamp": "t", "message_type": "system"}
+    message = ChatMessage.model_validate(row)
+    assert (message.id, message.message, message.type) == (3, "hi", "system")
+    assert ChatMessage.model_validate({"sender": "human", "message": "hello"}).type == "chat"
+
+def test_encode_messages_uses_api_keys():
+    rows = [{"id": 1, "sender": "agent", "message_content": "こんにちは", "timestamp": "t", "message_type": "chat"}]
+    assert encode_messages(rows, room="room1") == (
+        '[{"id":1,"room":"room1","sender":"agent","message":"こんにちは","timestamp":"t","type":"chat"}]'.encode("utf-8")
+    )
+
+def test_incoming_message_rejects_wrong_types():
+    assert MessageIn.model_validate_json('{"type": "control", "action": "pong"}').type == "control"
+    with pytest.raises(ValidationError):
+        MessageIn.model_validate_json('{"room": "r", "sender": "a", "message": {"text": "hi"}}')
@@ -23,18 +23,21 @@ class TestServerAPI:
         app.state.db_path = ":memory:"
         self.client = TestClient(app)
 
-    @patch('llm_agentchat.server.app.db')
-    def test_get_messages(self, mock_db):
+    @patch('llm_agentchat.server.app.get_storage')
+    def test_get_messages(self, mock_get_storage):
         """
         GET /api/messages エンドポイントをテストします。
         指定されたルームのメッセージが正しく返されることを確認します。
         """
-        # データベースモックのセットアップ
-        mock_conn = mock_db.get_db.return_value
-        mock_db.get_messages_for_room.return_value = [
-            {'sender': 'agent1', 'message_content': 'Hello'},
-            {'sender': 'agent2', 'message_content': 'Hi'}
-        ]
+        # ストレージモックのセットアップ
+        # 本文はストレージが生成したJSONをそのまま返す
+        mock_storage = mock_get_storage.return_value
+        mock_storage.identity = "mock"
+        mock_storage.latest_id.return_value = 2
+        mock_storage.get_messages_json.return_value = (
+            b'[{"id":1,"room":"test-room","sender":"agent1","message":"Hello","timestamp":"t","type":"chat"},'
+            b'{"id":2,"room":"test-room","sender":"agent2","message":"Hi","timestamp":"t","type":"chat"}]'
+        )
 
         response = self.client.get("/api/messages?room=test-room")
 
@@ -42,11 +45,11 @@ class TestServerAPI:
         data = response.json()
         assert len(data) == 2
         assert data[0]['sender'] == 'agent1'
-        mock_db.get_messages_for_room.assert_called_once_with(mock_conn, 'test-room')
+        mock_storage.get_messages_json.assert_called_once_with('test-room', limit=100, after_id=None, before_id=None)
 
     @patch('llm_agentchat.server.app.broadcast_message')
-    @patch('llm_agentchat.server.app.db')
-    def test_post_message(self, mock_db, mock_broadcast):
+    @patch('llm_agentchat.server.app.get_storage')
+    def test_post_message(self, mock_get_storage, mock_broadcast):
         """
         POST /api/message エンドポイントをテストします。
         メッセージが正常に投稿され、ブロードキャストされることを確認します。
@@ -62,7 +65,7 @@ class TestServerAPI:
         
         assert response.status_code == 200
         assert response.json() == {"status": "ok"}
-        mock_db.add_message.assert_called_once()
+        mock_get_storage.return_value.add_message.assert_called_once()
         mock_broadcast.assert_called_once()
 
     def test_get_agents_endpoint(self):
@@ -99,3 +102,66 @@ class TestServerAPI:
         response = self.client.get(f"/api/agents?room={room_name}")
         assert response.status_code == 200
         assert response.json() == []
+
+@pytest.mark.skipif(not _fastapi_installed, reason="fastapi or llm_agentchat.server.app not found")
+class TestHTTPCaching:
+    """履歴とエージェント一覧のETag・圧縮をテストするクラス。"""
+
+    @pytest.fixture(autouse=True)
+    def setup_db(self, tmp_path):
+        app.state.db_path = str(tmp_path / "cache_test.db")
+        self.client = TestClient(app)
+
+    def test_unchanged_history_returns_304(self):
+        room = "cache-room"
+        self.client.post("/api/message", json={"room": room, "sender": "human", "message": "first"})
+        response = self.client.get(f"/api/messages?room={room}")
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert response.headers["cache-control"] == "no-cache"
+
+        response = self.client.get(f"/api/messages?room={room}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        # 新しいメッセージが届いたらETagが変わる
+        self.client.post("/api/message", json={"room": room, "sender": "human", "message": "second"})
+        response = self.client.get(f"/api/messages?room={room}", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert [m["message"] for m in response.json()] == ["first", "second"]
+
+    def test_large_history_is_compressed(self):
+        room = "gzip-room"
+        for i in range(20):
+            self.client.post("/api/message", json={"room": room, "sender": "human", "message": f"message {i} " * 10})
+        response = self.client.get(f"/api/messages?room={room}", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert len(response.json()) == 20
+
+    def test_agents_etag_follows_connection_set(self):
+        room = "agents-cache-room"
+        response = self.client.get(f"/api/agents?room={room}")
+        etag = response.headers["etag"]
+        assert self.client.get(f"/api/agents?room={room}", headers={"If-None-Match": etag}).status_code == 304
+        with self.client.websocket_connect(f"/ws?room={room}&agent=agent1"):
+            response = self.client.get(f"/api/agents?room={room}", headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.json() == ["agent1"]
+
+    def test_bootstrap_snapshot(self):
+        room = "bootstrap-room"
+        self.client.post("/api/message", json={"room": room, "sender": "Alice", "message": "I have joined", "type": "system"})
+        for i in range(5):
+            self.client.post("/api/message", json={"room": room, "sender": "human", "message": f"question {i}"})
+        response = self.client.get(f"/api/bootstrap?room={room}&limit=3&summary=true")
+        assert response.status_code == 200
+        snapshot = response.json()
+        # システムメッセージを除いた直近3件
+        assert [m["message"] for m in snapshot["messages"]] == ["question 2", "question 3", "question 4"]
+        assert snapshot["last_id"] == snapshot["messages"][-1]["id"]
+        # メッセージは履歴APIと同じ形式
+        assert snapshot["messages"][-1] == self.client.get(f"/api/messages?room={room}&limit=1").json()[0]
+        # それより前の会話は要約にまとめられる
+        assert "2 messages from human (2)" in snapshot["summary"]
+        assert "I have joined" not in snapshot["summary"]
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import pytest
+
+try:
+    from llm_agentchat.server.sse import RoomFeed, encode_event, stream_events
+    _sse_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _sse_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server import app as app_module
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+
+pytestmark = pytest.mark.skipif(not _sse_module_found, reason="llm_agentchat.server.sse not found")
+
+def parse_events(chunk):
+    """SSEのチャンクを (id, event, data) のリストに変換します。"""
+    events = []
+    for block in chunk.decode("utf-8").split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if line and not line.startswith(":"))
+        if "data" in fields:
+            events.append((fields.get("id"), fields.get("event"), json.loads(fields["data"])))
+    return events
+
+async def next_events(stream):
+    return parse_events(await asyncio.wait_for(stream.__anext__(), 1))
+
+def test_feed_buffer_overflow_and_resume_position():
+    feed = RoomFeed("room1", latest_id=10, size=3)
+    for message_id in (11, 12, 13):
+        feed.publish(encode_event(json.dumps({"id": message_id}), message_id), message_id)
+    feed.publish(encode_event("{}", event="presence"))
+    assert feed.read(0) is None # 11 はすでに溢れている
+    assert [event_id for _, event_id, _ in feed.read(1)] == [12, 13, None]
+    assert feed.floor_id == 11
+    assert feed.cursor_after(12) == 2
+    assert feed.cursor_after(10) is None
+    assert feed.read(feed.seq) == []
+
+@pytest.mark.asyncio
+async def test_stream_backfills_then_follows_live_events():
+    feed = RoomFeed("room1", latest_id=5, size=2)
+    stored = {3: b"", 4: b"", 5: b""}
+    backfill = lambda after_id: [(i, encode_event(json.dumps({"id": i}), i)) for i in sorted(stored) if i > after_id]
+    stream = stream_events(feed, after_id=3, backfill=backfill, keepalive=0.05)
+    assert (await stream.__anext__()).startswith(b"retry:")
+    assert [data["id"] for _, _, data in await next_events(stream)] == [4, 5]
+
+    feed.publish(encode_event(json.dumps({"id": 6}), 6), 6)
+    assert await next_events(stream) == [("6", None, {"id": 6})]
+    assert await asyncio.wait_for(stream.__anext__(), 1) == b": keepalive\n\n"
+    await stream.aclose()
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+@pytest.mark.asyncio
+async def test_watchers_share_feed_and_resume_from_storage():
+    """保存されたメッセージが観戦者に一度だけエンコードして配信され、Last-Event-IDから再開できることをテストします。"""
+    app_module.app.state.db_path = ":memory:"
+    room = "sse-room"
+
+    def message(text):
+        return {"room": room, "sender": "human", "message": text, "type": "chat", "timestamp": "2024-01-01T00:00:00+00:00"}
+
+    await app_module.process_batch(room, [message("before")])
+    first = app_module.watch_feed(room, None)
+    second = app_module.watch_feed(room, None)
+    await first.__anext__()
+    await second.__anext__()
+    assert app_module.room_feeds[room].watchers == 2
+
+    await app_module.process_batch(room, [message("live1"), message("live2")])
+    live = await next_events(first)
+    assert [data["message"] for _, _, data in live] == ["live1", "live2"]
+    assert [data["message"] for _, _, data in await next_events(second)] == ["live1", "live2"]
+    await first.aclose()
+    await second.aclose()
+    assert room not in app_module.room_feeds
+
+    # 観戦者がいなくなった後の再接続はストレージから読み直す
+    resumed = app_module.watch_feed(room, int(live[0][0]))
+    await resumed.__anext__()
+    assert [data["message"] for _, _, data in await next_events(resumed)] == ["live2"]
+    await resumed.aclose()
+
+@pytest.mark.skipif(not _server_app_found, reason="llm_agentchat.server.app not found")
+def test_invalid_last_event_id_is_rejected():
+    client = TestClient(app_module.app)
+    response = client.get("/api/rooms/sse-room/stream", headers={"Last-Event-ID": "abc"})
+    assert response.status_code == 400
@@ -0,0 +1,152 @@
+import json
+import os
+import pytest
+
+try:
+    from llm_agentchat.server.storage import ENGINES, open_storage
+    from llm_agentchat.server.segment_log import SegmentLogStore
+    _storage_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _storage_module_found = False
+    ENGINES = ()
+
+pytestmark = pytest.mark.skipif(not _storage_module_found, reason="llm_agentchat.server.storage not found")
+
+@pytest.fixture(params=ENGINES)
+def store_factory(request, tmp_path):
+    """各ストレージエンジンを同じ保存先で開き直せるファクトリを提供するフィクスチャ。"""
+    engine = request.param
+    path = str(tmp_path / ("chat.db" if engine == "sqlite" else "chat_log"))
+    opened = []
+
+    def factory():
+        store = open_storage(engine, path)
+        opened.append(store)
+        return store
+
+    yield factory
+    for store in opened:
+        store.close()
+
+def add(store, room, text, message_type="chat"):
+    return store.add_message(room, "agent", text, message_type, "2024-01-01T00:00:00+00:00")
+
+class TestStorageConformance:
+    """全てのストレージエンジンが同じ振る舞いをすることを確認する適合テスト。"""
+
+    def test_ids_increase_within_room(self, store_factory):
+        store = store_factory()
+        first = add(store, "room1", "a")
+        add(store, "room2", "x")
+        second = add(store, "room1", "b")
+        assert second > first
+        assert store.latest_id("room1") == second
+        assert store.latest_id("missing") is None
+        assert store.get_messages("missing") == []
+
+    def test_pagination(self, store_factory):
+        store = store_factory()
+        ids = [add(store, "room1", f"msg{i}") for i in range(5)]
+        latest = store.get_messages("room1", limit=2)
+        assert [m["message_content"] for m in latest] == ["msg3", "msg4"]
+        assert [m["id"] for m in latest] == ids[3:]
+        assert set(latest[0]) >= {"id", "sender", "message_content", "timestamp", "message_type"}
+        assert [m["message_content"] for m in store.get_messages("room1", after_id=ids[2])] == ["msg3", "msg4"]
+        assert [m["message_content"] for m in store.get_messages("room1", limit=2, before_id=ids[3])] == ["msg1", "msg2"]
+
+    def test_messages_json_matches_api_format(self, store_factory):
+        store = store_factory()
+        ids = [add(store, "room1", f"メッセージ{i}") for i in range(4)]
+        page = json.loads(store.get_messages_json("room1", limit=2, before_id=ids[3]))
+        assert page == [
+            {"id": ids[i], "room": "room1", "sender": "agent", "message": f"メッセージ{i}",
+             "timestamp": "2024-01-01T00:00:00+00:00", "type": "chat"}
+            for i in (1, 2)
+        ]
+        assert [m["id"] for m in json.loads(store.get_messages_json("room1", after_id=ids[1]))] == ids[2:]
+        assert json.loads(store.get_messages_json("missing")) == []
+
+    def test_exclude_types(self, store_factory):
+        store = store_factory()
+        add(store, "room1", "joined", "system")
+        add(store, "room1", "hello")
+        messages = store.get_messages("room1", exclude_types=("system",))
+        assert [m["message_content"] for m in messages] == ["hello"]
+
+    def test_add_messages_batch(self, store_factory):
+        store = store_factory()
+        first = add(store, "room1", "single")
+        ids = store.add_messages("room1", [
+            ("agent", f"batch{i}", "chat", "2024-01-01T00:00:00+00:00", None) for i in range(3)
+        ])
+        assert len(ids) == 3 and ids == sorted(ids) and ids[0] > first
+        assert store.add_messages("room1", []) == []
+        assert add(store, "room1", "after") > ids[-1]
+        assert [m["message_content"] for m in store.get_messages("room1")] == [
+            "single", "batch0", "batch1", "batch2", "after",
+        ]
+
+    def test_messages_survive_reopen(self, store_factory):
+        store = store_factory()
+        last = [add(store, "room.with/odd name", f"msg{i}") for i in range(3)][-1]
+        store.close()
+        reopened = store_factory()
+        assert reopened.latest_id("room.with/odd name") == last
+        assert [m["message_content"] for m in reopened.get_messages("room.with/odd name")] == ["msg0", "msg1", "msg2"]
+        assert add(reopened, "room.with/odd name", "msg3") > last
+
+class TestSegmentLog:
+    """セグメントログ固有の動作（ロールオーバーとクラッシュ後の復旧）をテストするクラス。"""
+
+    def test_segment_rollover(self, tmp_path):
+        store = SegmentLogStore(str(tmp_path), segment_bytes=256)
+        for i in range(20):
+            add(store, "room1", f"message number {i}")
+        room_dir = tmp_path / "room1"
+        assert len([name for name in os.listdir(room_dir) if name.endswith(".seg")]) > 1
+        assert [m["message_content"] for m in store.get_messages("room1", limit=3, before_id=11)] == [
+            "message number 7", "message number 8", "message number 9",
+        ]
+        store.close()
+
+    def test_recovers_torn_tail_and_unindexed_records(self, tmp_path):
+        store = SegmentLogStore(str(tmp_path))
+        for i in range(3):
+            add(store, "room1", f"msg{i}")
+        store.close()
+        room_dir = tmp_path / "room1"
+        # 3件目のインデックスエントリが失われ、4件目のレコードが書きかけでクラッシュした状態を再現
+        with open(room_dir / "index", "r+b") as f:
+            f.seek(2 * 16)
+            f.write(b"\0" * 16)
+        segment = next(name for name in os.listdir(room_dir) if name.endswith(".seg"))
+        with open(room_dir / segment, "ab") as f:
+            f.write(b"\x40\x00\x00\x00garbage")
+
+        store = SegmentLogStore(str(tmp_path))
+        assert store.latest_id("room1") == 3
+        assert [m["message_content"] for m in store.get_messages("room1")] == ["msg0", "msg1", "msg2"]
+        assert add(store, "room1", "msg3") == 4
+        assert store.get_messages("room1", after_id=3)[0]["message_content"] == "msg3"
+        store.close()
+
+    def test_open_room_logs_are_bounded(self, tmp_path):
+        store = SegmentLogStore(str(tmp_path), max_open_rooms=2, fsync_batch=1000, fsync_interval=3600)
+        fds = len(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else None
+        for i in range(10):
+            add(store, f"room{i}", f"hello {i}")
+        assert list(store._rooms) == ["room8", "room9"]
+        if fds is not None:
+            # 閉じたルームのディスクリプタは残らない
+            assert len(os.listdir("/proc/self/fd")) - fds <= 2 * 3
+        # 閉じたルームも（未同期だった書き込みを含めて）開き直して読める
+        assert [m["message_content"] for m in store.get_messages("room0")] == ["hello 0"]
+        assert add(store, "room1", "again") == 2
+        assert list(store._rooms) == ["room0", "room1"]
+        store.close()
+
+    def test_segment_size_must_fit_index_offsets(self, tmp_path):
+        with pytest.raises(ValueError):
+            SegmentLogStore(str(tmp_path), segment_bytes=4 * 1024 ** 3)
+        with pytest.raises(ValueError):
+            SegmentLogStore(str(tmp_path), segment_bytes=0)
@@ -0,0 +1,41 @@
+import pytest
+
+try:
+    from llm_agentchat.server.storage_bench import check_thresholds, format_results, run_suite
+    _bench_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _bench_module_found = False
+
+pytestmark = pytest.mark.skipif(not _bench_module_found, reason="llm_agentchat.server.storage_bench not found")
+
+def test_suite_runs_at_small_scale(tmp_path):
+    """小さな規模でベンチマークの全ての計測が実行でき、合成した履歴が再利用されることをテストします。"""
+    logs = []
+    results = run_suite(str(tmp_path), rows=2000, rooms=20, queries=10, inserts=50,
+                        memory_messages=200, log=logs.append)
+    for engine in ("sqlite", "log"):
+        metrics = results[engine]
+        assert metrics["bytes_per_row"] > 0
+        assert metrics["recent_p95_ms"] > 0
+        assert metrics["insert_batch_rows_per_s"] > 0
+    assert "idx_room_name_id" in results["sqlite"]["details"]["plans"]["recent"]
+    assert results["memory"]["memory_search_p95_ms"] >= 0
+    assert "[sqlite]" in format_results(results)
+
+    generated = len(logs)
+    run_suite(str(tmp_path), engines=("sqlite",), rows=2000, rooms=20, queries=5, inserts=10,
+              memory_messages=0, log=logs.append)
+    assert len(logs) == generated
+
+def test_check_thresholds_reports_regressions():
+    results = {"dataset": {"rows": 10}, "sqlite": {"recent_p95_ms": 5.0, "insert_batch_rows_per_s": 100.0}}
+    thresholds = {
+        "_comment": "ignored",
+        "dataset": {"rows": 10},
+        "sqlite": {"recent_p95_ms": {"max": 2.0}, "insert_batch_rows_per_s": {"min": 50}, "page_p95_ms": {"max": 1}},
+        "log": {"recent_p95_ms": {"max": 2.0}},
+    }
+    failures = check_thresholds(results, thresholds)
+    assert len(failures) == 2
+    assert any("recent_p95_ms" in failure for failure in failures)
+    assert any("page_p95_ms: not measured" in failure for failure in failures)
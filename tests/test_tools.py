@@ -0,0 +1,141 @@
+import os
+import pytest
+import time
+
+try:
+    import llm
+    from llm_agentchat.client.tools import ToolSandbox
+    _tools_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _tools_module_found = False
+
+pytestmark = pytest.mark.skipif(not _tools_module_found, reason="llm_agentchat.client.tools not found")
+
+# ツールの実装は別プロセスに渡すため、モジュールレベルの関数として定義する
+def slow_add(a: int, b: int) -> int:
+    """Add two numbers slowly."""
+    time.sleep(0.5)
+    return a + b
+
+def hang() -> str:
+    """Never finishes."""
+    time.sleep(60)
+    return "done"
+
+def shout(text: str) -> str:
+    """Return a long string."""
+    return text.upper() * 1000
+
+def allocate() -> str:
+    """Allocate a lot of memory."""
+    data = bytearray(1024 * 1024 * 1024)
+    return str(len(data))
+
+def hang_with_pid(path: str) -> str:
+    """Record the process id, then never finish."""
+    with open(path, "w") as f:
+        f.write(str(os.getpid()))
+    time.sleep(60)
+    return "done"
+
+def allocate_mb(size: int) -> int:
+    """Allocate size MB of memory."""
+    return len(bytearray(size * 1024 * 1024))
+
+def crash() -> str:
+    """Exit without returning a result."""
+    os._exit(3)
+
+def numbers(count: int) -> list:
+    """Return a list of numbers."""
+    return list(range(count))
+
+def fail(text: str) -> str:
+    """Raise an error with a long message."""
+    raise ValueError(text * 100)
+
+def tool_call(name, **arguments):
+    return llm.ToolCall(name=name, arguments=arguments, tool_call_id=f"call-{name}")
+
+@pytest.mark.asyncio
+async def test_independent_calls_run_in_parallel():
+    sandbox = ToolSandbox(max_workers=2, timeout=10)
+    tools = {"slow_add": llm.Tool.function(slow_add)}
+    finished = []
+
+    async def on_result(call, result):
+        finished.append(result.output)
+
+    # forkserverの起動は初回のみのため、先に1回実行しておく
+    await sandbox.run(tools["slow_add"], tool_call("slow_add", a=0, b=0))
+
+    started = time.monotonic()
+    results = await sandbox.run_all(tools, [tool_call("slow_add", a=1, b=2), tool_call("slow_add", a=3, b=4)], on_result)
+    elapsed = time.monotonic() - started
+    assert [r.output for r in results] == ["3", "7"]
+    assert [r.tool_call_id for r in results] == ["call-slow_add", "call-slow_add"]
+    assert sorted(finished) == ["3", "7"]
+    # 2件を直列に実行すると1秒以上かかる
+    assert elapsed < 0.5 * 2 + 0.4
+
+@pytest.mark.asyncio
+async def test_limits_are_enforced():
+    sandbox = ToolSandbox(timeout=1, memory_limit_mb=256, max_output_chars=50)
+    tools = {fn.__name__: llm.Tool.function(fn) for fn in (hang, shout, allocate)}
+
+    started = time.monotonic()
+    timed_out = await sandbox.run(tools["hang"], tool_call("hang"))
+    assert "timed out" in timed_out.output
+    assert time.monotonic() - started < 5
+
+    truncated = await sandbox.run(tools["shout"], tool_call("shout", text="ab"))
+    assert truncated.output.startswith("ABAB")
+    assert "truncated" in truncated.output
+
+    out_of_memory = await sandbox.run(tools["allocate"], tool_call("allocate"))
+    assert out_of_memory.output.startswith("Error")
+
+    missing = await sandbox.run(None, tool_call("missing"))
+    assert "does not exist" in missing.output
+
+@pytest.mark.asyncio
+async def test_timed_out_tool_process_is_killed(tmp_path):
+    sandbox = ToolSandbox(max_workers=1, timeout=1)
+    tools = {fn.__name__: llm.Tool.function(fn) for fn in (hang_with_pid, slow_add)}
+    pid_file = tmp_path / "pid"
+
+    result = await sandbox.run(tools["hang_with_pid"], tool_call("hang_with_pid", path=str(pid_file)))
+    assert result.output == "Error: tool timed out after 1 seconds"
+    # タイムアウトしたプロセスは終了させられ、実行枠も解放される
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    assert (await sandbox.run(tools["slow_add"], tool_call("slow_add", a=1, b=1))).output == "2"
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(os.name != "posix", reason="RLIMIT_AS is only applied on POSIX")
+async def test_memory_limit_applies_per_call():
+    sandbox = ToolSandbox(timeout=10, memory_limit_mb=256)
+    tools = {fn.__name__: llm.Tool.function(fn) for fn in (allocate_mb, crash)}
+
+    over = await sandbox.run(tools["allocate_mb"], tool_call("allocate_mb", size=512))
+    assert over.output == "Error: tool exceeded its memory limit"
+    # 上限内の確保は成功し、メモリ上限の超過やクラッシュは後続の呼び出しに影響しない
+    within = await sandbox.run(tools["allocate_mb"], tool_call("allocate_mb", size=16))
+    assert within.output == str(16 * 1024 * 1024)
+    crashed = await sandbox.run(tools["crash"], tool_call("crash"))
+    assert crashed.output == "Error: tool process exited unexpectedly (exit code 3)"
+
+@pytest.mark.asyncio
+async def test_output_and_errors_are_truncated():
+    sandbox = ToolSandbox(timeout=10, max_output_chars=20)
+    tools = {fn.__name__: llm.Tool.function(fn) for fn in (shout, numbers, fail)}
+
+    shouted = await sandbox.run(tools["shout"], tool_call("shout", text="ab"))
+    assert shouted.output == "AB" * 10 + "\n... [truncated 1980 characters]"
+    # 文字列以外の結果はJSONにしてから切り詰める
+    listed = await sandbox.run(tools["numbers"], tool_call("numbers", count=3))
+    assert listed.output == "[0, 1, 2]"
+    long_list = await sandbox.run(tools["numbers"], tool_call("numbers", count=100))
+    assert long_list.output == "[0, 1, 2, 3, 4, 5, 6\n... [truncated 370 characters]"
+    failed = await sandbox.run(tools["fail"], tool_call("fail", text="x"))
+    assert failed.output == "Error: ValueError: x\n... [truncated 99 characters]"
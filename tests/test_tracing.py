@@ -0,0 +1,70 @@
+import pytest
+import json
+from unittest.mock import patch
+
+try:
+    from llm_agentchat import tracing
+    from llm_agentchat.tracing import Tracer, JsonlTraceExporter, is_sampled
+    _tracing_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _tracing_module_found = False
+
+try:
+    from fastapi.testclient import TestClient
+    from llm_agentchat.server.app import app, active_connections
+    _server_app_found = True
+except (ImportError, ModuleNotFoundError):
+    _server_app_found = False
+    app = None
+
+@pytest.mark.skipif(not _tracing_module_found, reason="llm_agentchat.tracing not found")
+def test_marks_are_exported_and_summarized(tmp_path):
+    """マークがJSONLに出力され、トレースごとの内訳として表示できることを確認します。"""
+    trace_file = tmp_path / "trace.jsonl"
+    tracer = Tracer("server", [JsonlTraceExporter(str(trace_file))])
+    message = {"room": "r1", "sender": "human", "message": "hi"}
+    tracer.mark(message, "received")
+    tracer.mark(message, "persisted")
+    tracer.mark(message, "broadcast", carry=False)
+    tracer.record(message["trace_id"], "llm_start", agent="AgentA")
+    tracer.close()
+
+    # 下流に伝えるマークだけがメッセージに残る
+    assert set(message["trace"]) == {"received", "persisted"}
+
+    # トレースが無効な場合はメッセージに trace フィールドを付けない
+    untraced = {"room": "r1", "sender": "human", "message": "hi"}
+    Tracer("server").mark(untraced, "received")
+    assert "trace" not in untraced and untraced["trace_id"]
+
+    traces = tracing.group_by_trace(tracing.load_trace_records([str(trace_file)]))
+    marks = traces[message["trace_id"]]
+    assert [m["name"] for m in marks] == ["received", "persisted", "broadcast", "llm_start"]
+    breakdown = tracing.format_breakdown(message["trace_id"], marks)
+    assert "llm_start" in breakdown and "AgentA" in breakdown
+
+@pytest.mark.skipif(not _tracing_module_found, reason="llm_agentchat.tracing not found")
+def test_sampling_is_deterministic_per_trace():
+    assert is_sampled("00000000aaaa", 0.5)
+    assert not is_sampled("ffffffffaaaa", 0.5)
+    assert not is_sampled("00000000aaaa", 0.0)
+
+@pytest.mark.skipif(not (_tracing_module_found and _server_app_found), reason="server app not found")
+@patch('llm_agentchat.server.app.get_storage')
+def test_server_records_ingest_marks(mock_get_storage, tmp_path):
+    """HTTPで投稿されたメッセージの受信・保存・配信のマークが記録されることを確認します。"""
+    mock_get_storage.return_value.add_message.return_value = 1
+    trace_file = tmp_path / "server.jsonl"
+    tracing.configure_tracing("server", trace_file=str(trace_file))
+    try:
+        app.state.db_path = ":memory:"
+        client = TestClient(app)
+        active_connections.clear()
+        response = client.post("/api/message", json={"room": "trace-room", "sender": "human", "message": "hello"})
+        assert response.status_code == 200
+    finally:
+        tracing.configure_tracing("agentchat")
+
+    records = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    assert [r["name"] for r in records] == ["received", "persisted", "broadcast"]
+    assert len({r["trace_id"] for r in records}) == 1
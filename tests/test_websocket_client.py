@@ -0,0 +1,128 @@
+import pytest
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
+try:
+    import websockets
+    from llm_agentchat.client.websocket_client import WebSocketClient
+    _client_module_found = True
+except (ImportError, ModuleNotFoundError):
+    _client_module_found = False
+    WebSocketClient = None
+
+pytestmark = pytest.mark.skipif(not _client_module_found, reason="llm_agentchat.client.websocket_client not found")
+
+def make_client(port: int, **kwargs) -> "WebSocketClient":
+    """テスト用にバックオフを短くしたクライアントを作成します。"""
+    return WebSocketClient(
+        server_url=f"ws://127.0.0.1:{port}",
+        room_name="test-room",
+        agent_name="TestAgent",
+        on_message=AsyncMock(),
+        initial_backoff=0.05,
+        max_backoff=0.1,
+        **kwargs,
+    )
+
+@pytest.mark.asyncio
+async def test_messages_sent_while_disconnected_are_flushed_on_connect():
+    """切断中に送信したメッセージがキューに保持され、接続後に順番通り送信されることを確認します。"""
+    received = []
+
+    async def handler(connection):
+        async for message in connection:
+            received.append(json.loads(message))
+
+    async with websockets.serve(handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        client = make_client(port)
+        await client.send_message({"message": "first"})
+        await client.send_message({"message": "second"})
+        assert client.pending_messages == 2
+
+        client.start()
+        assert await client.wait_connected(timeout=5)
+        for _ in range(50):
+            if len(received) == 2:
+                break
+            await asyncio.sleep(0.02)
+        await client.disconnect()
+
+    assert [m["message"] for m in received] == ["first", "second"]
+    assert client.pending_messages == 0
+    assert client.closed.is_set()
+
+@pytest.mark.asyncio
+async def test_client_reconnects_after_server_drops_connection():
+    """サーバー側で接続が切断されても、クライアントが自動的に再接続することを確認します。"""
+    connections = 0
+
+    async def handler(connection):
+        nonlocal connections
+        connections += 1
+        if connections == 1:
+            await connection.close()
+            return
+        await connection.wait_closed()
+
+    async with websockets.serve(handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        client = make_client(port)
+        client.start()
+        for _ in range(100):
+            if connections >= 2 and client.connected.is_set():
+                break
+            await asyncio.sleep(0.02)
+        assert connections >= 2
+        assert client.connected.is_set()
+        await client.disconnect()
+
+@pytest.mark.asyncio
+async def test_failed_send_on_live_socket_is_retried_with_the_next_message(caplog):
+    """接続が生きたまま送信に1回失敗しても、次の送信で残ったメッセージから順に送信されることを確認します。"""
+    client = make_client(1)
+    client.websocket = AsyncMock()
+    client.websocket.send.side_effect = [ConnectionError("send failed"), None, None]
+    await client.send_message({"message": "first"})
+    assert client.pending_messages == 1
+
+    with caplog.at_level("INFO", logger="llm_agentchat.client.websocket_client"):
+        await client.send_message({"message": "second"})
+    sent = [json.loads(call.args[0])["message"] for call in client.websocket.send.call_args_list]
+    assert sent == ["first", "first", "second"]
+    assert client.pending_messages == 0
+    assert not any("not connected" in record.getMessage() for record in caplog.records)
+
+def test_queue_is_bounded():
+    """送信待ちキューが上限を超えたら古いメッセージから破棄されることを確認します。"""
+    client = make_client(1, max_queue_size=2)
+    for i in range(3):
+        asyncio.run(client.send_message({"message": str(i)}))
+    assert client.pending_messages == 2
+    assert client.dropped_messages == 1
+
+@pytest.mark.asyncio
+async def test_client_answers_server_heartbeat():
+    """サーバーからのpingにpongを返し、pingはコールバックに渡さないことを確認します。"""
+    replies = []
+
+    async def handler(connection):
+        await connection.send(json.dumps({"type": "control", "action": "ping", "room": "test-room"}))
+        replies.append(json.loads(await connection.recv()))
+        # ハンドラが戻ると接続が閉じてクライアントが再接続するため、切断されるまで待つ
+        await connection.wait_closed()
+
+    async with websockets.serve(handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        client = make_client(port)
+        client.start()
+        assert await client.wait_connected(timeout=5)
+        for _ in range(50):
+            if replies:
+                break
+            await asyncio.sleep(0.02)
+        await client.disconnect()
+
+    assert replies == [{"type": "control", "action": "pong"}]
+    client.on_message.assert_not_called()